@@ -1,9 +1,20 @@
 #!/usr/bin/env python3
 
 # USAGE: ./power_plotter.py <csv_filename>"
+#        ./power_plotter.py --stream [--points N] [--chunk-bytes N] [--no-cache] <csv_filename> [<csv_filename> ...]
+#
+# stream mode reads the log (or rotated segments, .csv.gz is fine) in chunks,
+# plots a trace per device and downsamples each trace to at most N points.
+# parsed rows are cached next to each log in <csv_filename>.cache.npz and
+# later runs only parse rows appended since
 
 import sys
 import os.path
+import io
+import gzip
+import json
+import argparse
+import numpy as np
 import plotly
 import plotly.graph_objs as go
 import pandas as pd
@@ -11,24 +22,285 @@ from datetime import datetime
 
 TIME_COL_NAME = "time"
 Y_AXIS_COL_NAME = "power_usage"
+DEVICE_COL_NAME = "device_name"
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+DEFAULT_POINTS = 5000              # points per device trace in stream mode
+DEFAULT_CHUNK_BYTES = 32*1024*1024 # bytes of csv parsed at once in stream mode
+
+CACHE_SUFFIX = ".cache.npz"
+CACHE_VERSION = 1
+
+"""
+Function: Lttb
+largest triangle three buckets downsampling
+given x and y arrays (x increasing) and number of points to keep, returns
+indexes of the points that best preserve the shape of the line
+"""
+def Lttb(x, y, num_points):
+    num_rows = len(x)
+    if(num_points >= num_rows or num_points < 3):
+        return np.arange(num_rows)
+
+    # first and last points are always kept, the rest are split into buckets
+    edges = np.linspace(1, num_rows - 1, num_points - 1).astype(np.int64)
+
+    keep = np.empty(num_points, dtype=np.int64)
+    keep[0] = 0
+    keep[-1] = num_rows - 1
+
+    prev = 0
+    for i in range(num_points - 2):
+        start, end = edges[i], edges[i + 1]
+
+        # average of the next bucket (or the last point)
+        if(i + 2 < len(edges)):
+            next_x = x[end:edges[i + 2]].mean()
+            next_y = y[end:edges[i + 2]].mean()
+        else:
+            next_x = x[-1]
+            next_y = y[-1]
+
+        # pick the point making the largest triangle with the previous pick and the next average
+        area = np.abs((x[prev] - next_x) * (y[start:end] - y[prev]) - (x[prev] - x[start:end]) * (next_y - y[prev]))
+        prev = start + int(area.argmax())
+        keep[i + 1] = prev
+
+    return keep
+
+"""
+Function: Parse_chunk
+given csv bytes (complete rows, no header) returns arrays of times (ns
+since epoch), device names and watts
+"""
+def Parse_chunk(chunk_bytes):
+    chunk = pd.read_csv(io.BytesIO(chunk_bytes), header=None, names=[TIME_COL_NAME, DEVICE_COL_NAME, Y_AXIS_COL_NAME],
+                        dtype={DEVICE_COL_NAME: str})
+    chunk_times = pd.to_datetime(chunk[TIME_COL_NAME], format=TIME_FORMAT).values.astype(np.int64)
+    chunk_watts = pd.to_numeric(chunk[Y_AXIS_COL_NAME], errors="coerce").values.astype(np.float32)
+    return chunk_times, chunk[DEVICE_COL_NAME].values, chunk_watts
+
+class LogColumns():
+    """
+    parsed rows of one power log: times (ns since epoch), device ids
+    (indexes into names) and watts, plus how far into the file they go
+    """
+    def __init__(self):
+        self.names = []
+        self.times = [np.empty(0, dtype=np.int64)]
+        self.ids = [np.empty(0, dtype=np.int32)]
+        self.watts = [np.empty(0, dtype=np.float32)]
+        self.offset = 0
+        self.identity = None
+
+    def Add(self, chunk_times, chunk_names, chunk_watts):
+        name_ids = {name: i for i, name in enumerate(self.names)}
+        uniques, inverse = np.unique(chunk_names.astype(str), return_inverse=True)
+        uniques = [str(name) for name in uniques]
+        for name in uniques:
+            if(name not in name_ids):
+                name_ids[name] = len(self.names)
+                self.names.append(name)
+        lookup = np.array([name_ids[name] for name in uniques], dtype=np.int32)
+
+        self.times.append(chunk_times)
+        self.ids.append(lookup[inverse])
+        self.watts.append(chunk_watts)
+
+    def Arrays(self):
+        return np.concatenate(self.times), np.concatenate(self.ids), np.concatenate(self.watts)
+
+"""
+Function: Log_identity
+returns something that changes when a log file is replaced (rotated)
+rather than appended to: its inode and first data row
+"""
+def Log_identity(filename):
+    stat = os.stat(filename)
+    with Open_log(filename) as f:
+        f.readline()
+        first_row = f.readline().decode("utf-8", "replace")
+    return [stat.st_dev, stat.st_ino, first_row]
+
+def Open_log(filename):
+    if(filename.endswith(".gz")):
+        return gzip.open(filename, "rb")
+    return open(filename, "rb")
+
+def Load_cache(filename):
+    cache_filename = filename + CACHE_SUFFIX
+    columns = LogColumns()
+
+    if(not os.path.isfile(cache_filename)):
+        return columns
+
+    try:
+        with np.load(cache_filename) as cache:
+            meta = json.loads(str(cache["meta"]))
+            if(meta["version"] != CACHE_VERSION):
+                return columns
+            columns.names = list(meta["names"])
+            columns.times = [cache["times"]]
+            columns.ids = [cache["ids"]]
+            columns.watts = [cache["watts"]]
+            columns.offset = meta["offset"]
+            columns.identity = meta["identity"]
+    except (OSError, ValueError, KeyError):
+        print("ignoring unreadable cache " + cache_filename)
+        return LogColumns()
+
+    return columns
+
+def Save_cache(filename, columns):
+    cache_filename = filename + CACHE_SUFFIX
+    times, ids, watts = columns.Arrays()
+    meta = {"version": CACHE_VERSION, "names": columns.names, "offset": columns.offset, "identity": columns.identity}
+
+    # write next to the old cache then swap it in
+    tmp_filename = cache_filename + ".tmp.npz"
+    np.savez(tmp_filename, meta=np.array(json.dumps(meta)), times=times, ids=ids, watts=watts)
+    os.replace(tmp_filename, cache_filename)
+
+"""
+Function: Read_log
+returns LogColumns of a power log, parsing only what was appended since
+the cached parse (the whole file if not cached or the file was replaced)
+"""
+def Read_log(filename, chunk_bytes, use_cache):
+    identity = Log_identity(filename)
+
+    columns = Load_cache(filename) if use_cache else LogColumns()
+    if(columns.identity != identity or (not filename.endswith(".gz") and os.path.getsize(filename) < columns.offset)):
+        columns = LogColumns()
+    columns.identity = identity
+
+    start_offset = columns.offset
+
+    with Open_log(filename) as f:
+        if(columns.offset == 0):
+            # skip header
+            columns.offset = len(f.readline())
+        else:
+            f.seek(columns.offset)
+
+        remainder = b""
+        while(True):
+            block = f.read(chunk_bytes)
+            if(not block):
+                break
+
+            # only parse complete rows, the rest waits for the next block (or run)
+            block = remainder + block
+            end = block.rfind(b"\n") + 1
+            remainder = block[end:]
+            if(end == 0):
+                continue
+
+            columns.Add(*Parse_chunk(block[:end]))
+            columns.offset += end
+
+    if(use_cache and columns.offset != start_offset):
+        Save_cache(filename, columns)
+
+    return columns
+
+"""
+Function: Read_devices
+reads power log files, returns dict of device name -> (times, watts)
+unknown (negative) readings are dropped
+"""
+def Read_devices(filenames, chunk_bytes, use_cache=True):
+    times = dict()
+    watts = dict()
+
+    for filename in filenames:
+        columns = Read_log(filename, chunk_bytes, use_cache)
+        log_times, log_ids, log_watts = columns.Arrays()
+
+        known = log_watts >= 0
+        log_times, log_ids, log_watts = log_times[known], log_ids[known], log_watts[known]
+
+        for device_id, device_name in enumerate(columns.names):
+            rows = (log_ids == device_id)
+            times.setdefault(device_name, []).append(log_times[rows])
+            watts.setdefault(device_name, []).append(log_watts[rows])
+
+    devices = dict()
+    for device_name in times:
+        device_times = np.concatenate(times[device_name])
+        device_watts = np.concatenate(watts[device_name])
+
+        if(len(device_times) == 0):
+            continue
+
+        # segments may be given in any order
+        order = np.argsort(device_times, kind="stable")
+        devices[device_name] = (device_times[order], device_watts[order])
+
+    return devices
+
+def Plot_stream(filenames, num_points, chunk_bytes, use_cache):
+    devices = Read_devices(filenames, chunk_bytes, use_cache)
+
+    if(not devices):
+        print("no power readings found")
+        return
+
+    # setup figure
+    fig = go.Figure()
+    fig["layout"].update(title=", ".join(filenames))
+
+    print("Averages:")
+
+    # create a trace per device
+    for device_name in sorted(devices):
+        device_times, device_watts = devices[device_name]
+        keep = Lttb(device_times.astype(np.float64), device_watts.astype(np.float64), num_points)
+
+        print("  " + device_name + ": " + ("%.2f" % device_watts.mean()) + " W (" +
+              str(len(keep)) + " of " + str(len(device_watts)) + " points plotted)")
+
+        fig.add_trace(go.Scattergl(
+            x = pd.to_datetime(device_times[keep]),
+            y = device_watts[keep],
+            mode = "lines",
+            name = device_name,))
+
+    # plot the figure
+    plotly.offline.plot(fig, filename="".join(filenames[0].split(".")[:-1]) + "-GRAPH.html")
 
 def main(args):
-    # if no args given show usage
-    if (len(args) != 2):
-        print ("USAGE: " + args[0] + " <csv_filename>")
+    parser = argparse.ArgumentParser(description="plot a power usage log")
+    parser.add_argument("filenames", nargs="+", help="csv file(s), more than one only in stream mode")
+    parser.add_argument("--stream", action="store_true", help="read in chunks, plot each device downsampled")
+    parser.add_argument("--points", type=int, default=DEFAULT_POINTS, help="max points per device in stream mode")
+    parser.add_argument("--chunk-bytes", type=int, default=DEFAULT_CHUNK_BYTES, help="bytes of csv parsed at once in stream mode")
+    parser.add_argument("--no-cache", action="store_true", help="don't use or update the parse cache in stream mode")
+    opts = parser.parse_args(args[1:])
+
+    # see if files exist
+    for filename in opts.filenames:
+        if (not os.path.isfile(filename)):
+            print ("ERROR: csv file does not exist: " + filename)
+            return
+
+    if(opts.stream):
+        Plot_stream(opts.filenames, opts.points, opts.chunk_bytes, not opts.no_cache)
         return
-        
-    # see if file exists
-    if (not os.path.isfile(args[1])):
-        print ("ERROR: csv file does not exist")
+
+    if(len(opts.filenames) != 1):
+        print ("USAGE: " + args[0] + " <csv_filename>")
         return
-    
+
+    csv_filename = opts.filenames[0]
+
     # read data from file
     try:
-        inputData = pd.read_csv(args[1])
+        inputData = pd.read_csv(csv_filename)
     except:
-        inputData = pd.read_excel(args[1])
-        
+        inputData = pd.read_excel(csv_filename)
+
     # convert it to a time/date if found
     if TIME_COL_NAME in inputData.columns:
         inputData[TIME_COL_NAME] =  pd.to_datetime(inputData[TIME_COL_NAME])
@@ -37,20 +309,20 @@ def main(args):
         return
 
     devices = dict()
-    
+
     #for row in inputData.rows:
     #    devices.
-    
+
     y_labels = [Y_AXIS_COL_NAME]
-    
+
     # setup figure
     fig = plotly.tools.make_subplots(rows=1, cols=1, shared_xaxes=True, print_grid=False)
-    
+
     # set title to input filename
-    fig["layout"].update(title=args[1])
+    fig["layout"].update(title=csv_filename)
 
     trace_num = 1
-    
+
     # create each subplot
     for y_label in y_labels:
         print("y_label = " + str(y_label))
@@ -59,18 +331,18 @@ def main(args):
             y = inputData[y_label],
             mode = "lines",
             name = y_label,)
-        
+
         # add subplot to figure
         fig.append_trace(a_trace, trace_num, 1)
         trace_num += 1 # increment trace counter
-        
+
     # plot the figure
-    plotly.offline.plot(fig, filename="".join(args[1].split(".")[:-1]) + "-GRAPH.html")
+    plotly.offline.plot(fig, filename="".join(csv_filename.split(".")[:-1]) + "-GRAPH.html")
 
     # calulate averages
     print ("Averages:")
     print (inputData.mean(axis=0))
-    
+
 # run
 if __name__ == "__main__":
     main(sys.argv)
@@ -13,8 +13,10 @@ pip3 install XBee
 pip3 install Flask
 pip3 install Flask-BasicAuth
 apt install openssl
+pip3 install cheroot
 pip3 install pyopenssl
 pip3 install apscheduler
+pip3 install numpy
 pip3 install SQLAlchemy
 apt install python3-systemd
 
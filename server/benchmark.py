@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+# USAGE: ./benchmark.py [--sizes 5,25,100,200] [--concurrency 1,8] [--ops 50] [--output bench.json]
+
+import sys
+import os
+import json
+import math
+import time
+import atexit
+import random
+import tempfile
+import argparse
+import platform
+import contextlib
+from threading import *
+from concurrent.futures import ThreadPoolExecutor
+
+import sim_xbee
+from home import *
+
+DEFAULT_SIZES = "5,25,100,200"
+DEFAULT_CONCURRENCY = "1,8"
+DEFAULT_OPS = 50
+
+DISCOVERY_WAIT = 10 # seconds to wait for the simulated fleet to be discovered
+
+# responses that count as a failed operation
+ERROR_RESPONSES = ["failed", "unk", "invalid"]
+
+# commands benchmarked by default
+COMMANDS = ["test", "list_devices", "list_devices_with_types", "get_device_level", "get_device_level_uncached", "set_device_level",
+            "get_curr_temp", "get_set_temp", "set_temp", "get_temp_mode", "get_fan_mode", "set_temp_mode",
+            "set_fan_mode", "add_device", "change_device_name"]
+
+"""
+Function: Percentile
+nearest rank percentile of an already sorted list
+"""
+def Percentile(sorted_vals, pct):
+    if(not sorted_vals):
+        return 0.0
+    rank = max(0, min(len(sorted_vals) - 1, math.ceil((pct / 100.0) * len(sorted_vals)) - 1))
+    return sorted_vals[rank]
+
+class Workload():
+    """
+    generates Run_command params for each benchmarked command against a
+    home built on a simulated fleet
+
+    renamed : devices renamed by change_device_name, at least one per worker
+              thread so workers never rename the same device at once
+    """
+    def __init__(self, home, spares, renamed, seed=None):
+        self._home = home
+        self._rand = random.Random(seed)
+        self._spares = list(spares)
+        self._renamed = list(renamed)
+        self._renames = 0
+
+        # worker thread -> index of its device in renamed
+        self._worker = local()
+        self._num_workers = 0
+        self._workers_lock = Lock()
+
+        self.switches = [n for n in home._device_db if home._device_db[n]["type"] == SWITCH_TYPE]
+        self.dimmers = [n for n in home._device_db if home._device_db[n]["type"] == DIMMER_TYPE]
+        self.devices = self.switches + self.dimmers
+
+    def Commands(self):
+        return {
+            "test": lambda: [{"cmd": "test"}],
+            "list_devices": lambda: [{"cmd": "list_devices"}],
+            "list_devices_with_types": lambda: [{"cmd": "list_devices_with_types"}],
+            "get_device_level": lambda: [{"cmd": "get_device_level", "name": self._rand.choice(self.devices)}],
+            "get_device_level_uncached": lambda: [{"cmd": "get_device_level", "name": self._rand.choice(self.devices), "max_age": 0}],
+            "set_device_level": self._Set_level,
+            "get_curr_temp": lambda: [{"cmd": "get_curr_temp"}],
+            "get_set_temp": lambda: [{"cmd": "get_set_temp"}],
+            "set_temp": lambda: [{"cmd": "set_temp", "temp": self._rand.randint(65, 75)}],
+            "get_temp_mode": lambda: [{"cmd": "get_temp_mode"}],
+            "get_fan_mode": lambda: [{"cmd": "get_fan_mode"}],
+            "set_temp_mode": lambda: [{"cmd": "set_temp_mode", "temp_mode": self._rand.choice(["auto", "heat", "cool", "off"])}],
+            "set_fan_mode": lambda: [{"cmd": "set_fan_mode", "fan_mode": self._rand.choice(["auto", "on", "off"])}],
+            "add_device": self._Add_remove,
+            "change_device_name": self._Rename,
+        }
+
+    def _Set_level(self):
+        if(self.dimmers and self._rand.random() < 0.5):
+            return [{"cmd": "set_device_level", "name": self._rand.choice(self.dimmers), "level": self._rand.randint(0, 100)}]
+        return [{"cmd": "set_device_level", "name": self._rand.choice(self.switches or self.dimmers), "level": self._rand.choice(["on", "off"])}]
+
+    def _Add_remove(self):
+        # add a spare device then remove it again so the fleet size stays constant
+        device = self._spares.pop(0)
+        self._spares.append(device)
+        name = "bench_" + device.mac.hex()
+        return [{"cmd": "add_device", "name": name, "mac": device.mac.hex(), "type": device.device_type},
+                {"cmd": "remove_device", "name": name}]
+
+    """
+    Function: Add_renamed
+    adds the devices renamed by change_device_name to the db, they are
+    only in the db while it is benchmarked so other commands see the
+    fleet size asked for
+    """
+    def Add_renamed(self):
+        for device in self._renamed:
+            self._home.Add_device(self._Renamed_name(device), device.mac.hex(), device.device_type)
+
+    def Remove_renamed(self):
+        for device in self._renamed:
+            self._home.Remove_device(self._Renamed_name(device))
+
+    @staticmethod
+    def _Renamed_name(device):
+        return "rename_" + device.mac.hex()
+
+    def _Rename(self):
+        # each worker renames its own device, workers of one pool get consecutive indexes so never share
+        if(not hasattr(self._worker, "index")):
+            with self._workers_lock:
+                self._worker.index = self._num_workers % len(self._renamed)
+                self._num_workers += 1
+
+        with self._workers_lock:
+            self._renames += 1
+            renames = self._renames
+        name = self._Renamed_name(self._renamed[self._worker.index])
+        tmp_name = name + "_renamed_" + str(renames)
+        return [{"cmd": "change_device_name", "name": name, "new_name": tmp_name},
+                {"cmd": "change_device_name", "name": tmp_name, "new_name": name}]
+
+def Run_op(home, param_list):
+    # returns (latency of the first command, whether all commands succeeded)
+    latency = None
+    ok = True
+    for params in param_list:
+        start = time.perf_counter()
+        resp = home.Run_command(dict(params))
+        if(latency is None):
+            latency = time.perf_counter() - start
+        if(resp in ERROR_RESPONSES):
+            ok = False
+    return latency, ok
+
+def Bench_command(home, make_params, concurrency, ops):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        # params are made on the worker running them, workloads may keep per worker state
+        results = list(pool.map(lambda i: Run_op(home, make_params()), range(ops)))
+    wall = time.perf_counter() - start
+
+    latencies = sorted(r[0] for r in results)
+    errors = sum(1 for r in results if not r[1])
+
+    return {
+        "ops": ops,
+        "errors": errors,
+        "wall_s": wall,
+        "ops_per_sec": ops / wall if wall > 0 else 0.0,
+        "mean_ms": 1000 * sum(latencies) / len(latencies),
+        "p50_ms": 1000 * Percentile(latencies, 50),
+        "p95_ms": 1000 * Percentile(latencies, 95),
+        "p99_ms": 1000 * Percentile(latencies, 99),
+        "max_ms": 1000 * latencies[-1],
+    }
+
+def Bench_fleet(size, concurrencies, ops, commands, link, background, push_state, seed):
+    rand = random.Random(seed)
+
+    # fleet is half switches half dimmers, plus spare devices for add_device
+    fleet = sim_xbee.Make_fleet({SWITCH_TYPE: size - size//2, DIMMER_TYPE: size//2}, seed=seed)
+    spares = [sim_xbee.SimDevice("0013a2005" + ("%07x" % i), SWITCH_TYPE, hops=rand.randint(1, 3)) for i in range(4)]
+
+    # and a device per worker for change_device_name
+    renamed = [sim_xbee.SimDevice("0013a2006" + ("%07x" % i), SWITCH_TYPE, hops=rand.randint(1, 3)) for i in range(max(concurrencies))]
+
+    results = []
+
+    # run each fleet in its own directory so db and log files don't collide
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        orig_dir = os.getcwd()
+        os.chdir(tmp_dir)
+        try:
+            home = Home(radio=sim_xbee.Radio(fleet, link=link), push_state=push_state)
+            atexit.unregister(home.Exit)
+
+            # wait for discovery, then add anything discovery missed
+            deadline = time.time() + DISCOVERY_WAIT
+            while(len(home._device_db) < size and time.time() < deadline):
+                time.sleep(0.1)
+            for device in fleet:
+                if(not home.Mac_in_db(device.mac.hex())):
+                    home.Add_device(device.node_identifier, device.mac.hex(), device.device_type)
+
+            # spares join the mesh after discovery so they are only added by add_device
+            for device in spares + renamed:
+                home._zb.Add_device(device)
+
+            if(not background):
+                home._sched.pause()
+
+            workload = Workload(home, spares, renamed, seed=seed)
+            all_commands = workload.Commands()
+
+            for command in commands:
+                if(command == "change_device_name"):
+                    workload.Add_renamed()
+
+                for concurrency in concurrencies:
+                    result = Bench_command(home, all_commands[command], concurrency, ops)
+                    result.update({"fleet_size": size, "command": command, "concurrency": concurrency})
+                    results.append(result)
+                    print("%4d devices  %-24s c=%-3d %8.1f ops/s  p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms  errors %d" %
+                          (size, command, concurrency, result["ops_per_sec"], result["p50_ms"],
+                           result["p95_ms"], result["p99_ms"], result["errors"]), file=sys.__stdout__)
+
+                if(command == "change_device_name"):
+                    workload.Remove_renamed()
+
+            home.Exit()
+        finally:
+            os.chdir(orig_dir)
+
+    return results
+
+def main(args):
+    parser = argparse.ArgumentParser(description="benchmark Home.Run_command against a simulated radio")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma separated fleet sizes")
+    parser.add_argument("--concurrency", default=DEFAULT_CONCURRENCY, help="comma separated client thread counts")
+    parser.add_argument("--ops", type=int, default=DEFAULT_OPS, help="operations per command/concurrency pair")
+    parser.add_argument("--commands", default=None, help="comma separated subset of commands to run")
+    parser.add_argument("--hop-latency", type=float, default=sim_xbee.DEFAULT_HOP_LATENCY)
+    parser.add_argument("--jitter", type=float, default=sim_xbee.DEFAULT_JITTER)
+    parser.add_argument("--loss", type=float, default=sim_xbee.DEFAULT_LOSS)
+    parser.add_argument("--background", action="store_true", help="keep the power/temp/thermostat jobs running")
+    parser.add_argument("--push", action="store_true", help="run the server with push state tracking")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None, help="write json results to this file")
+    opts = parser.parse_args(args[1:])
+
+    sizes = [int(s) for s in opts.sizes.split(",")]
+    concurrencies = [int(c) for c in opts.concurrency.split(",")]
+
+    link = sim_xbee.SimLinkModel(hop_latency=opts.hop_latency, jitter=opts.jitter, loss=opts.loss, seed=opts.seed)
+
+    # get list of commands to run
+    commands = COMMANDS
+    if(opts.commands):
+        commands = [c for c in opts.commands.split(",") if c in COMMANDS]
+
+    report = {
+        "time": time.strftime(LOG_TIMESTAMP),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "link": {"serial_latency": link.serial_latency, "hop_latency": link.hop_latency,
+                 "jitter": link.jitter, "loss": link.loss},
+        "background": opts.background,
+        "push_state": opts.push,
+        "results": [],
+    }
+
+    # keep the server's log output out of the results
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for size in sizes:
+            report["results"].extend(Bench_fleet(size, concurrencies, opts.ops, commands, link, opts.background, opts.push, opts.seed))
+
+    if(opts.output):
+        with open(opts.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("wrote results to " + opts.output)
+    else:
+        print(json.dumps(report, indent=2))
+
+# run
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+import time
+from queue import *
+from threading import *
+
+"""
+last known state of each device
+
+holds the most recent level and power reading of every device along with
+when it was taken, so reads that can tolerate slightly old data are
+answered without a radio round trip. also holds the thermostat settings
+and modes, and a version number that goes up whenever anything in the
+table changes (not just the time of a reading), so a whole snapshot can
+be told apart from an older one.
+
+every change is also published as an event to subscribers, so clients can
+follow the state without polling.
+
+noisy readings (e.g. power) can be given a threshold: a new value that is
+closer than that to the last published one is stored but isn't a change,
+it neither bumps the version nor is published. the table is also split in
+parts (PART_*), each remembering the version it last changed at, so a read
+of only some parts can tell whether those changed.
+"""
+
+DEFAULT_MAX_QUEUED = 256   # events a subscriber may fall behind by before it is told to resync
+
+PART_DEVICES = "devices"         # devices added, removed or renamed
+PART_LEVEL = "level"             # device levels
+PART_POWER = "power"             # device power readings
+PART_THERMOSTAT = "thermostat"   # thermostat settings and modes
+PART_CURR_TEMP = "curr_temp"     # current temperature
+
+class DeviceStateTable():
+    """
+    thresholds : optional dict of field name -> smallest change of the field
+                 (from its last published value) that counts as a change
+    """
+    def __init__(self, thresholds=None):
+        # lock for state access
+        self._lock = RLock()
+
+        self._thresholds = dict(thresholds or {})
+
+        # device name -> {"level", "power", "time", "_updated", "_stale", "_published"}
+        self._states = dict()
+
+        # thermostat settings and current modes, and their last published values
+        self._thermostat = dict()
+        self._thermostat_published = dict()
+
+        # bumped on every change, notified to Wait_version callers
+        self._version = 0
+        self._changed = Condition(self._lock)
+
+        # part -> version it last changed at
+        self._part_versions = dict()
+
+        # queues of subscribed event listeners
+        self._subscribers = []
+
+    """
+    Function: Update
+    given a device name and any of level=, power=, records them as the
+    current state of the device
+    """
+    def Update(self, device_name, **fields):
+        with self._lock:
+            state = self._states.setdefault(device_name, dict())
+            published = state.setdefault("_published", dict())
+            changed = self._Changed(fields, published)
+            state.update(fields)
+            state["time"] = time.time()
+            state["_updated"] = time.monotonic()
+            state["_stale"] = state.get("_stale", set()) - set(fields)
+
+            if(changed):
+                published.update(changed)
+                parts = [PART_POWER if k == "power" else PART_LEVEL for k in changed]
+                self._Publish("device", parts, name=device_name, time=state["time"], **changed)
+
+    """
+    Function: Update_thermostat
+    given any thermostat settings or modes as keywords, records them
+    """
+    def Update_thermostat(self, **fields):
+        with self._lock:
+            changed = self._Changed(fields, self._thermostat_published)
+            self._thermostat.update(fields)
+
+            if(changed):
+                self._thermostat_published.update(changed)
+                parts = [PART_CURR_TEMP if k == "curr_temp" else PART_THERMOSTAT for k in changed]
+                self._Publish("thermostat", parts, **changed)
+
+    """
+    Function: Get
+    given a device name and max age in seconds, returns a copy of the
+    device state if it was updated within max_age, None otherwise
+    """
+    def Get(self, device_name, max_age):
+        with self._lock:
+            state = self._states.get(device_name)
+
+            if(state is None or "_updated" not in state or (time.monotonic() - state["_updated"]) > max_age):
+                return None
+
+            return {k: v for k, v in state.items() if k[0] != "_" and k not in state["_stale"]}
+
+    """
+    Function: Invalidate
+    marks a field (or the whole state if no field given) of a device as
+    stale so the next read goes to the device, the last known values are
+    still shown in snapshots
+    """
+    def Invalidate(self, device_name, field=None):
+        with self._lock:
+            state = self._states.get(device_name)
+            if(state is None):
+                return
+            if(field is None):
+                state["_stale"] = set(k for k in state if k[0] != "_")
+            else:
+                state.setdefault("_stale", set()).add(field)
+
+    """
+    Function: Add
+    starts an empty state for a new device, info (e.g. type=) goes in the event
+    """
+    def Add(self, device_name, **info):
+        with self._lock:
+            self._states[device_name] = dict()
+            self._Publish("device_added", [PART_DEVICES], name=device_name, **info)
+
+    def Remove(self, device_name):
+        with self._lock:
+            self._states.pop(device_name, None)
+            self._Publish("device_removed", [PART_DEVICES], name=device_name)
+
+    def Rename(self, orig_name, new_name):
+        with self._lock:
+            if(orig_name in self._states):
+                self._states[new_name] = self._states.pop(orig_name)
+            self._Publish("device_renamed", [PART_DEVICES], name=orig_name, new_name=new_name)
+
+    """
+    Function: Version
+    returns the version of the table, or given a list of parts the version
+    any of them last changed at
+    """
+    def Version(self, parts=None):
+        with self._lock:
+            return self._Version(parts)
+
+    """
+    Function: Wait_version
+    given a version (of the given parts, or the whole table), waits up to
+    timeout seconds for it to be any other version (newer, or reset by a
+    restart), returns the current version
+    """
+    def Wait_version(self, since_version, timeout, parts=None):
+        with self._lock:
+            self._changed.wait_for(lambda: self._Version(parts) != since_version, timeout=max(timeout, 0))
+            return self._Version(parts)
+
+    """
+    Function: Snapshot
+    returns (version, {device name: state}, thermostat) copied together
+    """
+    def Snapshot(self):
+        with self._lock:
+            states = {name: {k: v for k, v in state.items() if k[0] != "_"} for name, state in self._states.items()}
+            return self._version, states, dict(self._thermostat)
+
+    """
+    Function: Subscribe
+    returns a queue that gets an event dict for every change from now on,
+    each with "event" (device, thermostat, device_added, device_removed,
+    device_renamed), "version" and the changed fields. a subscriber that
+    falls max_queued events behind has its queue emptied and gets a single
+    "resync" event, it should take a new snapshot
+    """
+    def Subscribe(self, max_queued=DEFAULT_MAX_QUEUED):
+        queue = Queue(maxsize=max_queued)
+        with self._lock:
+            self._subscribers.append(queue)
+        return queue
+
+    def Unsubscribe(self, queue):
+        with self._lock:
+            if(queue in self._subscribers):
+                self._subscribers.remove(queue)
+
+    def _Version(self, parts):
+        # must hold self._lock
+        if(parts is None):
+            return self._version
+        return max([self._part_versions.get(part, 0) for part in parts] + [0])
+
+    def _Changed(self, fields, published):
+        # fields that differ from their published values, by at least their threshold if they have one
+        changed = dict()
+        for k, v in fields.items():
+            if(k not in published):
+                changed[k] = v
+            elif(k in self._thresholds and isinstance(v, (int, float)) and isinstance(published[k], (int, float))):
+                if(abs(v - published[k]) >= self._thresholds[k]):
+                    changed[k] = v
+            elif(published[k] != v):
+                changed[k] = v
+        return changed
+
+    def _Publish(self, event_type, parts, **fields):
+        # called with the lock held so events are queued in version order
+        self._version += 1
+        for part in parts:
+            self._part_versions[part] = self._version
+        self._changed.notify_all()
+
+        event = dict(fields)
+        event["event"] = event_type
+        event["version"] = self._version
+
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(event)
+            except Full:
+                # too far behind, drop what it hasn't read and have it start over
+                while(True):
+                    try:
+                        queue.get_nowait()
+                    except Empty:
+                        break
+                queue.put_nowait({"event": "resync", "version": self._version})
+
+if(__name__ == "__main__"):
+    print("this is a library. import it to use it")
+    exit(0)
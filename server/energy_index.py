@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+import os
+import gzip
+import json
+import time
+from threading import *
+
+"""
+sparse hourly index over the power log
+
+for every hour of the power log (current file and rotated segments) the
+index keeps the byte offset of the hour's first row, the energy each
+device used during the hour, and when each device was last read before
+the hour started. energy over a time range adds up the whole hours from
+the index and only reads the rows of the (at most two) partial hours at
+the ends of the range.
+
+a reading's energy is its power times the time since the device's
+previous reading (at most max_gap seconds), so energy of a range is the
+sum over the readings taken in it.
+
+rotated segments never change, their index is saved next to them as
+<segment>.idx. the current file is indexed in memory and extended as it
+grows.
+
+indexes are built without holding the index lock and swapped in when
+done. while Index_all is still going, queries read the rows of files it
+hasn't indexed yet rather than wait for it.
+"""
+
+DEFAULT_MAX_GAP = 30     # seconds, longest time a single reading is counted for
+HOUR = 60*60
+
+INDEX_SUFFIX = ".idx"
+
+class EnergyIndex():
+    """
+    filename  : current power log file (time,device_name,power_usage rows)
+    timestamp : strftime format of the time column
+    segments  : function returning the rotated segment filenames, oldest first
+    max_gap   : seconds a reading's power is counted for at most
+    """
+    def __init__(self, filename, timestamp, segments=lambda: [], max_gap=DEFAULT_MAX_GAP):
+        self._filename = filename
+        self._timestamp = timestamp
+        self._segments = segments
+        self._max_gap = max_gap
+
+        # lock for index access
+        self._lock = RLock()
+
+        # filename -> index dict, see _Build
+        self._indexes = dict()
+
+        # hour prefix of a time string -> unix time, parsing is the slow part of indexing
+        self._hour_times = dict()
+
+        # True while Index_all is building the indexes
+        self._indexing = False
+
+    """
+    Function: Energy
+    given a device name and time range (unix seconds), returns the energy
+    used by the device in that range in watt hours
+    """
+    def Energy(self, device_name, start, end):
+        watt_seconds = 0.0
+
+        # device's last reading time, carried from file to file when files are read row by row
+        last = dict()
+
+        for filename in self._Files():
+            with self._lock:
+                indexed = (not self._indexing or filename in self._indexes)
+                if(indexed):
+                    index = self._Index(filename)
+
+            # not indexed yet, read every row rather than wait for Index_all
+            if(not indexed):
+                for t, name, watts in self._Read_rows(filename, 0, None):
+                    if(name != device_name):
+                        continue
+                    reading = self._Reading_energy(last, name, t, watts)
+                    if(start <= t < end):
+                        watt_seconds += reading
+                continue
+
+            with self._lock:
+                hours = index["hours"]
+
+                for i in range(len(hours)):
+                    hour_start, offset, energy, prev = hours[i]
+
+                    if(hour_start + HOUR <= start or hour_start >= end):
+                        continue
+
+                    # whole hour in range
+                    if(start <= hour_start and hour_start + HOUR <= end):
+                        watt_seconds += energy.get(device_name, 0.0)
+                        continue
+
+                    # partial hour, read its rows
+                    end_offset = hours[i + 1][1] if i + 1 < len(hours) else index["size"]
+                    last = {device_name: prev[device_name]} if device_name in prev else dict()
+                    for t, name, watts in self._Read_rows(filename, offset, end_offset):
+                        if(name != device_name):
+                            continue
+                        reading = self._Reading_energy(last, name, t, watts)
+                        if(start <= t < end):
+                            watt_seconds += reading
+
+                last = {device_name: index["last"][device_name]} if device_name in index["last"] else dict()
+
+        return watt_seconds / HOUR
+
+    """
+    Function: Index_file
+    indexes a log file (if not already indexed), used to index segments as
+    soon as they are rotated
+    """
+    def Index_file(self, filename):
+        with self._lock:
+            if(filename in self._indexes):
+                return
+            seed = self._Seed(filename)
+        self._Add_index(filename, self._Load_or_build(filename, seed))
+
+    """
+    Function: Index_all
+    indexes every segment and the current file
+    """
+    def Index_all(self):
+        with self._lock:
+            self._indexing = True
+
+        try:
+            seed = dict()
+            for filename in self._Files():
+                with self._lock:
+                    index = self._indexes.get(filename)
+                if(index is None):
+                    index = self._Add_index(filename, self._Load_or_build(filename, seed))
+                seed = dict(index["last"])
+        finally:
+            with self._lock:
+                self._indexing = False
+
+    def _Add_index(self, filename, index):
+        # keeps an index built elsewhere in the meantime, returns the index kept
+        with self._lock:
+            return self._indexes.setdefault(filename, index)
+
+    def _Files(self):
+        files = list(self._segments())
+        if(os.path.isfile(self._filename)):
+            files.append(self._filename)
+        return files
+
+    def _Index(self, filename):
+        index = self._indexes.get(filename)
+
+        # rotated segment, load saved index or build it once
+        if(filename != self._filename):
+            if(index is None):
+                index = self._Load_or_build(filename, self._Seed(filename))
+                self._indexes[filename] = index
+            return index
+
+        # current file, start over if it was rotated since it was indexed
+        first_row = self._First_row(filename)
+        if(index is None or index["first_row"] != first_row or os.path.getsize(filename) < index["size"]):
+            index = self._New_index(self._Seed(filename))
+            index["first_row"] = first_row
+
+        # index rows written since last time
+        self._indexes[filename] = self._Build(filename, index)
+        return self._indexes[filename]
+
+    def _Load_or_build(self, filename, seed):
+        # new index of a file, needs no lock. rotated segments load their saved index or save the one built
+        if(filename == self._filename):
+            index = self._New_index(seed)
+            index["first_row"] = self._First_row(filename)
+            return self._Build(filename, index)
+
+        index_filename = filename + INDEX_SUFFIX
+        if(os.path.isfile(index_filename)):
+            with open(index_filename) as f:
+                return json.load(f)
+
+        index = self._Build(filename, self._New_index(seed))
+        tmp_filename = index_filename + "." + str(get_ident()) + ".tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_filename, index_filename)
+        return index
+
+    def _New_index(self, last):
+        # hours   : [hour start, byte offset of first row, {device: watt seconds}, {device: last reading time before hour}]
+        # size    : bytes of the file indexed so far
+        # last    : {device: last reading time} at the end of the indexed bytes
+        # first_row : first data row, identifies the current file
+        return {"hours": [], "size": 0, "last": last, "first_row": None}
+
+    def _Seed(self, filename):
+        # readings continue from the segment before this file
+        files = self._Files()
+        if(filename not in files or files.index(filename) == 0):
+            return dict()
+        previous = files[files.index(filename) - 1]
+        return dict(self._Index(previous)["last"])
+
+    def _Build(self, filename, index):
+        hours = index["hours"]
+        last = index["last"]
+
+        with self._Open(filename) as f:
+            row_offset = index["size"]
+            for offset, line in self._Lines(f, index["size"], None):
+                row = self._Parse_row(line)
+                if(row is not None):
+                    t, name, watts = row
+                    hour_start = t - (t % HOUR)
+                    if(not hours or hours[-1][0] != hour_start):
+                        hours.append([hour_start, row_offset, dict(), dict(last)])
+
+                    energy = hours[-1][2]
+                    energy[name] = energy.get(name, 0.0) + self._Reading_energy(last, name, t, watts)
+
+                # rows after the last complete line are indexed next time
+                row_offset = offset
+                index["size"] = offset
+
+        return index
+
+    def _Reading_energy(self, last, name, t, watts):
+        # unknown readings are not counted and don't start a new interval
+        if(watts < 0):
+            return 0.0
+
+        prev = last.get(name)
+        last[name] = t
+        if(prev is None):
+            return 0.0
+        return watts * min(max(t - prev, 0.0), self._max_gap)
+
+    def _Open(self, filename):
+        if(filename.endswith(".gz")):
+            return gzip.open(filename, 'rb')
+        return open(filename, 'rb')
+
+    def _First_row(self, filename):
+        with self._Open(filename) as f:
+            f.readline()
+            return f.readline().decode("utf-8", "replace")
+
+    def _Lines(self, f, start_offset, end_offset):
+        # yields (offset after line, line) of complete lines between the offsets
+        offset = start_offset
+        if(offset == 0):
+            # skip header
+            offset = len(f.readline())
+        else:
+            f.seek(offset)
+
+        while(end_offset is None or offset < end_offset):
+            line = f.readline()
+            if(not line.endswith(b"\n")):
+                # end of file, or a row still being written
+                return
+            offset += len(line)
+            yield offset, line
+
+    def _Read_rows(self, filename, start_offset, end_offset):
+        # yields (time, device name, watts) of rows between the offsets
+        with self._Open(filename) as f:
+            for offset, line in self._Lines(f, start_offset, end_offset):
+                row = self._Parse_row(line)
+                if(row is not None):
+                    yield row
+
+    def _Parse_row(self, line):
+        try:
+            timestamp, rest = line.decode("utf-8").split(",", 1)
+            name, watts = rest.rsplit(",", 1)
+            return (self._Parse_time(timestamp), name, float(watts))
+        except ValueError:
+            return None
+
+    def _Parse_time(self, timestamp):
+        if(not self._timestamp.endswith(":%M:%S")):
+            return time.mktime(time.strptime(timestamp, self._timestamp))
+
+        # parse each hour once, minutes and seconds are added on
+        hour_prefix, minute, second = timestamp.rsplit(":", 2)
+        hour_time = self._hour_times.get(hour_prefix)
+        if(hour_time is None):
+            hour_time = time.mktime(time.strptime(hour_prefix, self._timestamp[:-len(":%M:%S")]))
+            self._hour_times[hour_prefix] = hour_time
+        return hour_time + int(minute)*60 + int(second)
+
+if(__name__ == "__main__"):
+    print("this is a library. import it to use it")
+    exit(0)
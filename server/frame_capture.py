@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+# USAGE: ./frame_capture.py TRACE [--limit N]
+
+import sys
+import time
+import struct
+import argparse
+from collections import deque
+from threading import *
+
+"""
+api frame capture
+
+records every api frame passing between Home and the radio, in both
+directions, with a high resolution timestamp into an in-memory ring buffer.
+the buffer can be dumped to a compact binary trace file at any time, which
+Load reads back (e.g. to feed sim_xbee.ReplayZigBee, or to print it with
+this module run as a script).
+
+recording only keeps a reference to the frame, encoding happens on Dump.
+
+trace file layout (little endian):
+    header : magic "HZBT", version u8, wall clock start (f64 unix seconds),
+             clock start (u64 ns)
+    record : clock (u64 ns), direction u8, payload length u32, payload
+payloads are frame dicts in a small tagged encoding (see _Encode), bytes
+values are stored raw, lengths and counts are u32.
+"""
+
+DEFAULT_MAX_FRAMES = 10000   # frames kept in memory, oldest are dropped first
+
+RX = 0                       # frame received from the radio
+TX = 1                       # frame sent to the radio
+DIRECTIONS = {RX: "rx", TX: "tx"}
+
+TRACE_MAGIC = b'HZBT'
+TRACE_VERSION = 2
+
+HEADER_FORMAT = struct.Struct("<4sBdQ")
+RECORD_FORMAT = struct.Struct("<QBI")
+
+# value tags of the payload encoding
+TAG_NONE = b'N'
+TAG_TRUE = b'T'
+TAG_FALSE = b'F'
+TAG_INT = b'i'
+TAG_FLOAT = b'd'
+TAG_BYTES = b'b'
+TAG_STR = b's'
+TAG_LIST = b'l'
+TAG_DICT = b'm'
+
+LEN_FORMAT = struct.Struct("<I")
+INT_FORMAT = struct.Struct("<q")
+FLOAT_FORMAT = struct.Struct("<d")
+
+class FrameCapture():
+    """
+    max_frames : frames kept in the ring buffer
+    """
+    def __init__(self, max_frames=DEFAULT_MAX_FRAMES):
+        # wall clock and high resolution clock at the same moment, ties trace times to real time
+        self._wall_start = time.time()
+        self._clock_start = time.perf_counter_ns()
+
+        # lock for frame buffer access
+        self._lock = Lock()
+
+        # (clock ns, direction, frame dict), oldest first
+        self._frames = deque(maxlen=max_frames)
+
+        # frames recorded since start, including ones dropped from the buffer
+        self.frames_recorded = 0
+
+    """
+    Function: Record
+    given a direction (RX or TX) and a frame dict, records it with the
+    current time
+    """
+    def Record(self, direction, frame):
+        now = time.perf_counter_ns()
+        with self._lock:
+            self._frames.append((now, direction, frame))
+            self.frames_recorded += 1
+
+    """
+    Function: Wrap_callback
+    given a packet callback, returns a callback that records each packet
+    received before passing it on
+    """
+    def Wrap_callback(self, callback):
+        def Capture_callback(packet):
+            # copied, the callback is free to change the frame
+            self.Record(RX, dict(packet))
+            callback(packet)
+        return Capture_callback
+
+    """
+    Function: Wrap_radio
+    given a ZigBee api object, returns an object with the same api that
+    records each frame sent through at/remote_at/send
+    """
+    def Wrap_radio(self, zb):
+        return _CaptureRadio(self, zb)
+
+    def Frames(self):
+        with self._lock:
+            return list(self._frames)
+
+    """
+    Function: Dump
+    writes the frames in the buffer to a trace file, returns the number of
+    frames written
+    """
+    def Dump(self, filename):
+        frames = self.Frames()
+
+        # encode outside the lock, frames are never changed once recorded
+        with open(filename, "wb") as f:
+            f.write(HEADER_FORMAT.pack(TRACE_MAGIC, TRACE_VERSION, self._wall_start, self._clock_start))
+            for clock, direction, frame in frames:
+                payload = bytearray()
+                _Encode(frame, payload)
+                f.write(RECORD_FORMAT.pack(clock, direction, len(payload)))
+                f.write(payload)
+
+        return len(frames)
+
+class _CaptureRadio():
+    def __init__(self, capture, zb):
+        self._capture = capture
+        self._zb = zb
+
+    def at(self, **kwargs):
+        self.send("at", **kwargs)
+
+    def remote_at(self, **kwargs):
+        self.send("remote_at", **kwargs)
+
+    def send(self, cmd, **kwargs):
+        frame = dict(kwargs)
+        frame["id"] = cmd
+        self._capture.Record(TX, frame)
+        self._zb.send(cmd, **kwargs)
+
+    def __getattr__(self, name):
+        # everything else (halt, ...) goes straight to the radio
+        return getattr(self._zb, name)
+
+class Trace():
+    """
+    frames read from a trace file
+
+    wall_start : unix time the capture started
+    frames     : list of (seconds since the first frame, direction, frame dict)
+    """
+    def __init__(self, wall_start, frames):
+        self.wall_start = wall_start
+        self.frames = frames
+
+    def Duration(self):
+        return self.frames[-1][0] if self.frames else 0.0
+
+"""
+Function: Load
+given a trace file name, returns a Trace of its frames
+"""
+def Load(filename):
+    with open(filename, "rb") as f:
+        data = f.read()
+
+    if(len(data) < HEADER_FORMAT.size):
+        raise ValueError(filename + " is not a frame trace")
+    magic, version, wall_start, clock_start = HEADER_FORMAT.unpack_from(data, 0)
+    if(magic != TRACE_MAGIC):
+        raise ValueError(filename + " is not a frame trace")
+    if(version != TRACE_VERSION):
+        raise ValueError(filename + " has unsupported trace version " + str(version))
+
+    frames = []
+    first_clock = None
+    pos = HEADER_FORMAT.size
+    while(pos + RECORD_FORMAT.size <= len(data)):
+        clock, direction, length = RECORD_FORMAT.unpack_from(data, pos)
+        pos += RECORD_FORMAT.size
+        # a dump cut short ends with a partial record, keep what came before it
+        if(pos + length > len(data)):
+            break
+        frame = _Decode(data, pos)[0]
+        pos += length
+
+        if(first_clock is None):
+            first_clock = clock
+            wall_start += (clock - clock_start) / 1e9
+        frames.append(((clock - first_clock) / 1e9, direction, frame))
+
+    return Trace(wall_start, frames)
+
+def _Encode(value, out):
+    if(value is None):
+        out += TAG_NONE
+    elif(value is True):
+        out += TAG_TRUE
+    elif(value is False):
+        out += TAG_FALSE
+    elif(isinstance(value, int)):
+        out += TAG_INT
+        out += INT_FORMAT.pack(value)
+    elif(isinstance(value, float)):
+        out += TAG_FLOAT
+        out += FLOAT_FORMAT.pack(value)
+    elif(isinstance(value, (bytes, bytearray))):
+        out += TAG_BYTES
+        out += LEN_FORMAT.pack(len(value))
+        out += value
+    elif(isinstance(value, str)):
+        encoded = value.encode("utf-8")
+        out += TAG_STR
+        out += LEN_FORMAT.pack(len(encoded))
+        out += encoded
+    elif(isinstance(value, (list, tuple))):
+        out += TAG_LIST
+        out += LEN_FORMAT.pack(len(value))
+        for item in value:
+            _Encode(item, out)
+    elif(isinstance(value, dict)):
+        out += TAG_DICT
+        out += LEN_FORMAT.pack(len(value))
+        for k, v in value.items():
+            _Encode(str(k), out)
+            _Encode(v, out)
+    else:
+        # unknown types keep their text so the trace can still be read
+        _Encode(repr(value), out)
+
+def _Decode(data, pos):
+    # returns (value, position after it)
+    tag = data[pos:pos + 1]
+    pos += 1
+
+    if(tag == TAG_NONE):
+        return None, pos
+    elif(tag == TAG_TRUE):
+        return True, pos
+    elif(tag == TAG_FALSE):
+        return False, pos
+    elif(tag == TAG_INT):
+        return INT_FORMAT.unpack_from(data, pos)[0], pos + INT_FORMAT.size
+    elif(tag == TAG_FLOAT):
+        return FLOAT_FORMAT.unpack_from(data, pos)[0], pos + FLOAT_FORMAT.size
+    elif(tag in [TAG_BYTES, TAG_STR]):
+        length = LEN_FORMAT.unpack_from(data, pos)[0]
+        pos += LEN_FORMAT.size
+        value = bytes(data[pos:pos + length])
+        return (value if tag == TAG_BYTES else value.decode("utf-8")), pos + length
+    elif(tag == TAG_LIST):
+        count = LEN_FORMAT.unpack_from(data, pos)[0]
+        pos += LEN_FORMAT.size
+        items = []
+        for i in range(count):
+            item, pos = _Decode(data, pos)
+            items.append(item)
+        return items, pos
+    elif(tag == TAG_DICT):
+        count = LEN_FORMAT.unpack_from(data, pos)[0]
+        pos += LEN_FORMAT.size
+        items = dict()
+        for i in range(count):
+            k, pos = _Decode(data, pos)
+            v, pos = _Decode(data, pos)
+            items[k] = v
+        return items, pos
+
+    raise ValueError("bad value tag " + repr(tag) + " in frame trace")
+
+def main(args):
+    parser = argparse.ArgumentParser(description="print the frames of a trace file")
+    parser.add_argument("trace", help="trace file written by dump_frames")
+    parser.add_argument("--limit", type=int, default=None, help="print at most this many frames")
+    opts = parser.parse_args(args[1:])
+
+    trace = Load(opts.trace)
+    print("capture started " + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(trace.wall_start)) +
+          ", " + str(len(trace.frames)) + " frames over %.3f s" % trace.Duration())
+
+    frames = trace.frames if opts.limit is None else trace.frames[:opts.limit]
+    for t, direction, frame in frames:
+        print("%12.6f  %s  %s" % (t, DIRECTIONS.get(direction, "?"), frame))
+
+# run
+if __name__ == "__main__":
+    main(sys.argv)
@@ -7,17 +7,40 @@ import atexit
 from xbee import ZigBee
 import serial
 import logging
-from systemd.journal import JournalHandler
+from logging.handlers import QueueHandler, QueueListener
 import time
 from threading import *
 from apscheduler.schedulers.background import BackgroundScheduler
 from queue import *
-import RPi.GPIO as gpio
+from concurrent.futures import ThreadPoolExecutor, wait, TimeoutError
+from xbee_tx import XBeeTransactions
+from device_state import *
+from journal import Journal
+from power_history import PowerHistory
+from telemetry_writer import TelemetryWriter
+from energy_index import EnergyIndex
+from power_calc import Batch_power
+from metrics import Metrics
+from frame_capture import FrameCapture
+
+# journald and the raspberry pi gpio are only available on the pi itself,
+# fall back so the server can run against a simulated radio anywhere
+try:
+    from systemd.journal import JournalHandler
+except ImportError:
+    JournalHandler = None
+
+try:
+    import RPi.GPIO as gpio
+except ImportError:
+    from sim_xbee import SimGPIO as gpio
 gpio.setmode(gpio.BCM) # set gpio numbering mode to BCM
 
 DEVICE_DB_FILENAME = ".devices.json"               # path to device db file
 #TASKS_DB_FILENAME = "sqlite:///.tasks.db"          # path to task db file
 THERM_SETTINGS_FILENAME = ".thermostat.json"       # path to thermostat settings file
+JOURNAL_FSYNC_DELAY = 0.5                          # seconds from a db/settings change to it being on disk
+JOURNAL_COMPACT_RECORDS = 500                      # journaled changes before the db/settings file is rewritten
 LEVEL_UNK = -1                                     # special device level used to mean level is unknown
 UNK = "unknown"
 
@@ -37,17 +60,30 @@ THERM_TASKID = "__therm_task__"
 ###################### Logging Constants ###########################
 LOG_FILENAME = "main_log.log"
 LOG_FORMAT = '%(asctime)s : %(name)s : %(message)s'
+CONSOLE_LOG_FORMAT = '%(asctime)s: %(message)s'
 LOG_TIMESTAMP = "%Y-%m-%d %H:%M:%S"
+LOG_LEVEL = logging.INFO # level of home messages logged, logging.DEBUG adds per step dimmer messages
 
 POWER_LOG_FILENAME = "power_log.csv"
 POWER_LOG_INTERVAL = .1 # interval in minutes
 POWER_TIMESTAMP = LOG_TIMESTAMP
+POWER_SWEEP_CONCURRENCY = 8                      # max devices sampled at once by a power sweep
+POWER_SWEEP_DEADLINE = 0.8 * POWER_LOG_INTERVAL * 60 # seconds a power sweep may take, unfinished devices log unknown
+POWER_HISTORY_RAW = 600                          # raw power readings kept in memory per device (1 hour at 6 s)
+POWER_HISTORY_MINUTES = 24*60                    # 1 minute power rollups kept in memory per device
+POWER_HISTORY_HOURS = 30*24                      # 1 hour power rollups kept in memory per device
+ENERGY_MAX_GAP = 5 * POWER_LOG_INTERVAL * 60     # seconds a logged power reading counts towards energy at most
+POWER_SAMPLES = 4                                # current sense readings combined into one power reading
+POWER_SAMPLE_IR = b'\x00\x64'                    # sample interval (ms) while taking several readings
 
 TEMP_LOG_FILENAME = "temp_log.csv"
 TEMP_LOG_INTERVAL = 5 # interval in minutes
 TEMP_LOG_UNITS = "F" # possible values: "F", "C", "K"
 TEMP_TIMESTAMP = LOG_TIMESTAMP
 
+TELEMETRY_MAX_BYTES = 5*1024*1024 # size power/temp logs are rotated at (also rotated daily), rotated logs are gzipped
+TELEMETRY_FLUSH_INTERVAL = 30     # seconds power/temp log rows are buffered before being written
+
 ##################### Thermostat Constants ########################
 # default settings
 INIT_TEMP_MODE = "off"   # possible values: "off", "auto", "heat", "cool"
@@ -70,7 +106,60 @@ TEMP_ADC = 'D0'
 ###################### XBee Constants ###########################
 DEFAULT_TIMEOUT = 2 # seconds
 
-MAX_RX_TRIES = 3
+XBEE_PORT = "/dev/ttyS0"
+XBEE_BAUDRATE = 9600
+
+# seconds a cached device level is good for when a request doesn't give max_age
+STATE_MAX_AGE = 5
+
+# push state tracking: devices report relay changes and sample periodically on
+# their own, levels are answered from the pushed samples
+PUSH_STATE = False
+PUSH_SAMPLE_INTERVAL = 10                       # seconds between periodic samples
+PUSH_STATE_MAX_AGE = 2.5 * PUSH_SAMPLE_INTERVAL # default max_age of level reads when pushing
+
+# changes smaller than these (from the last published value) aren't state changes: they don't
+# change the state version or go out as events, so sensor noise doesn't wake every client
+STATE_POWER_THRESHOLD = 2.0   # watts
+STATE_TEMP_THRESHOLD = 0.5    # degrees F
+
+# commands Run_command knows, anything else is answered "invalid"
+COMMANDS = ["test", "get_curr_temp", "get_set_temp", "set_temp", "set_temp_mode", "set_fan_mode", "get_temp_mode",
+            "get_fan_mode", "set_device_level", "get_device_level", "get_metrics", "dump_frames", "get_state",
+            "get_power_history", "get_energy_usage", "add_device", "remove_device", "change_device_name",
+            "calibrate_dimmer", "discover_devices", "list_devices", "list_devices_with_types"]
+
+# reads that can be made conditional on the state version with since_version, and the parts of
+# the state each returns (None for all), their version only changes when those parts do
+STATE_READ_PARTS = {"get_state": None,
+                    "get_device_level": [PART_DEVICES, PART_LEVEL],
+                    "get_curr_temp": [PART_CURR_TEMP],
+                    "get_set_temp": [PART_THERMOSTAT],
+                    "get_temp_mode": [PART_THERMOSTAT],
+                    "get_fan_mode": [PART_THERMOSTAT],
+                    "list_devices": [PART_DEVICES],
+                    "list_devices_with_types": [PART_DEVICES]}
+STATE_READ_COMMANDS = list(STATE_READ_PARTS)
+LONG_POLL_TIMEOUT = 30   # seconds a since_version read waits for a change by default
+LONG_POLL_MAX = 120      # seconds a since_version read may wait at most
+
+# sample waiter key used for the local (coordinator) xbee
+LOCAL_WAITER_KEY = b'local'
+
+# max number of at/remote_at commands waiting for a response, across all devices
+XB_TX_WINDOW = 8
+
+# seconds to wait for a command's future at most, the transaction layer resolves it within
+# DEFAULT_TIMEOUT unless it has been closed
+XB_RESULT_TIMEOUT = 2 * DEFAULT_TIMEOUT
+
+# frame id used for discovery, never handed out by the transaction layer
+XB_DISCOVERY_FRAME_ID = b'\x01'
+
+# every api frame sent and received is kept in memory, dumped with dump_frames
+FRAME_CAPTURE = True
+FRAME_CAPTURE_FRAMES = 10000                    # most recent frames kept
+FRAME_TRACE_FILENAME = "frames-%Y%m%d-%H%M%S.trace" # default dump file name (strftime format)
 
 XB_CONF_HIGH = b'\x05'
 XB_CONF_LOW = b'\x04'
@@ -81,6 +170,10 @@ XB_CONF_ADC = b'\x02'
 # max inc/dec tries before giving up on setting light level
 LIGHT_SET_TRIES = 50
 
+# max difference between the calibrated and measured brightness after an open
+# loop dimmer move before falling back to stepping and sampling
+LIGHT_CAL_TOLERANCE = 3
+
 CUSTOM_PULSE_TIME = 0.25 # seconds
 
 # relay toggle pin
@@ -106,12 +199,40 @@ DIODE_DROP = 0.326
 # ac voltage
 AC_VOLTAGE = 170
 
+class _LogQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # leave formatting to the listener thread, log calls only queue the record
+        return record
+
 class Home():
-    def __init__(self): #, thermostat_function, power_log_function, temp_log_function):
-        # setup logging
-        logging.basicConfig(filename=LOG_FILENAME, level=logging.INFO, format=LOG_FORMAT, datefmt=LOG_TIMESTAMP)
+    """
+    radio      : optional function taking the packet callback and returning a
+                 ZigBee api object (e.g. sim_xbee.SimZigBee), uses the xbee on
+                 XBEE_PORT if not given
+    push_state : if True devices push their state (see PUSH_STATE)
+    """
+    def __init__(self, radio=None, push_state=PUSH_STATE): #, thermostat_function, power_log_function, temp_log_function):
+        # setup logging, records are queued and written out by a background thread so
+        # callers (often holding the radio) never wait on the log file, journald or the terminal
+        self._log_queue = SimpleQueue()
+        self._log_listener = QueueListener(self._log_queue, *self._Log_handlers(), respect_handler_level=True)
+        self._log_listener.start()
+        self._log_handler = _LogQueueHandler(self._log_queue)
+        logging.getLogger().setLevel(logging.INFO)
+        logging.getLogger().addHandler(self._log_handler)
         self._log = logging.getLogger('home')
-        self._log.addHandler(JournalHandler())
+        self._log.setLevel(LOG_LEVEL)
+
+        self._radio = radio
+        self._push_state = push_state
+
+        # set once Exit has run
+        self._exited = False
+        self._exit_lock = Lock()
+
+        # latency histograms and counters, read with get_metrics or as prometheus text
+        self._metrics = Metrics()
+        self._Describe_metrics()
         
         self.Log("starting server, please wait...")
 
@@ -122,9 +243,35 @@ class Home():
         # set up zigbee
         self._Setup_zigbee()
 
+        # workers for power sweeps, devices still being sampled are skipped by the next sweep
+        self._sweep_pool = ThreadPoolExecutor(max_workers=POWER_SWEEP_CONCURRENCY, thread_name_prefix="power-sweep")
+        self._sweep_in_flight = set()
+        self._sweep_lock = Lock()
+
+        # hourly index of the power log for energy queries
+        self._energy_index = EnergyIndex(POWER_LOG_FILENAME, POWER_TIMESTAMP, segments=lambda: self._power_log.Segments(),
+                                         max_gap=ENERGY_MAX_GAP)
+
+        # power and temperature csv logs, written in the background, rotated power logs are indexed right away
+        self._power_log = TelemetryWriter(POWER_LOG_FILENAME, ["time", "device_name", "power_usage"], POWER_TIMESTAMP,
+                                          max_bytes=TELEMETRY_MAX_BYTES, flush_interval=TELEMETRY_FLUSH_INTERVAL,
+                                          on_rotate=self._energy_index.Index_file, log=self.Log)
+        self._temp_log = TelemetryWriter(TEMP_LOG_FILENAME, ["time", "temperature", "units", "temp_mode", "fan_mode"], TEMP_TIMESTAMP,
+                                         max_bytes=TELEMETRY_MAX_BYTES, flush_interval=TELEMETRY_FLUSH_INTERVAL, log=self.Log)
+
+        # recent power usage of each device
+        self._power_history = PowerHistory(raw_size=POWER_HISTORY_RAW, minute_size=POWER_HISTORY_MINUTES, hour_size=POWER_HISTORY_HOURS)
+
+        # index power logs from before this start in the background
+        Thread(target=self._energy_index.Index_all, name="energy-index", daemon=True).start()
+
         # set up thermostat
         self._Setup_therm()
 
+        # turn on state tracking for devices already in the db
+        if(self._push_state):
+            Thread(target=self._Configure_push_all).start()
+
         # send discovery packet
         self.Send_discovery_packet()
 
@@ -134,13 +281,21 @@ class Home():
         self.Log_power_usage()
         
         # start power usage logger task
-        self._sched.add_job(self.Log_power_usage, trigger='interval', minutes=POWER_LOG_INTERVAL, id=POWER_LOG_TASKID, replace_existing=True)
+        self._sched.add_job(self._metrics.Timed(self.Log_power_usage, "job_seconds", job="log_power_usage"),
+                            trigger='interval', minutes=POWER_LOG_INTERVAL, id=POWER_LOG_TASKID, replace_existing=True)
 
         # start temperature logger task
-        self._sched.add_job(self.Log_temp, trigger='interval', minutes=TEMP_LOG_INTERVAL, id=TEMP_LOG_TASKID, replace_existing=True)
+        self._sched.add_job(self._metrics.Timed(self.Log_temp, "job_seconds", job="log_temp"),
+                            trigger='interval', minutes=TEMP_LOG_INTERVAL, id=TEMP_LOG_TASKID, replace_existing=True)
 
         # start thermostat updater task
-        self._sched.add_job(self.Thermostat_update, trigger='interval', seconds=THERM_INTERVAL, id=THERM_TASKID, replace_existing=True)
+        self._sched.add_job(self._metrics.Timed(self.Thermostat_update, "job_seconds", job="thermostat_update"),
+                            trigger='interval', seconds=THERM_INTERVAL, id=THERM_TASKID, replace_existing=True)
+
+        # queue depths, read when metrics are read
+        self._metrics.Gauge("xbee_outstanding_commands", self._zb_tx.Outstanding)
+        self._metrics.Gauge("sample_waiters", self._Num_sample_waiters)
+        self._metrics.Gauge("devices", lambda: len(self._device_db))
 
         # register shutdown proceedure
         atexit.register(self.Exit)
@@ -148,36 +303,134 @@ class Home():
         # setup complete
         self.Log("server ready!")
 
+    def _Log_handlers(self):
+        # everything logged goes to the log file, only home messages to the terminal and journald
+        file_handler = logging.FileHandler(LOG_FILENAME)
+        file_handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_TIMESTAMP))
+
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(logging.Formatter(CONSOLE_LOG_FORMAT, datefmt=LOG_TIMESTAMP))
+        console_handler.addFilter(logging.Filter('home'))
+
+        handlers = [file_handler, console_handler]
+        if(JournalHandler is not None):
+            journal_handler = JournalHandler()
+            journal_handler.addFilter(logging.Filter('home'))
+            handlers.append(journal_handler)
+        return handlers
+
+    def _Describe_metrics(self):
+        self._metrics.Describe("command_seconds", "Run_command latency by command (long poll waits not included)")
+        self._metrics.Describe("long_polls_total", "since_version reads by whether the state changed (stale: read again, cached state too old)")
+        self._metrics.Describe("sample_seconds", "time from requesting an io sample to receiving it, by device")
+        self._metrics.Describe("sample_timeouts_total", "io samples not received in time, by device")
+        self._metrics.Describe("job_seconds", "scheduled job duration by job")
+        self._metrics.Describe("xbee_command_seconds", "at/remote_at command round trip time")
+        self._metrics.Describe("xbee_command_timeouts_total", "at/remote_at commands that got no response in time")
+        self._metrics.Describe("xbee_frames_sent_total", "api frames sent by frame type")
+        self._metrics.Describe("xbee_frames_received_total", "api frames received by frame type")
+        self._metrics.Describe("xbee_outstanding_commands", "at/remote_at commands waiting for a response")
+        self._metrics.Describe("sample_waiters", "samplers waiting for an io sample")
+        self._metrics.Describe("devices", "devices in the db")
+
+    """
+    Function: Get_metrics
+    returns a dict of every metric (see Metrics.Snapshot)
+    """
+    def Get_metrics(self):
+        return self._metrics.Snapshot()
+
+    """
+    Function: Metrics_text
+    returns every metric in the prometheus text exposition format
+    """
+    def Metrics_text(self):
+        return self._metrics.Prometheus()
+
+    """
+    Function: Metrics
+    returns the Metrics holding the home's counters and histograms, for
+    code outside home that counts things of its own
+    """
+    def Metrics(self):
+        return self._metrics
+
+    """
+    Function: Dump_frames
+    writes the captured api frames to a trace file in the server directory
+    (FRAME_TRACE_FILENAME if no name given), returns a dict of the file name,
+    frames written and frames recorded since start, or None if capture is off
+    """
+    def Dump_frames(self, filename=None):
+        if(self._capture is None):
+            return None
+
+        # no paths, dumps only go in the server directory
+        if(filename is None):
+            filename = time.strftime(FRAME_TRACE_FILENAME)
+        filename = os.path.basename(filename)
+
+        num_frames = self._capture.Dump(filename)
+        self.Log("dumped " + str(num_frames) + " api frames to " + filename)
+        return {"filename": filename, "frames": num_frames, "frames_recorded": self._capture.frames_recorded}
+
+    def _Num_sample_waiters(self):
+        with self._waiters_lock:
+            return sum(len(waiters) for waiters in self._sample_waiters.values())
+
     def Exit(self):
 
+        # only shut down once, e.g. an explicit Exit followed by the atexit one
+        with self._exit_lock:
+            if(self._exited):
+                return
+            self._exited = True
+
         # log
         self.Log("shutdown procedure started...")
 
         # stop scheduler
         self._sched.shutdown()
 
+        # stop power sweep workers, abandon devices not yet started
+        self._sweep_pool.shutdown(wait=False, cancel_futures=True)
+
+        # write out buffered log rows
+        self._power_log.Close()
+        self._temp_log.Close()
+
         # write device database to file
         # get db lock
         with self._db_lock:
-            # dump db to file
-            with open(DEVICE_DB_FILENAME, 'w') as f:
-                json.dump(self._device_db, f)
+            # write final snapshot, also saves fields that aren't journaled
+            self._db_journal.Close(self._device_db)
         
         # get thermostat lock
         with self._therm_lock:
-            # dump thermostat settings to file
-            with open(THERM_SETTINGS_FILENAME, 'w') as f:
-                json.dump(self._therm_settings, f)
+            # write final snapshot
+            self._therm_journal.Close(self._therm_settings)
 
             # set gpio back to defaults
             gpio.cleanup()
 
+        # fail any commands still waiting for a response
+        self._zb_tx.Close()
+
         # close serial connection
         with self._zb_lock:
-            self._ser.close()
+            if(self._ser is not None):
+                self._ser.close()
+            else:
+                self._zb.halt()
 
         self.Log("shutdown procedure complete")
 
+        # write out queued log messages
+        logging.getLogger().removeHandler(self._log_handler)
+        self._log_listener.stop()
+        for handler in self._log_listener.handlers:
+            handler.close()
+
     def _Setup_zigbee(self):
 
         # create lock for zigbee access
@@ -186,36 +439,70 @@ class Home():
         # create lock for device_db access
         self._db_lock = RLock()
 
-        # create lock for permission to process zigbee packets
-        self._process_packets_lock = RLock()
+        # create table of last known device states
+        self._state = DeviceStateTable(thresholds={"power": STATE_POWER_THRESHOLD, "curr_temp": STATE_TEMP_THRESHOLD})
+
+        # create lock for sample waiter table
+        self._waiters_lock = RLock()
+
+        # samplers waiting for io samples, mac bytes (or LOCAL_WAITER_KEY) -> list of queues
+        self._sample_waiters = dict()
 
-        # create queue for holding pending zigbee packets
-        self._packet_queue = Queue(maxsize=10)
+        # create lock for dimmer ramp table
+        self._ramps_lock = Lock()
 
-        # setup serial connection to zigbee module
-        ser = serial.Serial()
-        ser.port = "/dev/ttyS0"
-        ser.baudrate = 9600
-        ser.timeout = 3
-        ser.write_timeout = 3
-        ser.exclusive = True
-        ser.open()
+        # dimmers being ramped, device name -> latest target level
+        self._ramps = dict()
 
-        self._ser = ser
+        # recent api frames in both directions
+        self._capture = FrameCapture(max_frames=FRAME_CAPTURE_FRAMES) if FRAME_CAPTURE else None
+        recv_handler = self._capture.Wrap_callback(self.Recv_handler) if FRAME_CAPTURE else self.Recv_handler
 
-        # create zigbee api object
-        self._zb = ZigBee(ser, escaped=True, callback=self.Recv_handler)
+        # if using a simulated (or otherwise provided) radio
+        if(self._radio is not None):
+            self.Log("using provided radio instead of " + XBEE_PORT)
+            self._ser = None
+            self._zb = self._radio(recv_handler)
+
+        else:
+            # setup serial connection to zigbee module
+            ser = serial.Serial()
+            ser.port = XBEE_PORT
+            ser.baudrate = XBEE_BAUDRATE
+            ser.timeout = 3
+            ser.write_timeout = 3
+            ser.exclusive = True
+            ser.open()
+
+            self._ser = ser
+
+            # create zigbee api object
+            self._zb = ZigBee(ser, escaped=True, callback=recv_handler)
+
+        # record frames sent, including ones not sent through the transaction layer
+        if(FRAME_CAPTURE):
+            self._zb = self._capture.Wrap_radio(self._zb)
+
+        # create frame id transaction layer for at/remote_at commands
+        self._zb_tx = XBeeTransactions(self._zb, self._zb_lock, window=XB_TX_WINDOW, timeout=DEFAULT_TIMEOUT, metrics=self._metrics)
+
+        # load/create db file, changes are journaled as they are made
+        self._db_journal = Journal(DEVICE_DB_FILENAME, fsync_delay=JOURNAL_FSYNC_DELAY, compact_records=JOURNAL_COMPACT_RECORDS)
 
-        # load/create db file
         # check if need to create new db file
-        if (not os.path.isfile(DEVICE_DB_FILENAME)):
+        if (not self._db_journal.Exists()):
             self.Log(DEVICE_DB_FILENAME + " file doesn't exist, creating a new one")
-            self._device_db = dict()
-        # if db file already exists
-        else:
-            with open(DEVICE_DB_FILENAME) as f:
-                self._device_db = json.load(f)
-            self.Log("opened existing device database file: " + DEVICE_DB_FILENAME)
+        self._device_db = self._db_journal.Load()
+        self.Log("opened device database file: " + DEVICE_DB_FILENAME)
+
+        # mac (hex string as stored in the db) -> device name
+        self._mac_index = dict()
+
+        # mac (bytes) -> device name
+        self._bytes_mac_index = dict()
+
+        for device_name in self._device_db:
+            self._Index_device(device_name)
 
     def _Setup_therm(self):
 
@@ -225,8 +512,7 @@ class Home():
         gpio.setup(THERM_FAN_CTRL, gpio.OUT, initial=gpio.LOW)
 
         # configure temperature sensor adc on local xbee
-        with self._zb_lock:
-            self._zb.at(command=TEMP_ADC, parameter=XB_CONF_ADC)
+        self._zb_tx.At(TEMP_ADC, XB_CONF_ADC)
         
         # create lock for thermostat io and settings access
         self._therm_lock = RLock()
@@ -234,20 +520,24 @@ class Home():
         # initialize current thermostat modes
         self._curr_temp_mode = "off"
         self._curr_fan_mode = "off"
+        self._state.Update_thermostat(curr_temp_mode=self._curr_temp_mode, curr_fan_mode=self._curr_fan_mode)
         
         # acquire thermostat lock
         with self._therm_lock:
 
+            # load settings, changes are journaled as they are made
+            self._therm_journal = Journal(THERM_SETTINGS_FILENAME, fsync_delay=JOURNAL_FSYNC_DELAY, compact_records=JOURNAL_COMPACT_RECORDS)
+
             # if need to make new thermostat settings file
-            if (not os.path.isfile(THERM_SETTINGS_FILENAME)):
+            if (not self._therm_journal.Exists()):
                 self.Log(THERM_SETTINGS_FILENAME + " file doesn't exist, creating a new one")
-                self._therm_settings = dict()
+                self._therm_settings = self._therm_journal.Load()
                 # initialize settings to defaults
                 self._Initialize_therm_settings()
             # if file already exists
             else:
-                with open(THERM_SETTINGS_FILENAME) as f:
-                    self._therm_settings = json.load(f)
+                self._therm_settings = self._therm_journal.Load()
+                self._state.Update_thermostat(**self._therm_settings)
                 self.Log("opened existing thermostat settings file: " + THERM_SETTINGS_FILENAME)
 
             # update thermostat
@@ -285,8 +575,13 @@ class Home():
 
         sample_volts = (sample_val / 1023)*1.2
 
+        temp_c = (sample_volts - 0.5) / .01
+
+        # remember latest reading
+        self._state.Update_thermostat(curr_temp=round(self.Convert_temp(temp_c, "C", "F"), 2))
+
         # convert to specified units
-        return self.Convert_temp(((sample_volts - 0.5) / .01), "C", units)
+        return self.Convert_temp(temp_c, "C", units)
 
     def Get_set_temp(self, units=DEFAULT_TEMP_UNITS):
 
@@ -303,6 +598,8 @@ class Home():
 
         with self._therm_lock:
             self._therm_settings["set_temp"] = temp_f
+            self._therm_journal.Set("set_temp", temp_f)
+            self._state.Update_thermostat(set_temp=temp_f)
 
         # update thermostat
         Thread(target=lambda: self.Thermostat_update()).start()
@@ -339,6 +636,8 @@ class Home():
 
         with self._therm_lock:
             self._therm_settings["lower_diff"] = lower_diff_f
+            self._therm_journal.Set("lower_diff", lower_diff_f)
+            self._state.Update_thermostat(lower_diff=lower_diff_f)
 
         return True
 
@@ -348,6 +647,8 @@ class Home():
 
         with self._therm_lock:
             self._therm_settings["upper_diff"] = upper_diff_f
+            self._therm_journal.Set("upper_diff", upper_diff_f)
+            self._state.Update_thermostat(upper_diff=upper_diff_f)
 
         return True
 
@@ -359,6 +660,8 @@ class Home():
 
         with self._therm_lock:
             self._therm_settings["temp_mode"] = temp_mode
+            self._therm_journal.Set("temp_mode", temp_mode)
+            self._state.Update_thermostat(temp_mode=temp_mode)
 
         # update thermostat
         Thread(target=lambda: self.Thermostat_update()).start()
@@ -373,6 +676,8 @@ class Home():
         
         with self._therm_lock:
             self._therm_settings["fan_mode"] = fan_mode
+            self._therm_journal.Set("fan_mode", fan_mode)
+            self._state.Update_thermostat(fan_mode=fan_mode)
 
         # update thermostat
         Thread(target=lambda: self.Thermostat_update()).start()
@@ -393,24 +698,12 @@ class Home():
         return {"temp_mode":self._curr_temp_mode, "fan_mode":self._curr_fan_mode}
 
     def Log_temp(self):
-        
-        # if file is not already created
-        if(not os.path.isfile(TEMP_LOG_FILENAME)):
-            with open(TEMP_LOG_FILENAME, 'a+') as f:
-                f.write("time,temperature,units,temp_mode,fan_mode\n")
 
-        # open power log file
-        with open(TEMP_LOG_FILENAME, 'a+') as f:
+        # get current temperature
+        curr_temp = self.Get_curr_temp(TEMP_LOG_UNITS)
 
-            # for each device in database
-            for device_name in self._device_db:
-                
-                # get current power usage
-                curr_temp = self.Get_curr_temp(TEMP_LOG_UNITS)
-                
-                # add line to csv
-                f.write(time.strftime(TEMP_TIMESTAMP) + "," + curr_temp + "," + TEMP_LOG_UNITS + "," +
-                        self.Get_temp_mode() + "," + self.Get_fan_mode() + "\n")
+        # add line to csv
+        self._temp_log.Write((time.time(), "%.2f" % curr_temp, TEMP_LOG_UNITS, self.Get_temp_mode(), self.Get_fan_mode()))
 
     def _Set_curr_fan_mode(self, fan_mode):
 
@@ -423,12 +716,14 @@ class Home():
             self.Log("turning fan on")
             gpio.output(THERM_FAN_CTRL, gpio.HIGH)
             self._curr_fan_mode = fan_mode
+            self._state.Update_thermostat(curr_fan_mode=fan_mode)
 
         elif(fan_mode == "off"):
             # turn fan off
             self.Log("turning fan off")
             gpio.output(THERM_FAN_CTRL, gpio.LOW)
             self._curr_fan_mode = fan_mode
+            self._state.Update_thermostat(curr_fan_mode=fan_mode)
 
         else:
             self.Log("invalid fan mode: " + str(fan_mode))
@@ -448,6 +743,7 @@ class Home():
             gpio.output(THERM_AC_CTRL, gpio.HIGH)
             # update current mode
             self._curr_temp_mode = temp_mode
+            self._state.Update_thermostat(curr_temp_mode=temp_mode)
             
         # change to heat
         elif(temp_mode == "heat"):
@@ -458,6 +754,7 @@ class Home():
             gpio.output(THERM_HEAT_CTRL, gpio.HIGH)
             # update current mode
             self._curr_temp_mode = temp_mode
+            self._state.Update_thermostat(curr_temp_mode=temp_mode)
 
         # change to off
         elif(temp_mode == "off"):
@@ -468,6 +765,7 @@ class Home():
             gpio.output(THERM_HEAT_CTRL, gpio.LOW)
             # update current mode
             self._curr_temp_mode = temp_mode
+            self._state.Update_thermostat(curr_temp_mode=temp_mode)
         # invalid mode
         else:
             self.Log("invalid temp mode: " + str(temp_mode))
@@ -566,97 +864,158 @@ class Home():
                     return
 
     def Get_power_usage(self, device_name):
-        
-        currsense_out_sample_ident = self.Pin2SampleIdent(CURRSENSE_OUT, adc=True)
-        
-        # sample device's current sense pin
-        samples = self._Sample_xbee(device_name, pins=[currsense_out_sample_ident])
-        
-        # if could not get sample
+
+        samples = self._Read_power_samples(device_name)
+
+        # if could not get samples
         if(not samples):
             return LEVEL_UNK
 
-        # get sampled value
-        sample_val = samples[currsense_out_sample_ident]
+        return self._Samples2power({device_name: samples})[device_name]
+
+    """
+    Function: _Read_power_samples
+    given a device name, takes POWER_SAMPLES readings of its current sense
+    and relay status pins
+    returns (list of raw current sense readings, relay on), False if the
+    device could not be sampled
+    """
+    def _Read_power_samples(self, device_name):
 
-        # convert to voltage
-        sample_voltage = (sample_val / 1023.0) * 1.2
+        currsense_out_sample_ident = self.Pin2SampleIdent(CURRSENSE_OUT, adc=True)
+        relay_stat_sample_ident = self.Pin2SampleIdent(RELAY_STAT)
 
-        off = False
-        checked_stat = False
+        # sample device's current sense and relay status pins
+        samples = self._Sample_xbee_many(device_name, pins=[currsense_out_sample_ident, relay_stat_sample_ident],
+                                         num_samples=POWER_SAMPLES)
+
+        if(not samples):
+            return False
+
+        # relay status of the latest reading
+        return [sample[currsense_out_sample_ident] for sample in samples], samples[-1][relay_stat_sample_ident] != 0
+
+    """
+    Function: _Samples2power
+    given dict of device name -> samples from _Read_power_samples, converts
+    all of them to power usage (W) at once, recalibrates the voltage divider
+    of devices that are off and records the power usage in the state table
+    returns dict of device name -> power usage
+    """
+    def _Samples2power(self, device_samples):
+
+        device_names = list(device_samples)
+        if(not device_names):
+            return dict()
+
+        # pad readings to a rectangle, missing readings are nan
+        num_readings = max(len(device_samples[n][0]) for n in device_names)
+        adc = [device_samples[n][0] + [float("nan")] * (num_readings - len(device_samples[n][0])) for n in device_names]
+        relay_on = [device_samples[n][1] for n in device_names]
 
-        # if relay is off, recalibrate and return 0 power usage
-        if(self.Get_device_level(device_name) == 0):
-            with self._db_lock:
-                #self._device_db[device_name]["noload_vout"] = (DIODE_DROP + sample_voltage)/0.4
-                #self.Log("noload_vout = " + str(self._device_db[device_name]["noload_vout"]))
-                self._device_db[device_name]["voltage_div"] = (DIODE_DROP + sample_voltage)/2.5
-            return 0.0
-        
         with self._db_lock:
-            if("voltage_div" not in self._device_db[device_name]):
-                #noload_vout = 2.5
-                voltage_div = 0.4
-            else:
-                #diode_drop = self._device_db[device_name]["diode_drop"]
-                #noload_vout = self._device_db[device_name]["noload_vout"]
-                voltage_div = self._device_db[device_name]["voltage_div"]
-
-        diode_drop = DIODE_DROP
-        noload_vout = 2.5
-
-        #self.Log("sample voltage = " + str(sample_voltage))
-        #self.Log("chip output voltage = " + str((sample_voltage + diode_drop) / voltage_div))
-        #self.Log("voltage divider = " + str(voltage_div))
-        #self.Log("diode drop = " + str(diode_drop))
-        #self.Log("noload_vout = " + str(noload_vout))
-        
-        # convert to ac current amplitude (A)
-        ac_current = abs(((sample_voltage + diode_drop) / voltage_div) - noload_vout)*10
+            # assume default divider and purely resistive load if not specified
+            voltage_div = [self._device_db.get(n, dict()).get("voltage_div", 0.4) for n in device_names]
+            power_factor = [self._device_db.get(n, dict()).get("power_factor", 1.0) for n in device_names]
 
-        #self.Log("current = " + str(ac_current))
-        
-        if(ac_current <= 0):
-            return 0.0
-        
-        # calculate apparent power (VA)
-        apparent_power = ac_current*AC_VOLTAGE / 2
+        watts, voltage_div = Batch_power(adc, relay_on, voltage_div, power_factor, DIODE_DROP, 2.5, AC_VOLTAGE)
 
-        # get power factor
+        results = dict()
         with self._db_lock:
-            if("power_factor" in self._device_db[device_name]):
-                power_factor = self._device_db[device_name]["power_factor"]
+            for i in range(len(device_names)):
+                device_name = device_names[i]
+                results[device_name] = float(watts[i])
 
-            # assume purely resistive load if not specified
-            else:
-                power_factor = 1.0
+                # relay is off, remember recalibrated divider
+                if(not relay_on[i] and device_name in self._device_db):
+                    self._device_db[device_name]["voltage_div"] = float(voltage_div[i])
+
+        # remember power usage
+        for device_name in device_names:
+            self._state.Update(device_name, power=results[device_name])
 
-        # return approximate real power (W)
-        return apparent_power * power_factor
+        return results
 
     def Log_power_usage(self):
 
         self.Log("logging power usage")
-            
-        # if file is not already created
-        if(not os.path.isfile(POWER_LOG_FILENAME)):
-            with open(POWER_LOG_FILENAME, 'a+') as f:
-                f.write("time,device_name,power_usage\n")
 
-        # open power log file
-        with open(POWER_LOG_FILENAME, 'a+') as f:
-            
-            # for each device in database
-            for device_name in self._device_db:
+        # get switches and dimmers in database
+        with self._db_lock:
+            device_names = [n for n in self._device_db if self._device_db[n]['type'] in [DIMMER_TYPE, SWITCH_TYPE]]
 
-                if(self._device_db[device_name]['type'] in [DIMMER_TYPE, SWITCH_TYPE]):
-                
-                    # get current power usage
-                    power_usage = self.Get_power_usage(device_name)
-                    self.Log(device_name + " power usage = " + str(power_usage) + " W")
-                    
-                    # add line to csv
-                    f.write(time.strftime(POWER_TIMESTAMP) + "," + device_name + "," + str(power_usage) + "\n")
+        # sample all devices at once
+        results = self._Sweep_power_usage(device_names)
+
+        # whole sweep is logged with the same time
+        now = time.time()
+        for device_name in device_names:
+            power_usage = results[device_name]
+            self.Log("%s power usage = %s W", device_name, power_usage)
+
+            # add line to csv
+            self._power_log.Write((now, device_name, power_usage))
+
+            # keep in memory history of known readings
+            if(power_usage != LEVEL_UNK):
+                self._power_history.Record(device_name, power_usage, now)
+
+    """
+    Function: _Sweep_power_usage
+    given a list of device names, reads the power usage of all of them with
+    at most POWER_SWEEP_CONCURRENCY at a time
+    returns dict of device name -> power usage, LEVEL_UNK for devices that
+    did not answer within POWER_SWEEP_DEADLINE or are still being read by
+    an earlier sweep
+    """
+    def _Sweep_power_usage(self, device_names, deadline=POWER_SWEEP_DEADLINE):
+
+        results = {device_name: LEVEL_UNK for device_name in device_names}
+
+        # don't queue a device again while an earlier sweep is still waiting on it
+        with self._sweep_lock:
+            device_names = [n for n in device_names if n not in self._sweep_in_flight]
+            self._sweep_in_flight.update(device_names)
+
+        futures = dict()
+        for device_name in device_names:
+            try:
+                futures[self._sweep_pool.submit(self._Sweep_device, device_name)] = device_name
+            except RuntimeError:
+                # pool shut down
+                self._Sweep_done(device_name)
+
+        done, not_done = wait(futures, timeout=deadline)
+
+        # convert every device that answered in one batch
+        device_samples = dict()
+        for future in done:
+            samples = future.result(timeout=XB_RESULT_TIMEOUT)
+            if(samples):
+                device_samples[futures[future]] = samples
+
+        try:
+            results.update(self._Samples2power(device_samples))
+        except Exception as e:
+            self.Log("power sweep conversion failed: %s", e)
+
+        if(not_done):
+            self.Log("power sweep deadline passed, %s devices unknown", len(not_done))
+
+        return results
+
+    def _Sweep_device(self, device_name):
+        try:
+            return self._Read_power_samples(device_name)
+        except Exception as e:
+            self.Log("power sweep failed for %s: %s", device_name, e)
+            return False
+        finally:
+            self._Sweep_done(device_name)
+
+    def _Sweep_done(self, device_name):
+        with self._sweep_lock:
+            self._sweep_in_flight.discard(device_name)
 
     """
     Function: Mac2bytes
@@ -691,13 +1050,142 @@ class Home():
 
             return self._device_db[device_name]["mac"]
     
-    def Get_device_level(self, device_name):
+    """
+    Function: Get_device_level
+    given a device name, returns its level (LEVEL_UNK if it can't be read)
+
+    if max_age (seconds) is given, a level read within that long ago is
+    returned from the device state table without using the radio
+    """
+    def Get_device_level(self, device_name, max_age=0):
+
+        # answer from cached state if recent enough
+        if(max_age > 0):
+            cached = self._state.Get(device_name, max_age)
+            if(cached is not None and "level" in cached):
+                return cached["level"]
+
+        level = self._Read_device_level(device_name)
+
+        # remember level
+        if(level not in [LEVEL_UNK, None]):
+            self._state.Update(device_name, level=level)
+
+        return level
+
+    """
+    Function: Get_state
+    returns every device's name, type, level, power and last update time
+    plus the thermostat settings and modes as one dict built from cached
+    state (nothing unknown is read from the radio), with the state version.
+    temperatures are given in units
+    """
+    def Get_state(self, units=DEFAULT_TEMP_UNITS):
+
+        # snapshot under the db lock so the device list and states match the version
+        with self._db_lock:
+            version, states, thermostat = self._state.Snapshot()
+            device_types = {device_name: self._device_db[device_name]["type"] for device_name in self._device_db}
+
+        devices = []
+        for device_name in device_types:
+            state = states.get(device_name, dict())
+            power = state.get("power")
+            devices.append({"name": device_name, "type": device_types[device_name], "level": state.get("level"),
+                            "power": power if (power is not None and power >= 0) else None, "time": state.get("time")})
+
+        thermostat = self.Thermostat_in_units(thermostat, units)
+        thermostat["units"] = units
+
+        return {"version": version, "time": time.time(), "devices": devices, "thermostat": thermostat}
+
+    """
+    Function: Thermostat_in_units
+    given thermostat state fields (temperatures kept in F), returns a copy
+    with the temperatures in units
+    """
+    @staticmethod
+    def Thermostat_in_units(fields, units):
+        fields = dict(fields)
+
+        for key in ["set_temp", "curr_temp"]:
+            if(key in fields):
+                fields[key] = round(Home.Convert_temp(fields[key], "F", units), 2)
+
+        # differences only scale
+        for key in ["lower_diff", "upper_diff"]:
+            if(key in fields and units != "F"):
+                fields[key] = round(fields[key] * 5.0 / 9.0, 2)
+
+        return fields
+
+    """
+    Function: Subscribe_state
+    returns a queue of state change events (see DeviceStateTable.Subscribe),
+    pass it to Unsubscribe_state when done
+    """
+    def Subscribe_state(self):
+        return self._state.Subscribe()
+
+    def Unsubscribe_state(self, queue):
+        self._state.Unsubscribe(queue)
+
+    """
+    Function: State_version
+    returns the state version, or given a read command (see
+    STATE_READ_PARTS) the version of the parts of the state it returns
+    """
+    def State_version(self, command=None):
+        return self._state.Version(STATE_READ_PARTS.get(command))
+
+    """
+    Function: Wait_state_version
+    given a state version (of what command reads, see State_version), waits
+    up to timeout seconds for it to be any other version, returns the
+    current version
+    """
+    def Wait_state_version(self, since_version, timeout, command=None):
+        return self._state.Wait_version(since_version, timeout, STATE_READ_PARTS.get(command))
+
+    """
+    Function: State_current
+    given read command params, returns whether the cached state still
+    holds what the read would return. devices that don't push their state
+    can change level without the version changing, so without push a level
+    read is only current while the level is within max_age
+    """
+    def State_current(self, params):
+        command = params.get("cmd", params.get("command"))
+        if(command != "get_device_level" or self._push_state):
+            return True
+
+        if("name" not in params):
+            return False
+
+        try:
+            max_age = self._Level_max_age(params)
+        except ValueError:
+            return False
+
+        cached = self._state.Get(params["name"], max_age)
+        return cached is not None and "level" in cached
+
+    def _Level_max_age(self, params):
+        # how old (seconds) a cached level can be, 0 to always ask the device
+        if("max_age" in params):
+            return float(params["max_age"])
+        elif(self._push_state):
+            return PUSH_STATE_MAX_AGE
+        else:
+            return STATE_MAX_AGE
+
+    def _Read_device_level(self, device_name):
         
         device_type = self.Get_device_type(device_name)
 
         # check if device in db
         if(device_type == UNK):
-            self.Log("cannot sample device \"" + device_name + "\", no device with that name in db")
+            self.Log("cannot sample device \"%s\", no device with that name in db", device_name)
             # return unknown
             return LEVEL_UNK
 
@@ -711,7 +1199,7 @@ class Home():
 
             if(not samples):
                 return LEVEL_UNK
-            return samples[relay_stat_sample_ident]
+            return self._Samples2level(device_type, samples)
             
         # dimmer device
         elif(device_type == DIMMER_TYPE):
@@ -723,33 +1211,92 @@ class Home():
 
             if(not samples):
                 return LEVEL_UNK
+            return self._Samples2level(device_type, samples)
             
-            relay_level = samples[relay_stat_sample_ident]
+        elif(device_type == CUSTOM_SWITCH):
+            with self._db_lock:
+                return self._device_db[device_name]['status']
+
+    """
+    Function: _Samples2level
+    given a device type and a sample dict from the device, returns the
+    device level, LEVEL_UNK if the needed pins aren't in the sample
+    """
+    def _Samples2level(self, device_type, samples):
+
+        relay_stat_sample_ident = self.Pin2SampleIdent(RELAY_STAT)
+        dpot_out_sample_ident = self.Pin2SampleIdent(DPOT_OUT, adc=True)
+
+        if(relay_stat_sample_ident not in samples):
+            return LEVEL_UNK
+
+        # relay status is a bool in raw samples, 0/100 after _Sample_xbee
+        relay_on = bool(samples[relay_stat_sample_ident])
+
+        # switch device
+        if(device_type == SWITCH_TYPE):
+            if(relay_on):
+                return 100
+            return 0
+
+        # dimmer device
+        elif(device_type == DIMMER_TYPE):
 
             # if relay is off
-            if(relay_level == 0):
+            if(not relay_on):
                 return 0
 
-            # if relay is on
-            else:
-                # get level
-                dpot_level = LEVEL_ONEV - samples[dpot_out_sample_ident]
-                
-                # calculate brightness
-                brightness = int(round(100*((dpot_level**2) / (LEVEL_ONEV**2))))
+            if(dpot_out_sample_ident not in samples):
+                return LEVEL_UNK
 
-                if(brightness >= 99):
-                    brightness = 100
-                elif(brightness <= 0):
-                    brightness = 1
-                
-                return brightness
+            # get level
+            dpot_level = LEVEL_ONEV - samples[dpot_out_sample_ident]
             
-        elif(device_type == CUSTOM_SWITCH):
-            with self._db_lock:
-                return self._device_db[device_name]['status']
+            # calculate brightness
+            brightness = int(round(100*((dpot_level**2) / (LEVEL_ONEV**2))))
+
+            if(brightness >= 99):
+                brightness = 100
+            elif(brightness <= 0):
+                brightness = 1
+            
+            return brightness
+
+        return LEVEL_UNK
+
+    """
+    Function: _Sample_xbee
+    samples the io pins of a remote device (or the local xbee if no device
+    name given), returns a dict of sample identifier -> value, or False if
+    the sample could not be taken before timeout
 
+    samples are routed to the caller by Recv_handler using the source mac,
+    so different devices can be sampled at the same time
+    """
     def _Sample_xbee(self, device_name=False, pins=False, timeout=DEFAULT_TIMEOUT):
+
+        samples = self._Sample_xbee_many(device_name, pins, num_samples=1, timeout=timeout)
+
+        if(not samples):
+            return False
+
+        return samples[0]
+
+    """
+    Function: _Sample_xbee_many
+    like _Sample_xbee but waits for num_samples consecutive samples, the
+    device samples every POWER_SAMPLE_IR ms meanwhile
+    returns list of sample dicts, False if they could not all be taken
+    before timeout (extended by the time the extra samples take)
+    """
+    def _Sample_xbee_many(self, device_name=False, pins=False, num_samples=1, timeout=DEFAULT_TIMEOUT):
+
+        # later samples come at the fast sample interval
+        if(num_samples > 1):
+            sample_ir = POWER_SAMPLE_IR
+            timeout += (num_samples - 1) * int.from_bytes(POWER_SAMPLE_IR, "big") / 1000.0
+        else:
+            sample_ir = b'\x0FF'
         
         # if remote device
         if(device_name != False):
@@ -758,114 +1305,161 @@ class Home():
             mac_addr = self.Get_device_mac(device_name)
             
             if(mac_addr == UNK):
-                self.Log("cannot sample device \"" + device_name + "\", no device with that name in db")
-                # return unknown
-                return LEVEL_UNK
+                self.Log("cannot sample device \"%s\", no device with that name in db", device_name)
+                return False
 
             bytes_mac = self.Mac2bytes(mac_addr)
+            waiter_key = bytes(bytes_mac)
+        else:
+            waiter_key = LOCAL_WAITER_KEY
 
-        # get process packets lock
-        with self._process_packets_lock:
-            # clear the queue
-            while(not self._packet_queue.empty()):
-                self._packet_queue.get(block=False)
-                
+        # queue this sampler's samples get delivered to
+        sample_queue = Queue()
+
+        # record start time
+        start_time = time.time()
+        first_sample_time = None
+        metric_device = device_name if device_name != False else "local"
+
+        # register as waiter
+        with self._waiters_lock:
+            self._sample_waiters.setdefault(waiter_key, []).append(sample_queue)
+
+        sample_list = []
+
+        # the waiter is unregistered in finally, even if sending fails
         try:
-            # record start time
-            start_time = time.time()
-            
+            # request the sample, not holding the waiters lock since sending may wait
+            # for room in the transaction window, which is freed by Recv_handler
             # if remote device
             if(device_name != False):
-                with self._zb_lock:
-                    # request sample (periodic sampling every 255 ms)
-                    self._zb.remote_at(dest_addr_long=bytes_mac, command='IR', parameter=b'\x0FF')
+                if(self._push_state):
+                    # device is already sampling periodically, force each sample
+                    for x in range(num_samples):
+                        self._zb_tx.Remote_at(bytes_mac, 'IS')
+                else:
+                    # request sample (periodic sampling, first sample is sent immediately)
+                    self._zb_tx.Remote_at(bytes_mac, 'IR', sample_ir)
             else:
-                with self._zb_lock:
-                    # request sample
-                    self._zb.at(command='IS')
-
-            with self._process_packets_lock:
-                # for each try
-                for x in range(MAX_RX_TRIES):
-                    #self.Log(str(x) + " try")
-                    try:
-                        # check if timed out
-                        if(time.time() - start_time >= timeout):
-                            if(device_name != False):
-                                self.Log("could not get sample from device \"" + device_name + "\", check the device")
-                                return False
+                # request sample
+                for x in range(num_samples):
+                    self._zb_tx.At('IS')
+
+            while(True):
+                # check if timed out
+                remaining = timeout - (time.time() - start_time)
+                if(remaining <= 0):
+                    break
+
+                try:
+                    # wait for a sample from this device
+                    samples = sample_queue.get(block=True, timeout=remaining)
+                except Empty:
+                    break
+
+                # if no specific pin given, return all
+                if(not pins):
+                    sample_list.append(samples)
+
+                # if specific pins given, make sure all are present
+                elif(all(pin in samples for pin in pins)):
+                    sample_dict = dict()
+
+                    for pin in pins:
+                        if(type(samples[pin]) is bool):
+                            if(samples[pin]):
+                                sample_dict[pin] = 100
                             else:
-                                self.Log("could not get sample from local xbee, check the device")
-                                return False
-                                
-                        # wait for a packet
-                        packet = self._packet_queue.get(block=True, timeout=timeout)
-                        
-                        #self.Log("packet = " + str(packet))
-                        
-                    except Empty:
-                        if(device_name != False):
-                            self.Log("could not get sample from device \"" + device_name + "\", check the device")
-                            return False
+                                sample_dict[pin] = 0
                         else:
-                            self.Log("could not get sample from local xbee, check the device")
-                            return False
-                        
-                    # check if packet is from desired device
-                    if("source_addr_long" not in packet):
-                        if(not device_name):
-                            if("parameter" in packet):
-                                if(type(packet["parameter"]) is list):
-                                    return packet["parameter"][0]
-                        continue
-
-                    if (device_name != False):
-                        if((bytearray(packet['source_addr_long'])) != bytes_mac):
-                            self.Log("mac doesn't match")
-                            continue
-                        
-                    # check if sample packet
-                    if("samples" in packet):    
-                        samples = packet["samples"][0]
-                            
-                        # if no specific pin given, return all
-                        if(not pins):
-                            return samples
-                            
-                        sample_dict = dict()
-
-                        cont = False
-                        
-                        # if specific pins given, make sure all are present
-                        for pin in pins:
-                            if(pin not in samples):
-                                cont = True
-                                break
-                            elif(type(samples[pin]) is bool):
-                                if(samples[pin]):
-                                    sample_dict[pin] = 100
-                                else:
-                                    sample_dict[pin] = 0
-                            else:
-                                sample_dict[pin] = samples[pin]
+                            sample_dict[pin] = samples[pin]
 
-                        if(cont):
-                            continue
+                    sample_list.append(sample_dict)
 
-                        return sample_dict
-                    
-                # if couldn't get desired samples
-                if(device_name != False):
-                    self.Log("couldn't sample device \"" + device_name + "\", please check device status")
-                    return False
-                else:
-                    self.Log("could not get sample from local xbee, check the device")
-                    return False
-            
-        finally:                    
+                # round trip is the time to the first sample
+                if(len(sample_list) == 1 and first_sample_time is None):
+                    first_sample_time = time.time()
+                    self._metrics.Observe("sample_seconds", first_sample_time - start_time, device=metric_device)
+
+                if(len(sample_list) >= num_samples):
+                    return sample_list
+
+            self._metrics.Inc("sample_timeouts_total", device=metric_device)
+
+            # if couldn't get desired samples
             if(device_name != False):
-                with self._zb_lock:
-                    self._zb.remote_at(dest_addr_long=bytes_mac, command='IR', parameter=b'\x00');
+                self.Log("could not get sample from device \"%s\", check the device", device_name)
+            else:
+                self.Log("could not get sample from local xbee, check the device")
+            return False
+
+        finally:
+            with self._waiters_lock:
+                waiters = self._sample_waiters[waiter_key]
+                waiters.remove(sample_queue)
+
+                last_waiter = (len(waiters) == 0)
+                if(last_waiter):
+                    del(self._sample_waiters[waiter_key])
+
+            # if last sampler of this device, turn periodic sampling back off
+            if(last_waiter and device_name != False and not self._push_state):
+                self._zb_tx.Remote_at(bytes_mac, 'IR', b'\x00')
+
+    """
+    Function: _Dispatch_sample
+    given the mac (or LOCAL_WAITER_KEY) a sample came from and the sample
+    dict, hands the sample to every sampler waiting on that device
+    """
+    def _Dispatch_sample(self, waiter_key, samples):
+        with self._waiters_lock:
+            for sample_queue in self._sample_waiters.get(waiter_key, []):
+                sample_queue.put(samples, block=False)
+
+    """
+    Function: _Update_pushed_state
+    given the mac a sample came from and the sample dict, updates the
+    device's level in the state table
+    """
+    def _Update_pushed_state(self, mac, samples):
+        device_name = self.Mac2name(mac)
+        if(not device_name):
+            return
+
+        device_type = self.Get_device_type(device_name)
+        if(device_type not in NORMAL_TYPES):
+            return
+
+        level = self._Samples2level(device_type, samples)
+        if(level != LEVEL_UNK):
+            self._state.Update(device_name, level=level)
+
+    """
+    Function: _Configure_push
+    given device mac bytes and type, returns frames enabling change detection
+    on the relay status pin and slow periodic sampling on the device
+    """
+    def _Configure_push(self, bytes_mac, device_type):
+        if(device_type not in NORMAL_TYPES):
+            return []
+
+        # change detection mask, bit n watches pin Dn
+        change_mask = 1 << int(RELAY_STAT[1:])
+
+        return [self._zb_tx.Remote_at(bytes_mac, 'IC', change_mask.to_bytes(2, "big")),
+                self._zb_tx.Remote_at(bytes_mac, 'IR', int(PUSH_SAMPLE_INTERVAL*1000).to_bytes(2, "big"))]
+
+    """
+    Function: _Configure_push_all
+    turns on push state tracking on every switch/dimmer already in the db
+    """
+    def _Configure_push_all(self):
+        with self._db_lock:
+            devices = [(self.Mac2bytes(d['mac']), d['type'], d['name']) for d in self._device_db.values()]
+
+        for bytes_mac, device_type, device_name in devices:
+            if(not self._Wait_frames(self._Configure_push(bytes_mac, device_type))):
+                self.Log("could not turn on state tracking for device \"%s\"", device_name)
 
     """
     Function: Set_device_level
@@ -882,7 +1476,7 @@ class Home():
     def Set_device_level(self, device_name, level):
         
         if(not self.Name_in_db(device_name)):
-            self.Log("could not set level of device \"" + device_name + "\", name not in db")
+            self.Log("could not set level of device \"%s\", name not in db", device_name)
             return False
 
         # get db lock
@@ -890,6 +1484,11 @@ class Home():
             # get device type
             device_type = self._device_db[device_name]['type']
 
+        # dimmer already ramping, latest request wins, no need to sample it
+        if(device_type == DIMMER_TYPE and self._Retarget_ramp(device_name, level)):
+            self._state.Invalidate(device_name, "level")
+            return True
+
         if(device_type in CUSTOM_TYPES):
             if(device_type == CUSTOM_SWITCH):
                 # get db lock
@@ -901,35 +1500,40 @@ class Home():
             # get current device level
             curr_level = self.Get_device_level(device_name)
         else:
-            self.Log("could not set device level to " + str(level) + ", not a valid device type")
+            self.Log("could not set device level to %s, not a valid device type", level)
             return False
         
         # check if got a sample
         if(curr_level == LEVEL_UNK):
-            self.Log("could not set device \"" + device_name +"\" level to " + str(level) + ", could not communicate with module")
+            self.Log("could not set device \"%s\" level to %s, could not communicate with module", device_name, level)
             return False
 
         # check if need to change the level
         if(curr_level == level):
-            self.Log("did not need to set device \"" + device_name +"\" level to " + str(level) + ", was already set")
+            self.Log("did not need to set device \"%s\" level to %s, was already set", device_name, level)
             return True
         
         # if switch
         if(device_type == SWITCH_TYPE):
             # toggle relay
-            self._Toggle_relay(device_name)
+            if(not self._Toggle_relay(device_name)):
+                # relay state is no longer known
+                self._state.Invalidate(device_name, "level")
+                return False
+
+            # relay acknowledged the toggle, write new level through to state table
+            self._state.Update(device_name, level=level)
             return True
         elif(device_type == DIMMER_TYPE):
-            self.Log("here")
-            # set light level using a thread
-            Thread(target=lambda: self._Set_light(device_name, curr_level, level)).start()
+            # level is unknown until ramp is done, next read goes to the device
+            self._state.Invalidate(device_name, "level")
+            # hand the level to the device's ramp, starting one if needed
+            self._Ramp_light(device_name, curr_level, level)
             return True
         elif(device_type == CUSTOM_SWITCH):
-            self._Set_custom_switch(device_name, level, curr_level)
-            return True
+            return self._Set_custom_switch(device_name, level, curr_level)
         elif(device_type == CUSTOM_PULSE):
-            self._Toggle_custom_pulse(device_name)
-            return True
+            return self._Toggle_custom_pulse(device_name)
 
     def _Set_custom_switch(self, device_name, level, curr_level = False):
 
@@ -942,19 +1546,25 @@ class Home():
             device_mac = self.Mac2bytes(self._device_db[device_name]['mac'])
 
         if(level == 0):
-            with self._zb_lock:
-                # make pin low
-                self._zb.remote_at(dest_addr_long=device_mac, command=pin, parameter=XB_CONF_LOW)
-
+            # make pin low
+            if(not self._Wait_frames([self._zb_tx.Remote_at(device_mac, pin, XB_CONF_LOW)])):
+                self.Log("device \"%s\" did not acknowledge pin change", device_name)
+                return False
+
             with self._db_lock:
                 self._device_db[device_name]['status'] = 0
+                self._db_journal.Set(device_name, self._device_db[device_name])
         else:
-            with self._zb_lock:
-                # set pin high
-                self._zb.remote_at(dest_addr_long=device_mac, command=pin, parameter=XB_CONF_HIGH)
+            # set pin high
+            if(not self._Wait_frames([self._zb_tx.Remote_at(device_mac, pin, XB_CONF_HIGH)])):
+                self.Log("device \"%s\" did not acknowledge pin change", device_name)
+                return False
 
             with self._db_lock:
                 self._device_db[device_name]['status'] = 100
+                self._db_journal.Set(device_name, self._device_db[device_name])
+
+        return True
 
     def _Toggle_custom_pulse(self, device_name):
 
@@ -967,14 +1577,18 @@ class Home():
 
         #self.Log("custom pin = " + str(pin))
             
-        with self._zb_lock:
-            # set pin high
-            self._zb.remote_at(dest_addr_long=device_mac, command=pin, parameter=XB_CONF_HIGH)
-            self.Log("set high")
-            time.sleep(CUSTOM_PULSE_TIME)
-            # make pin low
-            self._zb.remote_at(dest_addr_long=device_mac, command=pin, parameter=XB_CONF_LOW)
-            self.Log("set low")
+        # set pin high
+        if(not self._Wait_frames([self._zb_tx.Remote_at(device_mac, pin, XB_CONF_HIGH)])):
+            self.Log("device \"%s\" did not acknowledge pulse", device_name)
+            return False
+        self.Log("set high")
+        time.sleep(CUSTOM_PULSE_TIME)
+        # make pin low
+        if(not self._Wait_frames([self._zb_tx.Remote_at(device_mac, pin, XB_CONF_LOW)])):
+            self.Log("device \"%s\" did not acknowledge end of pulse", device_name)
+            return False
+        self.Log("set low")
+        return True
 
     def _Toggle_relay(self, device_name):
 
@@ -983,12 +1597,86 @@ class Home():
             # get device mac
             device_mac = self.Mac2bytes(self._device_db[device_name]['mac'])
 
-        # get zigbee lock
-        with self._zb_lock:
-            # set relay toggle pin high
-            self._zb.remote_at(dest_addr_long=device_mac, command=RELAY_TOGGLE, parameter=XB_CONF_HIGH)
-            # make relay toggle pin low
-            self._zb.remote_at(dest_addr_long=device_mac, command=RELAY_TOGGLE, parameter=XB_CONF_LOW)
+        # set relay toggle pin high then low, both in flight at once
+        frames = [self._zb_tx.Remote_at(device_mac, RELAY_TOGGLE, XB_CONF_HIGH),
+                  self._zb_tx.Remote_at(device_mac, RELAY_TOGGLE, XB_CONF_LOW)]
+
+        if(not self._Wait_frames(frames)):
+            self.Log("device \"%s\" did not acknowledge relay toggle", device_name)
+            return False
+        return True
+
+    """
+    Function: _Ramp_light
+    given a dimmer name, its current level and a target level, sets the
+    target of the dimmer's ramp, starting a ramp thread if none is running
+    a ramp that is already running moves to the newest target, earlier
+    targets that were never reached are dropped
+    """
+    def _Ramp_light(self, device_name, curr_level, level):
+
+        with self._ramps_lock:
+            # a ramp may have started since the caller checked, it is retargeted
+            running = device_name in self._ramps
+            self._ramps[device_name] = level
+
+        if(running):
+            self.Log("retargeted ramp of \"%s\" to %s", device_name, level)
+            return
+
+        Thread(target=lambda: self._Run_ramp(device_name, curr_level), name="ramp-" + device_name).start()
+
+    def _Run_ramp(self, device_name, curr_level):
+
+        level = None
+
+        while(True):
+            with self._ramps_lock:
+                # done if target reached, or device gone
+                if(self._ramps[device_name] == level or not self.Name_in_db(device_name)):
+                    del(self._ramps[device_name])
+                    break
+
+                level = self._ramps[device_name]
+
+            # level changed under the previous target, ask the device
+            if(curr_level is None):
+                curr_level = self.Get_device_level(device_name)
+
+            try:
+                if(curr_level != level and curr_level != LEVEL_UNK):
+                    self._Set_light(device_name, curr_level, level)
+            except Exception as e:
+                self.Log("ramp of \"%s\" failed: %s", device_name, e)
+
+            curr_level = None
+
+        # read where the ramp ended up so the state table (and its subscribers) get the new level
+        if(level is not None and self.Name_in_db(device_name)):
+            self.Get_device_level(device_name)
+
+    """
+    Function: _Retarget_ramp
+    gives the ramp of a dimmer a new target level, returns False (and
+    does nothing) if the dimmer isn't ramping
+    """
+    def _Retarget_ramp(self, device_name, level):
+        with self._ramps_lock:
+            if(device_name not in self._ramps):
+                return False
+            self._ramps[device_name] = level
+
+        self.Log("retargeted ramp of \"%s\" to %s", device_name, level)
+        return True
+
+    """
+    Function: _Ramp_retargeted
+    returns True if the ramp of a dimmer has been given a target other
+    than level, so the step in progress can stop early
+    """
+    def _Ramp_retargeted(self, device_name, level):
+        with self._ramps_lock:
+            return self._ramps.get(device_name, level) != level
 
     def _Set_light(self, device_name, curr_level, level):
 
@@ -996,47 +1684,65 @@ class Home():
         with self._db_lock:
             # get device mac
             bytes_mac = self.Mac2bytes(self._device_db[device_name]['mac'])
-            
+            # get brightness of each wiper position, if calibrated
+            calibration = self._device_db[device_name].get('calibration')
+
+        if(level == 0):
+            # turn off the relay, dpot is left where it is
+            if(curr_level != 0):
+                self._Toggle_relay(device_name)
+            return
+
         if(curr_level == 0):
             # turn on the relay
             self._Toggle_relay(device_name)
                 
-        curr_level = self.Get_device_level(device_name)
+            curr_level = self.Get_device_level(device_name)
 
         if(curr_level == LEVEL_UNK):
             self.Log("couldn't set light level, couldn't communicate with device")
             return
 
-        if(level == 0):
-            if(curr_level != 0):
-                self._Toggle_relay(device_name)
-                
         try:
-            # get zigbee lock
-            with self._zb_lock:
-                # set D flip flop CLR# to low (cleared)
-                self._zb.remote_at(dest_addr_long=bytes_mac, command=DFLIPCLR_N, parameter=XB_CONF_LOW)
+            # set D flip flop CLR# to low (cleared)
+            if(not self._Wait_frames([self._zb_tx.Remote_at(bytes_mac, DFLIPCLR_N, XB_CONF_LOW)])):
+                self.Log("couldn't set light level, couldn't communicate with device")
+                return
+
+            # move straight to the calibrated position and check once
+            if(calibration):
+                curr_level = self._Set_light_calibrated(device_name, bytes_mac, calibration, curr_level, level)
+
+                if(curr_level == LEVEL_UNK):
+                    self.Log("couldn't set light level, couldn't communicate with device")
+                    return
+
+                if(abs(curr_level - calibration[self._Nearest_position(calibration, level)]) <= LIGHT_CAL_TOLERANCE):
+                    return
+
+                self.Log("device \"%s\" did not match its calibration, stepping to level, recalibrate device", device_name)
 
             # if light is too bright
             if(curr_level > level):
                 # set U/D# to high (up)
-                # get zigbee lock
-                with self._zb_lock:
-                    self._zb.remote_at(dest_addr_long=bytes_mac, command=DPOT_UD_N, parameter=XB_CONF_HIGH)
-                    
+                if(not self._Pulse_dpot(bytes_mac, 0, up=True)):
+                    self.Log("couldn't set light level, couldn't communicate with device")
+                    return
+
                 num_tries = 0
                 
                 # while the light is too bright
                 while(level < curr_level):
+
+                    # stop if the ramp now has another target
+                    if(self._Ramp_retargeted(device_name, level)):
+                        return
                     
-                    self.Log("inc")
+                    self.Log("inc dpot of \"%s\"", device_name, level=logging.DEBUG)
+
+                    # increment the dpot
+                    self._Pulse_dpot(bytes_mac)
 
-                    # get zigbee lock
-                    with self._zb_lock:
-                        # increment the dpot
-                        self._zb.remote_at(dest_addr_long=bytes_mac, command=DPOT_INC_N, parameter=XB_CONF_HIGH)
-                        self._zb.remote_at(dest_addr_long=bytes_mac, command=DPOT_INC_N, parameter=XB_CONF_LOW)
-                        
                     num_tries += 1
                         
                     if(num_tries >= LIGHT_SET_TRIES):
@@ -1051,23 +1757,24 @@ class Home():
                         
             # light is too dim
             else:
-                # get zigbee lock
-                with self._zb_lock:
-                    # set U/D# to low (down)
-                    self._zb.remote_at(dest_addr_long=bytes_mac, command=DPOT_UD_N, parameter=XB_CONF_LOW)
-                    
+                # set U/D# to low (down)
+                if(not self._Pulse_dpot(bytes_mac, 0, up=False)):
+                    self.Log("couldn't set light level, couldn't communicate with device")
+                    return
+
                 num_tries = 0
                 
                 # while the light is too dim
                 while(curr_level < level):
 
-                    self.Log("dec")
+                    # stop if the ramp now has another target
+                    if(self._Ramp_retargeted(device_name, level)):
+                        return
+
+                    self.Log("dec dpot of \"%s\"", device_name, level=logging.DEBUG)
 
-                    # get zigbee lock
-                    with self._zb_lock:
-                        # decrement the dpot
-                        self._zb.remote_at(dest_addr_long=bytes_mac, command=DPOT_INC_N, parameter=XB_CONF_HIGH)
-                        self._zb.remote_at(dest_addr_long=bytes_mac, command=DPOT_INC_N, parameter=XB_CONF_LOW)
+                    # decrement the dpot
+                    self._Pulse_dpot(bytes_mac)
 
                     num_tries += 1
                         
@@ -1082,12 +1789,179 @@ class Home():
                         return    
 
         finally:
-            # get zigbee lock
-            with self._zb_lock:
-                # set D flip flop CLR# to input (not cleared)
-                self._zb.remote_at(dest_addr_long=bytes_mac, command=DFLIPCLR_N, parameter=XB_CONF_DINPUT)
-                # set U/D# back to low
-                self._zb.remote_at(dest_addr_long=bytes_mac, command=DPOT_UD_N, parameter=XB_CONF_LOW)
+            # set D flip flop CLR# to input (not cleared) and U/D# back to low
+            self._Wait_frames([self._zb_tx.Remote_at(bytes_mac, DFLIPCLR_N, XB_CONF_DINPUT),
+                               self._zb_tx.Remote_at(bytes_mac, DPOT_UD_N, XB_CONF_LOW)])
+
+    """
+    Function: _Set_light_calibrated
+    given a dimmer's calibration, its current level and the desired level,
+    works out the wiper positions, moves the dpot in one burst of pulses
+    and samples once, returns the level measured after the move
+    must be called with the D flip flop cleared
+    """
+    def _Set_light_calibrated(self, device_name, bytes_mac, calibration, curr_level, level):
+
+        curr_pos = self._Locate_dpot(bytes_mac, calibration, curr_level)
+        if(curr_pos is None):
+            return LEVEL_UNK
+
+        target_pos = self._Nearest_position(calibration, level)
+
+        # up (towards the last position) is dimmer
+        num_steps = target_pos - curr_pos
+        if(num_steps != 0):
+            self.Log("moving dpot %s steps", num_steps)
+            if(not self._Pulse_dpot(bytes_mac, abs(num_steps), up=(num_steps > 0))):
+                return LEVEL_UNK
+
+        return self.Get_device_level(device_name)
+
+    """
+    Function: _Locate_dpot
+    given a dimmer's calibration and current level, returns the wiper
+    position, or None if the device could not be reached
+    if the level matches several positions (the flat ends of the curve) the
+    wiper is first driven against the end stop of those positions
+    """
+    def _Locate_dpot(self, bytes_mac, calibration, curr_level):
+
+        diffs = [abs(brightness - curr_level) for brightness in calibration]
+        positions = [pos for pos in range(len(diffs)) if diffs[pos] == min(diffs)]
+
+        if(len(positions) == 1):
+            return positions[0]
+
+        last_pos = len(calibration) - 1
+
+        # wiper stops at either end, so extra pulses past the end are harmless
+        if(positions[0] + positions[-1] <= last_pos):
+            end_pos = 0
+            num_steps = positions[-1]
+        else:
+            end_pos = last_pos
+            num_steps = last_pos - positions[0]
+
+        if(not self._Pulse_dpot(bytes_mac, num_steps, up=(end_pos == last_pos))):
+            return None
+
+        return end_pos
+
+    @staticmethod
+    def _Nearest_position(calibration, level):
+        return min(range(len(calibration)), key=lambda pos: abs(calibration[pos] - level))
+
+    """
+    Function: Calibrate_dimmer
+    given a dimmer name, measures the brightness at every dpot wiper
+    position and stores it with the device, then puts the light back
+    returns True if successful
+    """
+    def Calibrate_dimmer(self, device_name):
+
+        if(not self.Name_in_db(device_name)):
+            self.Log("could not calibrate device \"" + device_name + "\", name not in db")
+            return False
+
+        with self._db_lock:
+            if(self._device_db[device_name]['type'] != DIMMER_TYPE):
+                self.Log("could not calibrate device \"" + device_name + "\", not a dimmer")
+                return False
+            bytes_mac = self.Mac2bytes(self._device_db[device_name]['mac'])
+
+        orig_level = self.Get_device_level(device_name)
+        if(orig_level == LEVEL_UNK):
+            self.Log("could not calibrate device \"" + device_name + "\", could not communicate with module")
+            return False
+
+        self.Log("calibrating dimmer \"" + device_name + "\"")
+
+        # level reads bypass the state table while the wiper moves
+        self._state.Invalidate(device_name, "level")
+
+        # relay must be on to measure brightness
+        if(orig_level == 0 and not self._Toggle_relay(device_name)):
+            self.Log("could not calibrate device \"" + device_name + "\", relay did not turn on")
+            return False
+
+        calibration = []
+        try:
+            # set D flip flop CLR# to low (cleared) and drive the wiper to position 0 (brightest)
+            if(not (self._Wait_frames([self._zb_tx.Remote_at(bytes_mac, DFLIPCLR_N, XB_CONF_LOW)]) and
+                    self._Pulse_dpot(bytes_mac, DPOT_NUM_POS, up=False) and
+                    self._Pulse_dpot(bytes_mac, 0, up=True))):
+                self.Log("could not calibrate device \"" + device_name + "\", could not communicate with module")
+                return False
+
+            # measure each position, stepping up (dimmer) between them
+            for pos in range(DPOT_NUM_POS):
+                if(pos > 0 and not self._Pulse_dpot(bytes_mac)):
+                    break
+
+                level = self.Get_device_level(device_name)
+                if(level == LEVEL_UNK):
+                    break
+
+                calibration.append(level)
+
+            if(len(calibration) != DPOT_NUM_POS):
+                self.Log("could not calibrate device \"" + device_name + "\", lost communication with module")
+                return False
+
+            with self._db_lock:
+                if(device_name in self._device_db):
+                    self._device_db[device_name]['calibration'] = calibration
+                    self._db_journal.Set(device_name, self._device_db[device_name])
+
+            self.Log("calibrated dimmer \"" + device_name + "\": " + str(calibration))
+
+            # wiper is at the last position, put the light back where it was
+            if(orig_level != 0):
+                num_steps = (DPOT_NUM_POS - 1) - self._Nearest_position(calibration, orig_level)
+                self._Pulse_dpot(bytes_mac, num_steps, up=False)
+
+        finally:
+            # set D flip flop CLR# to input (not cleared) and U/D# back to low
+            self._Wait_frames([self._zb_tx.Remote_at(bytes_mac, DFLIPCLR_N, XB_CONF_DINPUT),
+                               self._zb_tx.Remote_at(bytes_mac, DPOT_UD_N, XB_CONF_LOW)])
+
+            self._state.Invalidate(device_name, "level")
+
+        if(orig_level == 0):
+            self._Toggle_relay(device_name)
+
+        return True
+
+    """
+    Function: _Pulse_dpot
+    pulses the DPOT INC# pin of a device num_steps times, setting U/D#
+    first if up is given, all frames are kept in flight together
+    returns True if every frame was acknowledged
+    """
+    def _Pulse_dpot(self, bytes_mac, num_steps=1, up=None):
+        frames = []
+        if(up is not None):
+            frames.append(self._zb_tx.Remote_at(bytes_mac, DPOT_UD_N, XB_CONF_HIGH if up else XB_CONF_LOW))
+        for x in range(num_steps):
+            frames.append(self._zb_tx.Remote_at(bytes_mac, DPOT_INC_N, XB_CONF_HIGH))
+            frames.append(self._zb_tx.Remote_at(bytes_mac, DPOT_INC_N, XB_CONF_LOW))
+        return self._Wait_frames(frames)
+
+    """
+    Function: _Wait_frames
+    given a list of futures from the transaction layer, waits for all of
+    them and returns True if every command was applied successfully
+    """
+    def _Wait_frames(self, frames):
+        ok = True
+        deadline = time.monotonic() + XB_RESULT_TIMEOUT
+        for frame in frames:
+            try:
+                if(not XBeeTransactions.Ok(frame.result(timeout=max(deadline - time.monotonic(), 0)))):
+                    ok = False
+            except TimeoutError:
+                ok = False
+        return ok
 
     """
     Function: Name_in_db
@@ -1097,12 +1971,7 @@ class Home():
     def Name_in_db(self, device_name):
         # get db lock
         with self._db_lock:
-        
-            for device in self._device_db:
-                if(device == device_name):
-                    return True
-                
-            return False
+            return device_name in self._device_db
 
     """
     Function: Mac_in_db
@@ -1110,27 +1979,7 @@ class Home():
     returns true if device with that mac address is in db, false otherwise
     """
     def Mac_in_db(self, device_mac):
-        # get db lock
-        with self._db_lock:
-        
-            if(type(device_mac) is bytearray):
-                byte_format = True
-            else:
-                byte_format = False
-            
-            if(byte_format):
-                for device in self._device_db:
-                    if(self.Mac2bytes(self._device_db[device]['mac']) == device_mac):
-                        return True
-                    
-                return False
-
-            else:
-                for device in self._device_db:
-                    if(self._device_db[device]['mac'] == device_mac):
-                        return True
-                    
-                return False
+        return bool(self.Mac2name(device_mac))
 
     """
     Function: Mac2name
@@ -1141,17 +1990,30 @@ class Home():
         # get db lock
         with self._db_lock:
 
-            if(type(mac) is bytearray):
-                for device_name in self._device_db:
-                    if(self.Mac2bytes(self._device_db[device_name]['mac']) == mac):
-                        return device_name
+            if(type(mac) in [bytearray, bytes]):
+                return self._bytes_mac_index.get(bytes(mac), False)
 
-            else:
-                for device_name in self._device_db:
-                    if(self._device_db[device_name]['mac'] == mac):
-                        return device_name
+            return self._mac_index.get(mac, False)
 
-            return False
+    """
+    Function: _Index_device
+    adds a device already in the db to the mac indexes
+    must hold the db lock
+    """
+    def _Index_device(self, device_name):
+        mac = self._device_db[device_name]['mac']
+        self._mac_index[mac] = device_name
+        self._bytes_mac_index[bytes(self.Mac2bytes(mac))] = device_name
+
+    """
+    Function: _Unindex_device
+    removes a device still in the db from the mac indexes
+    must hold the db lock
+    """
+    def _Unindex_device(self, device_name):
+        mac = self._device_db[device_name]['mac']
+        self._mac_index.pop(mac, None)
+        self._bytes_mac_index.pop(bytes(self.Mac2bytes(mac)), None)
 
     @staticmethod
     def Pin2SampleIdent(pin, adc=False):
@@ -1184,33 +2046,32 @@ class Home():
 
             custom = False
 
+            # configuration commands sent to the device, all kept in flight together
+            frames = []
+
             if(device_type in [SWITCH_TYPE, DIMMER_TYPE]):
 
-                # acquire zigbee lock
-                with self._zb_lock:
-                    # set RELAY_STATUS (D1) to input
-                    self._zb.remote_at(dest_addr_long=bytes_mac, command=RELAY_STAT, parameter=XB_CONF_DINPUT)
+                # set RELAY_STATUS (D1) to input
+                frames.append(self._zb_tx.Remote_at(bytes_mac, RELAY_STAT, XB_CONF_DINPUT))
 
-                    # set CURRSENSE_OUT (D3) to analog input
-                    self._zb.remote_at(dest_addr_long=bytes_mac, command=CURRSENSE_OUT, parameter=XB_CONF_ADC)
-                    
-                    # set RELAY_TOGGLE (D0) to output low
-                    self._zb.remote_at(dest_addr_long=bytes_mac, command=RELAY_TOGGLE, parameter=XB_CONF_LOW)
+                # set CURRSENSE_OUT (D3) to analog input
+                frames.append(self._zb_tx.Remote_at(bytes_mac, CURRSENSE_OUT, XB_CONF_ADC))
+
+                # set RELAY_TOGGLE (D0) to output low
+                frames.append(self._zb_tx.Remote_at(bytes_mac, RELAY_TOGGLE, XB_CONF_LOW))
 
             if(device_type == DIMMER_TYPE):
-                # acquire zigbee lock
-                with self._zb_lock:
-                    # set DPOT_OUT (D2) to analog input
-                    self._zb.remote_at(dest_addr_long=bytes_mac, command=DPOT_OUT, parameter=XB_CONF_ADC)
-                    
-                    # set D flip flop CLR# to high
-                    self._zb.remote_at(dest_addr_long=bytes_mac, command=DFLIPCLR_N, parameter=XB_CONF_HIGH)
-                    
-                    # DPOT INC# to low
-                    self._zb.remote_at(dest_addr_long=bytes_mac, command=DPOT_INC_N, parameter=XB_CONF_LOW)
-                
-                    # set U/D# to low
-                    self._zb.remote_at(dest_addr_long=bytes_mac, command=DPOT_UD_N, parameter=XB_CONF_LOW)
+                # set DPOT_OUT (D2) to analog input
+                frames.append(self._zb_tx.Remote_at(bytes_mac, DPOT_OUT, XB_CONF_ADC))
+
+                # set D flip flop CLR# to high
+                frames.append(self._zb_tx.Remote_at(bytes_mac, DFLIPCLR_N, XB_CONF_HIGH))
+
+                # DPOT INC# to low
+                frames.append(self._zb_tx.Remote_at(bytes_mac, DPOT_INC_N, XB_CONF_LOW))
+
+                # set U/D# to low
+                frames.append(self._zb_tx.Remote_at(bytes_mac, DPOT_UD_N, XB_CONF_LOW))
 
             elif(device_type.split("-")[0] == "cust"):
                 
@@ -1237,20 +2098,13 @@ class Home():
 
                 # custom switch or pulse
                 if(device_type in [CUSTOM_SWITCH, CUSTOM_PULSE]):
-                    
-                    # acquire zigbee lock
-                    with self._zb_lock:
-                        # set pin to output low initially
-                        self._zb.remote_at(dest_addr_long=bytes_mac, command=dio, parameter=XB_CONF_LOW)
-
-                        self.Log("here1")
+                    # set pin to output low initially
+                    frames.append(self._zb_tx.Remote_at(bytes_mac, dio, XB_CONF_LOW))
 
                 # custom input
                 elif(device_type == CUSTOM_INPUT):
-                    # acquire zigbee lock
-                    with self._zb_lock:
-                        # set pin to digital input
-                        self._zb.remote_at(dest_addr_long=bytes_mac, command=dio, parameter=XB_CONF_DINPUT)
+                    # set pin to digital input
+                    frames.append(self._zb_tx.Remote_at(bytes_mac, dio, XB_CONF_DINPUT))
 
             if(device_name.split("-")[0] == "cust"):
                 # create node identifier
@@ -1259,30 +2113,41 @@ class Home():
                 # create node identifier
                 node_identifier = device_type + "_" + device_mac[12:]
                 
-            # acquire zigbee lock
-            with self._zb_lock:
-                
-                # write node identifier to device
-                self._zb.remote_at(dest_addr_long=bytes_mac, command='NI', parameter=node_identifier)
-                
-                # apply changes
-                self._zb.remote_at(dest_addr_long=bytes_mac, command='AC')
-                # save configuration
-                self._zb.remote_at(dest_addr_long=bytes_mac, command='WR')
+            # turn on change detection and periodic sampling
+            if(self._push_state):
+                frames.extend(self._Configure_push(bytes_mac, device_type))
+
+            # write node identifier to device
+            frames.append(self._zb_tx.Remote_at(bytes_mac, 'NI', node_identifier))
 
-                self.Log("here2")
+            # apply changes
+            frames.append(self._zb_tx.Remote_at(bytes_mac, 'AC'))
+            # save configuration
+            frames.append(self._zb_tx.Remote_at(bytes_mac, 'WR'))
+
+            # wait for device to acknowledge configuration
+            if(not self._Wait_frames(frames)):
+                self.Log("could not add device \"" + device_name + "\", device did not acknowledge configuration")
+                return False
 
             with self._db_lock:
+                # check nothing took the name or mac while the device was being configured
+                if(self.Name_in_db(device_name) or self.Mac_in_db(device_mac)):
+                    self.Log("could not add device \"" + device_name + "\", name or mac was added to the db while configuring")
+                    return False
+
                 if(custom):
                     # add to db dict
                     self._device_db[device_name] = {'name':device_name, 'mac':device_mac, 'type':device_type, 'pin':dio, 'status':0}
-                    self.Log("here3")
                 else:
                     # add to db dict
                     self._device_db[device_name] = {'name':device_name, 'mac':device_mac, 'type':device_type}
 
+                self._Index_device(device_name)
+                self._db_journal.Set(device_name, self._device_db[device_name])
+                self._state.Add(device_name, type=device_type)
+
 
-            self.Log("here4")
             self.Log("added device \"" + device_name + "\" of type \"" + device_type + "\" to db")
             return True
 
@@ -1300,7 +2165,12 @@ class Home():
                 return False
 
             # remove from db
+            self._Unindex_device(device_name)
             del(self._device_db[device_name])
+            self._db_journal.Delete(device_name)
+            self._state.Remove(device_name)
+            self._metrics.Forget("device", device_name)
+            self._power_history.Remove(device_name)
 
             self.Log("removed device \"" + device_name + "\" from db")
             return True
@@ -1328,11 +2198,18 @@ class Home():
             saved_device = self._device_db[orig_name]
             
             # remove old device name from db
+            self._Unindex_device(orig_name)
             del(self._device_db[orig_name])
             
             # add new device name to db
             saved_device["name"] = new_name
             self._device_db[new_name] = saved_device
+            self._Index_device(new_name)
+            self._db_journal.Delete(orig_name)
+            self._db_journal.Set(new_name, saved_device)
+            self._state.Rename(orig_name, new_name)
+            self._metrics.Forget("device", orig_name)
+            self._power_history.Rename(orig_name, new_name)
 
             self.Log("changed device name from \"" + orig_name + "\" to \"" + new_name + "\"")
             return True
@@ -1340,64 +2217,80 @@ class Home():
     """
     Function: Recv_handler
     receives all packets from ZigBee modules (runs on separate thread)
-    handles packets containing change detection samples
+    routes io samples to the samplers waiting on the device they came from
+    and handles discovery packet responses
     """
     def Recv_handler(self, packet):
-        
-        # acquire process packets lock
-        acquired = self._process_packets_lock.acquire(blocking=False)
 
-        # if could not get lock
-        if(not acquired):
-            # put packet into queue
-            self._packet_queue.put(packet, block=True, timeout=DEFAULT_TIMEOUT)
+        self._metrics.Inc("xbee_frames_received_total", frame=packet.get("id", "unknown"))
+
+        # resolve outstanding at/remote_at command this responds to (if any)
+        self._zb_tx.Handle_response(packet)
+
+        # if io sample from a remote device (periodic sampling, change detection or remote IS response)
+        if("source_addr_long" in packet):
+            if("samples" in packet):
+                samples = packet["samples"][0]
+            elif(type(packet.get("parameter")) is list):
+                samples = packet["parameter"][0]
+            else:
+                return
+
+            self._Dispatch_sample(bytes(packet["source_addr_long"]), samples)
+
+            # keep state table live from pushed samples
+            if(self._push_state):
+                self._Update_pushed_state(bytearray(packet["source_addr_long"]), samples)
             return
 
-        # if could get lock:
-        try:
-            # if discovery packet response
-            if("parameter" in packet):
-                discovery_data = packet['parameter']
-                if("node_identifier" in discovery_data):
-                    with self._db_lock:
-                        
-                        self.Log("received discovery packet response")
-                        
-                        # get mac address
-                        device_mac = self.Bytes2mac(bytearray(discovery_data['source_addr_long']))
-                        
-                        # check if already in db
-                        if(self.Mac2name(device_mac)):
-                            self.Log("discovered device that is already in the db")
-                            return
-                        
-                        # try to identify device using node identifier
-                        node_identifier = discovery_data["node_identifier"].decode("utf-8")
-                        
-                        #self.Log("NI = " + node_identifier)
-                        
-                        split_ident = node_identifier.split("_")
-                        
-                        if(len(split_ident) >= 2):       
-                            # get needed values
-                            device_type = split_ident[0]
-                        else:
-                            self.Log("can't add discovered device, unrecognized identifier: " + str(node_identifier))
-                            return
-                        
-                        # attempt to add to db
-                        success = self.Add_device(node_identifier, device_mac, device_type)
-                        
-                        if(success):
-                            self.Log("discovered device with mac \"" + device_mac + "\" of type \"" + device_type + "\"")
-                            self.Log("device named \"" + node_identifier + "\", use change_device_name command to change it to a better name")
-                            return
-                        else:
-                            self.Log("failed to add discovered device to db")
-                            return
-        finally:
-            # release process_packets lock
-            self._process_packets_lock.release()
+        # if local sample response
+        if(type(packet.get("parameter")) is list):
+            self._Dispatch_sample(LOCAL_WAITER_KEY, packet["parameter"][0])
+            return
+
+        # if discovery packet response
+        if("parameter" in packet):
+            discovery_data = packet['parameter']
+            if(type(discovery_data) is dict and "node_identifier" in discovery_data):
+                with self._db_lock:
+
+                    self.Log("received discovery packet response")
+
+                    # get mac address
+                    device_mac = self.Bytes2mac(bytearray(discovery_data['source_addr_long']))
+
+                    # check if already in db
+                    if(self.Mac2name(device_mac)):
+                        self.Log("discovered device that is already in the db")
+                        return
+
+                    # try to identify device using node identifier
+                    node_identifier = discovery_data["node_identifier"].decode("utf-8")
+
+                    #self.Log("NI = " + node_identifier)
+
+                    split_ident = node_identifier.split("_")
+
+                    if(len(split_ident) >= 2):
+                        # get needed values
+                        device_type = split_ident[0]
+                    else:
+                        self.Log("can't add discovered device, unrecognized identifier: " + str(node_identifier))
+                        return
+
+                    # attempt to add to db, on another thread since configuring the
+                    # device waits for responses delivered by this thread
+                    Thread(target=lambda: self._Add_discovered_device(node_identifier, device_mac, device_type)).start()
+
+    def _Add_discovered_device(self, node_identifier, device_mac, device_type):
+
+        success = self.Add_device(node_identifier, device_mac, device_type)
+
+        if(success):
+            self.Log("discovered device with mac \"" + device_mac + "\" of type \"" + device_type + "\"")
+            self.Log("device named \"" + node_identifier + "\", use change_device_name command to change it to a better name")
+        else:
+            self.Log("failed to add discovered device to db")
 
     """
     Function: Send_discovery_packet
@@ -1409,8 +2302,11 @@ class Home():
 
         # get lock
         with self._zb_lock:
-            # tell local zigbee to discover devices on network
-            self._zb.at(command='ND')
+            # tell local zigbee to discover devices on network, not sent through
+            # the transaction layer since every device answers with the same frame id
+            self._zb.at(frame_id=XB_DISCOVERY_FRAME_ID, command='ND')
+
+        self._metrics.Inc("xbee_frames_sent_total", frame="at")
 
     """
     Function: Add_task
@@ -1534,6 +2430,21 @@ class Home():
     commands = test, get(level), set(level), add(name, mac, type), remove(name)
     """
     def Run_command(self, params):
+
+        # command given before Run_command changes params
+        command = params.get("cmd", params.get("command", "invalid"))
+
+        start = time.perf_counter()
+        resp = "error"
+        try:
+            resp = self._Run_command(params)
+            return resp
+        finally:
+            # unknown commands share one label, so clients can't add a series per made up command
+            self._metrics.Observe("command_seconds", time.perf_counter() - start,
+                                  command=command if command in COMMANDS else "invalid")
+
+    def _Run_command(self, params):
         """
         if("task_id" in params):
             self.Log("executing task \"" + params["task_id"] + "\"")
@@ -1686,13 +2597,80 @@ class Home():
             # get device name
             device_name = params['name']
 
-            curr_level = self.Get_device_level(device_name)
+            curr_level = self.Get_device_level(device_name, max_age=self._Level_max_age(params))
 
             if(curr_level == LEVEL_UNK):
                 return("unk")
             else:
                 return(str(curr_level))
 
+        # get latency histograms and counters
+        elif(command == "get_metrics"):
+            return json.dumps(self.Get_metrics())
+
+        # write the recently sent and received api frames to a trace file
+        elif(command == "dump_frames"):
+            dump = self.Dump_frames(params.get('filename') or None)
+            if(dump is None):
+                self.Log("cannot run dump_frames command, frame capture is off")
+                return("failed")
+            return json.dumps(dump)
+
+        # get every device and thermostat state at once
+        elif(command == "get_state"):
+            # check if units are specified
+            if("units" in params):
+                units = params["units"][0].upper()
+                return json.dumps(self.Get_state(units=units))
+            else:
+                return json.dumps(self.Get_state())
+
+        # get recent power usage
+        elif(command == "get_power_history"):
+
+            if('name' not in params):
+                self.Log("cannot run get_power_history command, must specify \"name\"")
+                return("failed")
+
+            device_name = params['name']
+
+            if(not self.Name_in_db(device_name)):
+                self.Log("cannot get power history of \"" + device_name + "\", name not in db")
+                return("failed")
+
+            # resolution is "raw", "minute" or "hour", range is in unix seconds
+            resolution = params.get('resolution', "raw")
+            end = float(params['end']) if 'end' in params else None
+            start = float(params['start']) if 'start' in params else 0
+
+            history = self._power_history.Get(device_name, resolution=resolution, start=start, end=end)
+
+            if(history is None):
+                self.Log("cannot get power history, invalid resolution \"" + str(resolution) + "\"")
+                return("failed")
+
+            return json.dumps(history)
+
+        # get energy used in a time range
+        elif(command == "get_energy_usage"):
+
+            if('name' not in params):
+                self.Log("cannot run get_energy_usage command, must specify \"name\"")
+                return("failed")
+
+            device_name = params['name']
+
+            # range is in unix seconds, defaults to everything logged
+            end = float(params['end']) if 'end' in params else time.time()
+            start = float(params['start']) if 'start' in params else 0
+
+            if(start > end):
+                self.Log("cannot get energy usage, start is after end")
+                return("failed")
+
+            # return kWh
+            return ("%.4f" % (self._energy_index.Energy(device_name, start, end) / 1000.0))
+
         # add a device
         elif(command == "add_device"):
 
@@ -1757,6 +2735,20 @@ class Home():
             else:
                 return("failed")
 
+        # measure brightness at each dimmer position
+        elif(command == "calibrate_dimmer"):
+
+            if("name" not in params):
+                self.Log("cannot run calibrate_dimmer command, must specify \"name\"")
+                return("failed")
+
+            success = self.Calibrate_dimmer(params["name"])
+
+            if(success):
+                return("ok")
+            else:
+                return("failed")
+
         # discover devices
         elif(command == "discover_devices"):
             self.Send_discovery_packet()
@@ -1805,11 +2797,11 @@ class Home():
 
     """
     Function: Log
-    prints string to console and log file with a timestamp
+    logs string to console, log file and journald with a timestamp, given
+    % format args the string is only formatted if level is enabled
     """
-    def Log(self, logstr):
-        self._log.info(logstr)
-        print(time.strftime(LOG_TIMESTAMP) + ": " + logstr)
+    def Log(self, logstr, *args, level=logging.INFO):
+        self._log.log(level, logstr, *args)
 
 if(__name__ == "__main__"):
     print("this is a library. import it to use it")
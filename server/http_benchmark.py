@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+# USAGE: ./http_benchmark.py [--devices 20] [--clients 8] [--slow-clients 8] [--duration 10] [--output bench.json]
+
+import sys
+import os
+import ssl
+import json
+import time
+import base64
+import socket
+import tempfile
+import argparse
+import platform
+import subprocess
+import http.client
+import urllib.parse
+from threading import *
+from benchmark import Percentile
+
+"""
+http throughput benchmark
+
+starts server_main.py on a simulated radio, once with the flask
+development server (--dev) and once in production mode, and measures
+requests/sec and latency of list_devices from keep-alive clients, alone
+and while other clients keep slow radio commands (uncached
+get_device_level) in flight.
+"""
+
+DEFAULT_DEVICES = 20
+DEFAULT_CLIENTS = 8
+DEFAULT_SLOW_CLIENTS = 8
+DEFAULT_DURATION = 10   # seconds each measurement runs
+
+STARTUP_WAIT = 30       # seconds to wait for the server to answer and discover the fleet
+REQUEST_TIMEOUT = 30    # seconds a client waits for a response
+
+USER = 'clayton'
+PASS = 'clayton'
+
+SERVER_MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server_main.py")
+
+class Client():
+    """
+    keep-alive https connection to the server
+    """
+    def __init__(self, port):
+        self._port = port
+        self._context = ssl.create_default_context()
+        self._context.check_hostname = False
+        self._context.verify_mode = ssl.CERT_NONE
+        self._auth = "Basic " + base64.b64encode((USER + ":" + PASS).encode()).decode()
+        self._conn = None
+
+    """
+    Function: Request
+    given command params, returns (http status, response body, retry after
+    seconds or None), reconnects if the server closed the connection
+    """
+    def Request(self, params):
+        for attempt in range(2):
+            if(self._conn is None):
+                self._conn = http.client.HTTPSConnection("127.0.0.1", self._port, context=self._context, timeout=REQUEST_TIMEOUT)
+            try:
+                self._conn.request("GET", "/?" + urllib.parse.urlencode(params), headers={"Authorization": self._auth})
+                resp = self._conn.getresponse()
+                retry_after = resp.getheader("Retry-After")
+                return resp.status, resp.read().decode(), float(retry_after) if retry_after else None
+            except (http.client.HTTPException, OSError):
+                self.Close()
+                if(attempt == 1):
+                    raise
+
+    def Close(self):
+        if(self._conn is not None):
+            self._conn.close()
+            self._conn = None
+
+def Free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def Start_server(tmp_dir, port, num_devices, dev):
+    cmd = [sys.executable, SERVER_MAIN, "--sim", str(num_devices), "--port", str(port)]
+    if(dev):
+        cmd.append("--dev")
+    server = subprocess.Popen(cmd, cwd=tmp_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    # wait until the server answers and knows the whole fleet
+    client = Client(port)
+    deadline = time.time() + STARTUP_WAIT
+    while(time.time() < deadline):
+        try:
+            status, body, retry_after = client.Request({"cmd": "list_devices"})
+            if(status == 200 and body != "none" and len(body.split(",")) >= num_devices):
+                client.Close()
+                return server
+        except OSError:
+            pass
+        time.sleep(0.2)
+
+    server.kill()
+    raise Exception("server did not start")
+
+def Stop_server(server):
+    server.terminate()
+    try:
+        server.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+def Run_clients(port, num_clients, make_params, stop):
+    # returns sorted latencies and number of failed requests of all clients
+    latencies = []
+    errors = [0]
+    lock = Lock()
+
+    def Run():
+        client = Client(port)
+        mine = []
+        failed = 0
+        while(not stop.is_set()):
+            start = time.perf_counter()
+            try:
+                status, body, retry_after = client.Request(make_params())
+                if(status != 200 or body in ["failed", "invalid"]):
+                    failed += 1
+                if(retry_after):
+                    # server is busy, back off like a real client would
+                    stop.wait(retry_after)
+            except OSError:
+                failed += 1
+            mine.append(time.perf_counter() - start)
+        client.Close()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [Thread(target=Run, daemon=True) for i in range(num_clients)]
+    for t in threads:
+        t.start()
+    return threads, latencies, errors
+
+def Measure(port, devices, clients, slow_clients, duration):
+    stop = Event()
+    slow_stop = Event()
+
+    # slow clients keep radio commands in flight, a different device each request
+    counter = [0]
+    def Slow_params():
+        counter[0] += 1
+        return {"cmd": "get_device_level", "name": devices[counter[0] % len(devices)], "max_age": 0}
+
+    slow_threads, slow_latencies, slow_errors = Run_clients(port, slow_clients, Slow_params, slow_stop)
+    if(slow_clients):
+        # let the slow requests pile up first
+        time.sleep(1)
+
+    start = time.perf_counter()
+    fast_threads, fast_latencies, fast_errors = Run_clients(port, clients, lambda: {"cmd": "list_devices"}, stop)
+    time.sleep(duration)
+    stop.set()
+    for t in fast_threads:
+        t.join(REQUEST_TIMEOUT)
+    wall = time.perf_counter() - start
+
+    slow_stop.set()
+    for t in slow_threads:
+        t.join(REQUEST_TIMEOUT)
+
+    fast_latencies.sort()
+    slow_latencies.sort()
+    return {
+        "requests": len(fast_latencies),
+        "errors": fast_errors[0],
+        "req_per_sec": len(fast_latencies) / wall,
+        "p50_ms": 1000 * Percentile(fast_latencies, 50),
+        "p99_ms": 1000 * Percentile(fast_latencies, 99),
+        "max_ms": 1000 * (fast_latencies[-1] if fast_latencies else 0.0),
+        "slow_requests": len(slow_latencies),
+        "slow_errors": slow_errors[0],
+        "slow_p50_ms": 1000 * Percentile(slow_latencies, 50),
+    }
+
+def Bench_mode(dev, opts):
+    results = []
+
+    # each server gets its own directory for db, logs and a throwaway certificate
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-out", "cert.pem", "-keyout", "key.pem",
+                        "-days", "1", "-subj", "/CN=localhost"], cwd=tmp_dir, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        port = Free_port()
+        server = Start_server(tmp_dir, port, opts.devices, dev)
+        try:
+            client = Client(port)
+            devices = client.Request({"cmd": "list_devices"})[1].split(",")
+            client.Close()
+
+            for slow_clients in [0, opts.slow_clients]:
+                result = Measure(port, devices, opts.clients, slow_clients, opts.duration)
+                result.update({"server": "dev" if dev else "production", "clients": opts.clients, "slow_clients": slow_clients})
+                results.append(result)
+                print("%-10s  list_devices c=%-3d slow=%-3d %8.1f req/s  p50 %8.2f ms  p99 %8.2f ms  errors %d  (slow: %d done, p50 %.0f ms, errors %d)" %
+                      (result["server"], opts.clients, slow_clients, result["req_per_sec"], result["p50_ms"], result["p99_ms"],
+                       result["errors"], result["slow_requests"], result["slow_p50_ms"], result["slow_errors"]))
+        finally:
+            Stop_server(server)
+
+    return results
+
+def main(args):
+    parser = argparse.ArgumentParser(description="benchmark server_main.py over https, dev server vs production mode")
+    parser.add_argument("--devices", type=int, default=DEFAULT_DEVICES, help="simulated fleet size")
+    parser.add_argument("--clients", type=int, default=DEFAULT_CLIENTS, help="keep-alive clients sending list_devices")
+    parser.add_argument("--slow-clients", type=int, default=DEFAULT_SLOW_CLIENTS, help="clients sending uncached get_device_level")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION, help="seconds per measurement")
+    parser.add_argument("--modes", default="dev,production", help="comma separated servers to run")
+    parser.add_argument("--output", default=None, help="write json results to this file")
+    opts = parser.parse_args(args[1:])
+
+    report = {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "devices": opts.devices,
+        "results": [],
+    }
+
+    for mode in opts.modes.split(","):
+        report["results"].extend(Bench_mode(mode == "dev", opts))
+
+    if(opts.output):
+        with open(opts.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("wrote results to " + opts.output)
+    else:
+        print(json.dumps(report, indent=2))
+
+# run
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+from threading import *
+
+"""
+journaled json file
+
+keeps a dict saved in a json snapshot file (same format as writing the
+dict with json.dump) plus a write-ahead log of the changes made since the
+snapshot was written. each change is appended to the log as one line
+right away, the log is fsynced shortly after (several changes close
+together share one fsync), and once enough changes have built up the
+snapshot is rewritten and the log started over. loading reads the
+snapshot then replays the log, so nothing acknowledged before the last
+fsync is lost if the process or the power dies.
+"""
+
+DEFAULT_FSYNC_DELAY = 0.5      # seconds from a change to the fsync that makes it durable
+DEFAULT_COMPACT_RECORDS = 500  # log records before the snapshot is rewritten
+
+LOG_SUFFIX = ".journal"
+TMP_SUFFIX = ".tmp"
+
+OP_SET = "set"
+OP_DELETE = "del"
+
+class Journal():
+    """
+    filename        : snapshot file, the log is kept next to it in filename + LOG_SUFFIX
+    fsync_delay     : seconds to wait for more changes before fsyncing the log
+    compact_records : number of log records that triggers rewriting the snapshot
+    """
+    def __init__(self, filename, fsync_delay=DEFAULT_FSYNC_DELAY, compact_records=DEFAULT_COMPACT_RECORDS):
+        self._filename = filename
+        self._log_filename = filename + LOG_SUFFIX
+        self._fsync_delay = fsync_delay
+        self._compact_records = compact_records
+
+        # lock/condition for the log and state
+        self._lock = Condition()
+
+        # state as of the last record, written out on compaction
+        self._state = dict()
+
+        self._log = None
+        self._num_records = 0
+        self._fsync_due = None
+        self._running = False
+        self._thread = None
+
+    """
+    Function: Load
+    reads the snapshot and replays the log over it, then starts journaling
+    returns the loaded dict (empty if neither file exists)
+    """
+    def Load(self):
+        with self._lock:
+            state = dict()
+
+            if(os.path.isfile(self._filename)):
+                with open(self._filename) as f:
+                    state = json.load(f)
+
+            num_records = 0
+            if(os.path.isfile(self._log_filename)):
+                with open(self._log_filename, 'rb') as f:
+                    good_end = 0
+                    for line in f:
+                        try:
+                            if(not line.endswith(b"\n")):
+                                raise ValueError("no newline")
+                            op, key, value = json.loads(line)
+                        except ValueError:
+                            # torn write at the end of the log, nothing after it was acknowledged
+                            break
+                        self._Apply(state, op, key, value)
+                        num_records += 1
+                        good_end = f.tell()
+
+                # drop the torn record so new records don't end up after it, where replay would never reach them
+                if(good_end < os.path.getsize(self._log_filename)):
+                    with open(self._log_filename, 'r+b') as f:
+                        f.truncate(good_end)
+                        os.fsync(f.fileno())
+
+            self._state = json.loads(json.dumps(state))
+            self._log = open(self._log_filename, 'a')
+            self._num_records = num_records
+            self._running = True
+
+        self._thread = Thread(target=self._Run, name="journal-" + os.path.basename(self._filename), daemon=True)
+        self._thread.start()
+
+        # fold a replayed log into the snapshot
+        if(num_records > 0):
+            self.Compact()
+
+        return state
+
+    def Exists(self):
+        return os.path.isfile(self._filename) or os.path.isfile(self._log_filename)
+
+    """
+    Function: Set
+    records key being set to value (anything json serializable)
+    callers must hold the lock protecting their copy of the dict so
+    changes are journaled in the order they were made
+    """
+    def Set(self, key, value):
+        self._Append(OP_SET, key, value)
+
+    """
+    Function: Delete
+    records key being removed
+    """
+    def Delete(self, key):
+        self._Append(OP_DELETE, key, None)
+
+    """
+    Function: Compact
+    rewrites the snapshot from the journaled state (or the given dict) and
+    starts a new log
+    """
+    def Compact(self, state=None):
+        with self._lock:
+            if(state is not None):
+                self._state = json.loads(json.dumps(state))
+
+            # write new snapshot next to the old one then swap it in
+            tmp_filename = self._filename + TMP_SUFFIX
+            with open(tmp_filename, 'w') as f:
+                json.dump(self._state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_filename, self._filename)
+            self._Fsync_dir()
+
+            # snapshot has everything, log can start over
+            if(self._log is not None):
+                self._log.close()
+                self._log = open(self._log_filename, 'w')
+                os.fsync(self._log.fileno())
+            self._num_records = 0
+            self._fsync_due = None
+
+    """
+    Function: Close
+    writes a final snapshot (of the given dict if given) and stops journaling
+    """
+    def Close(self, state=None):
+        self.Compact(state)
+
+        with self._lock:
+            self._running = False
+            self._lock.notify_all()
+            if(self._log is not None):
+                self._log.close()
+                self._log = None
+
+        if(self._thread is not None):
+            self._thread.join()
+
+    def _Append(self, op, key, value):
+        line = json.dumps([op, key, value]) + "\n"
+
+        with self._lock:
+            self._Apply(self._state, op, key, json.loads(json.dumps(value)))
+
+            if(self._log is None):
+                return
+
+            # written through to the os now, fsynced by the journal thread
+            self._log.write(line)
+            self._log.flush()
+            self._num_records += 1
+
+            if(self._fsync_due is None):
+                self._fsync_due = time.monotonic() + self._fsync_delay
+                self._lock.notify()
+
+    @staticmethod
+    def _Apply(state, op, key, value):
+        if(op == OP_SET):
+            state[key] = value
+        elif(op == OP_DELETE):
+            state.pop(key, None)
+
+    def _Fsync_dir(self):
+        # make the rename durable, not every platform can open a directory
+        try:
+            fd = os.open(os.path.dirname(os.path.abspath(self._filename)), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def _Run(self):
+        while(True):
+            with self._lock:
+                while(self._running and (self._fsync_due is None or self._fsync_due > time.monotonic())):
+                    if(self._fsync_due is None):
+                        self._lock.wait()
+                    else:
+                        self._lock.wait(self._fsync_due - time.monotonic())
+
+                if(not self._running):
+                    return
+
+                self._fsync_due = None
+                os.fsync(self._log.fileno())
+                compact = (self._num_records >= self._compact_records)
+
+            if(compact):
+                self.Compact()
+
+if(__name__ == "__main__"):
+    print("this is a library. import it to use it")
+    exit(0)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+import time
+import bisect
+from threading import *
+
+"""
+in-process counters, gauges and histograms
+
+cheap enough to leave on: recording is a dict lookup and a bisect under a
+lock, nothing is kept per observation. histograms use fixed buckets, so
+percentiles reported by Snapshot are bucket upper bounds (estimates).
+everything can be read as a dict (Snapshot) or in the prometheus text
+exposition format (Prometheus).
+"""
+
+# bucket upper bounds in seconds, roughly x2.5 apart from 1 ms to 60 s
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+DEFAULT_PREFIX = "home_"
+
+class Histogram():
+    """
+    buckets : increasing bucket upper bounds, values above the last go in +Inf
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def Observe(self, value):
+        # caller holds the metrics lock
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if(value > self.max):
+            self.max = value
+
+    def Percentile(self, pct):
+        # upper bound of the bucket holding the pct-th percentile observation (or the max if lower)
+        if(self.count == 0):
+            return 0.0
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for i in range(len(self.counts)):
+            seen += self.counts[i]
+            if(seen >= rank):
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+        return self.max
+
+class Metrics():
+    """
+    prefix : prepended to every metric name in the prometheus output
+    """
+    def __init__(self, prefix=DEFAULT_PREFIX):
+        self._prefix = prefix
+
+        # lock for metric access
+        self._lock = Lock()
+
+        # name -> {label tuple -> value / Histogram}
+        self._counters = dict()
+        self._histograms = dict()
+
+        # name -> function returning the current value, read when metrics are read
+        self._gauges = dict()
+
+        # name -> help text
+        self._help = dict()
+
+    """
+    Function: Inc
+    adds amount to the counter name with the given labels
+    """
+    def Inc(self, name, amount=1, **labels):
+        key = self._Key(labels)
+        with self._lock:
+            counter = self._counters.setdefault(name, dict())
+            counter[key] = counter.get(key, 0) + amount
+
+    """
+    Function: Observe
+    records value (seconds) in the histogram name with the given labels
+    """
+    def Observe(self, name, value, **labels):
+        key = self._Key(labels)
+        with self._lock:
+            histogram = self._histograms.setdefault(name, dict())
+            if(key not in histogram):
+                histogram[key] = Histogram()
+            histogram[key].Observe(value)
+
+    """
+    Function: Timer
+    returns a context manager recording how long its block takes in the
+    histogram name
+    """
+    def Timer(self, name, **labels):
+        return _Timer(self, name, labels)
+
+    """
+    Function: Timed
+    given a function, returns a function that calls it and records how long
+    each call takes in the histogram name
+    """
+    def Timed(self, function, name, **labels):
+        def Timed_function(*args, **kwargs):
+            with self.Timer(name, **labels):
+                return function(*args, **kwargs)
+        return Timed_function
+
+    """
+    Function: Gauge
+    registers a function returning the current value of the gauge name
+    """
+    def Gauge(self, name, function):
+        with self._lock:
+            self._gauges[name] = function
+
+    def Describe(self, name, help_text):
+        with self._lock:
+            self._help[name] = help_text
+
+    def Forget(self, label_name, label_value):
+        # drops every series with the given label, e.g. of a removed device
+        with self._lock:
+            for family in list(self._counters.values()) + list(self._histograms.values()):
+                for key in [k for k in family if (label_name, label_value) in k]:
+                    del(family[key])
+
+    """
+    Function: Snapshot
+    returns a dict of every metric: counters and gauges as values,
+    histograms as count, sum, mean, max and estimated p50/p90/p99, keyed by
+    name then label string
+    """
+    def Snapshot(self):
+        gauges = self._Read_gauges()
+
+        with self._lock:
+            snapshot = {"time": time.time(), "counters": dict(), "gauges": gauges, "histograms": dict()}
+
+            for name in self._counters:
+                snapshot["counters"][name] = {self._Label_str(key): value for key, value in self._counters[name].items()}
+
+            for name in self._histograms:
+                series = dict()
+                for key, histogram in self._histograms[name].items():
+                    series[self._Label_str(key)] = {
+                        "count": histogram.count,
+                        "sum": histogram.sum,
+                        "mean": histogram.sum / histogram.count if histogram.count else 0.0,
+                        "max": histogram.max,
+                        "p50": histogram.Percentile(50),
+                        "p90": histogram.Percentile(90),
+                        "p99": histogram.Percentile(99),
+                    }
+                snapshot["histograms"][name] = series
+
+        return snapshot
+
+    """
+    Function: Prometheus
+    returns every metric in the prometheus text exposition format
+    """
+    def Prometheus(self):
+        gauges = self._Read_gauges()
+        lines = []
+
+        with self._lock:
+            for name in sorted(self._counters):
+                full_name = self._prefix + name
+                self._Header(lines, name, full_name, "counter")
+                for key, value in self._counters[name].items():
+                    lines.append(full_name + self._Label_block(key) + " " + repr(float(value)))
+
+            for name in sorted(gauges):
+                full_name = self._prefix + name
+                self._Header(lines, name, full_name, "gauge")
+                lines.append(full_name + " " + repr(float(gauges[name])))
+
+            for name in sorted(self._histograms):
+                full_name = self._prefix + name
+                self._Header(lines, name, full_name, "histogram")
+                for key, histogram in self._histograms[name].items():
+                    cumulative = 0
+                    for i in range(len(histogram.buckets)):
+                        cumulative += histogram.counts[i]
+                        lines.append(full_name + "_bucket" + self._Label_block(key + (("le", repr(histogram.buckets[i])),)) +
+                                     " " + str(cumulative))
+                    lines.append(full_name + "_bucket" + self._Label_block(key + (("le", "+Inf"),)) + " " + str(histogram.count))
+                    lines.append(full_name + "_sum" + self._Label_block(key) + " " + repr(histogram.sum))
+                    lines.append(full_name + "_count" + self._Label_block(key) + " " + str(histogram.count))
+
+        return "\n".join(lines) + "\n"
+
+    def _Header(self, lines, name, full_name, metric_type):
+        if(name in self._help):
+            lines.append("# HELP " + full_name + " " + self._help[name])
+        lines.append("# TYPE " + full_name + " " + metric_type)
+
+    def _Read_gauges(self):
+        with self._lock:
+            gauges = dict(self._gauges)
+
+        # outside the lock, gauge functions may take other locks
+        values = dict()
+        for name in gauges:
+            try:
+                values[name] = gauges[name]()
+            except Exception:
+                continue
+        return values
+
+    @staticmethod
+    def _Key(labels):
+        if(not labels):
+            return ()
+        # nearly every series has a single label, skip the sort
+        if(len(labels) == 1):
+            for k, v in labels.items():
+                return ((k, v if type(v) is str else str(v)),)
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    @staticmethod
+    def _Label_str(key):
+        return ",".join(k + "=" + v for k, v in key)
+
+    @staticmethod
+    def _Label_block(key):
+        if(not key):
+            return ""
+        escaped = [(k, v.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for k, v in key]
+        return "{" + ",".join(k + "=\"" + v + "\"" for k, v in escaped) + "}"
+
+class _Timer():
+    def __init__(self, metrics, name, labels):
+        self._metrics = metrics
+        self._name = name
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._metrics.Observe(self._name, time.perf_counter() - self._start, **self._labels)
+        return False
+
+if(__name__ == "__main__"):
+    print("this is a library. import it to use it")
+    exit(0)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+"""
+current sense to power conversion
+
+converts raw CURRSENSE_OUT adc readings to real power for many devices
+at once. each device gives several readings of the rectified current
+sense output, which are combined as an rms so one noisy reading doesn't
+decide the result.
+"""
+
+ADC_MAX = 1023.0      # 10 bit adc
+ADC_VREF = 1.2        # volts at ADC_MAX
+AMPS_PER_VOLT = 10    # current sense chip output is 100 mV per amp
+
+"""
+Function: Batch_power
+given
+    adc          : 2d array, a row of raw adc readings per device (nan where
+                   a device gave fewer readings than the others)
+    relay_on     : bool array, whether each device's relay is on
+    voltage_div  : array, each device's calibrated voltage divider ratio
+    power_factor : array, each device's load power factor
+and the circuit constants, returns (watts, voltage_div) arrays
+
+devices with the relay off use 0 W and have their voltage divider
+recalibrated from the no load reading, the rest keep theirs
+"""
+def Batch_power(adc, relay_on, voltage_div, power_factor, diode_drop, noload_vout, ac_voltage):
+    adc = np.asarray(adc, dtype=np.float64)
+    relay_on = np.asarray(relay_on, dtype=bool)
+    voltage_div = np.asarray(voltage_div, dtype=np.float64)
+    power_factor = np.asarray(power_factor, dtype=np.float64)
+
+    # convert to voltage
+    sample_voltage = (adc / ADC_MAX) * ADC_VREF
+
+    # convert each reading to ac current amplitude (A), then combine the readings of each device
+    ac_current = np.abs(((sample_voltage + diode_drop) / voltage_div[:, np.newaxis]) - noload_vout) * AMPS_PER_VOLT
+    ac_current = np.sqrt(np.nanmean(ac_current**2, axis=1))
+
+    # apparent power (VA) to approximate real power (W)
+    watts = (ac_current * ac_voltage / 2) * power_factor
+    watts = np.where(relay_on, watts, 0.0)
+
+    # relay off means no load, recalibrate divider from the mean no load reading
+    noload_div = (diode_drop + np.nanmean(sample_voltage, axis=1)) / noload_vout
+    voltage_div = np.where(relay_on, voltage_div, noload_div)
+
+    return watts, voltage_div
+
+if(__name__ == "__main__"):
+    print("this is a library. import it to use it")
+    exit(0)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import time
+from collections import deque
+from threading import *
+
+"""
+recent power usage kept in memory
+
+each device gets a fixed size ring of raw readings plus rings of 1 minute
+and 1 hour rollups (min/mean/max), updated as readings arrive. memory use
+only depends on the ring sizes and number of devices, not on uptime.
+"""
+
+DEFAULT_RAW_SIZE = 600         # raw readings kept per device
+DEFAULT_MINUTE_SIZE = 24*60    # 1 minute rollups kept per device
+DEFAULT_HOUR_SIZE = 30*24      # 1 hour rollups kept per device
+
+RESOLUTIONS = {"minute": 60, "hour": 60*60}
+
+class PowerHistory():
+    """
+    raw_size    : number of raw readings kept per device
+    minute_size : number of 1 minute rollups kept per device
+    hour_size   : number of 1 hour rollups kept per device
+    """
+    def __init__(self, raw_size=DEFAULT_RAW_SIZE, minute_size=DEFAULT_MINUTE_SIZE, hour_size=DEFAULT_HOUR_SIZE):
+        self._sizes = {"raw": raw_size, "minute": minute_size, "hour": hour_size}
+
+        # lock for history access
+        self._lock = Lock()
+
+        # device name -> {"raw": deque of (time, watts),
+        #                 "minute"/"hour": deque of [start, min, max, sum, count]}
+        self._devices = dict()
+
+    """
+    Function: Record
+    given a device name, power usage (W) and unix time of the reading,
+    adds the reading to the device's history
+    """
+    def Record(self, device_name, watts, timestamp=None):
+        if(timestamp is None):
+            timestamp = time.time()
+
+        with self._lock:
+            history = self._devices.get(device_name)
+            if(history is None):
+                history = {res: deque(maxlen=size) for res, size in self._sizes.items()}
+                self._devices[device_name] = history
+
+            history["raw"].append((timestamp, watts))
+
+            for res, period in RESOLUTIONS.items():
+                buckets = history[res]
+                start = timestamp - (timestamp % period)
+
+                # add to the current bucket or start a new one
+                if(buckets and buckets[-1][0] == start):
+                    bucket = buckets[-1]
+                    bucket[1] = min(bucket[1], watts)
+                    bucket[2] = max(bucket[2], watts)
+                    bucket[3] += watts
+                    bucket[4] += 1
+                else:
+                    buckets.append([start, watts, watts, watts, 1])
+
+    """
+    Function: Get
+    given a device name, resolution ("raw", "minute" or "hour") and time
+    range (unix seconds), returns the readings in that range, oldest first
+    raw readings are [time, watts], rollups are [start, min, mean, max]
+    returns None if the resolution is not valid
+    """
+    def Get(self, device_name, resolution="raw", start=0, end=None):
+        if(resolution not in self._sizes):
+            return None
+
+        if(end is None):
+            end = time.time()
+
+        with self._lock:
+            history = self._devices.get(device_name)
+            if(history is None):
+                return []
+
+            if(resolution == "raw"):
+                return [[t, watts] for t, watts in history["raw"] if start <= t <= end]
+
+            return [[b[0], b[1], b[3] / b[4], b[2]] for b in history[resolution] if start <= b[0] <= end]
+
+    def Remove(self, device_name):
+        with self._lock:
+            self._devices.pop(device_name, None)
+
+    def Rename(self, orig_name, new_name):
+        with self._lock:
+            if(orig_name in self._devices):
+                self._devices[new_name] = self._devices.pop(orig_name)
+
+if(__name__ == "__main__"):
+    print("this is a library. import it to use it")
+    exit(0)
@@ -1,18 +1,357 @@
 #!/usr/bin/env python3
 
+# USAGE: ./server_main.py [--sim N] [--dev] [--port PORT] [--threads N] [--radio-workers N]
+#                         [--radio-queue N] [--backlog N] [--timeout SECONDS] [--socket-timeout SECONDS]
+#                         [--replay TRACE] [--replay-speed X]
+#
+# --replay runs against a radio playing back a trace written by dump_frames, run it in a directory
+# holding a copy of the device db (.devices.json and its .journal) from where the trace was captured
+#
+# routes: /      runs one command given as query string or json params
+#         /batch runs a json list of commands, returns a json list of results
+#         /events streams state changes as server-sent events, starting with the whole state
+#         /metrics latency histograms and counters in the prometheus text format
+#
+# reads of state (get_state, get_device_level, ...) answer with the version of the part of the state
+# they return as their ETag. given since_version (or If-None-Match) they wait up to timeout seconds
+# for that part to change, and answer 304 with no body if it didn't. without push, level reads only
+# answer 304 while the cached level is within max_age, otherwise they read the device again
+
 import sys
-from flask import Flask, request
+import json
+import math
+import time
+import argparse
+from queue import Empty
+from threading import *
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from flask import Flask, request, Response
 from flask_basicauth import BasicAuth
 from home import *
 
+# production wsgi server, only needed when not running the flask development server
+try:
+    from cheroot import wsgi
+    from cheroot.ssl.builtin import BuiltinSSLAdapter
+except ImportError:
+    wsgi = None
+
 PORT = 58000
 
 USER = 'clayton'
 PASS = 'clayton'
 
+CERT_FILENAME = 'cert.pem'
+KEY_FILENAME = 'key.pem'
+
+HTTP_THREADS = 32          # threads serving http connections
+HTTP_BACKLOG = 64          # connections waiting to be accepted before new ones are refused
+HTTP_SOCKET_TIMEOUT = 10   # seconds an idle keep-alive connection is kept open
+RADIO_WORKERS = 8          # commands using the radio run at once at most
+RADIO_QUEUE = 16           # commands using the radio running or waiting at most, more are refused (503),
+                           # keep below HTTP_THREADS so waiting radio commands can't hold every http thread
+COMMAND_TIMEOUT = 10       # seconds a request waits for a radio command before giving up (504)
+BUSY_RETRY_AFTER = 1       # seconds clients are told to wait before retrying a refused command
+BATCH_WORKERS = 8          # commands of a batch run at once at most
+BATCH_MAX_COMMANDS = 100   # commands a batch may hold
+MAX_STREAMS = 8            # event streams open at once at most, each holds an http thread
+MAX_LONG_POLLS = 8         # reads waiting for a state change at once at most, each holds an http thread
+STREAM_KEEPALIVE = 15      # seconds between keepalive comments on an idle event stream
+
+# commands answered without waiting on the radio, run right on the http thread
+LOCAL_COMMANDS = ["test", "get_set_temp", "set_temp", "set_temp_mode", "set_fan_mode", "get_temp_mode",
+                  "get_fan_mode", "remove_device", "change_device_name", "list_devices",
+                  "list_devices_with_types", "get_state", "get_metrics", "dump_frames", "get_power_history",
+                  "get_energy_usage"]
+
+# commands on the thermostat settings, run in order with each other within a batch
+THERMOSTAT_COMMANDS = ["get_curr_temp", "get_set_temp", "set_temp", "set_temp_mode", "set_fan_mode",
+                       "get_temp_mode", "get_fan_mode"]
+
+# responses meaning the command didn't work, used as the status of batch results
+FAILED_RESPONSES = ["failed", "invalid"]
+
+class CommandRunner():
+    """
+    runs Run_command for http requests, commands that use the radio run on
+    their own bounded pool so they can't tie up every http thread
+    """
+    def __init__(self, home, workers=RADIO_WORKERS, queue_size=RADIO_QUEUE, timeout=COMMAND_TIMEOUT, long_polls=MAX_LONG_POLLS):
+        self._home = home
+        self._timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="radio-command")
+        self._slots = BoundedSemaphore(queue_size)
+        self._poll_slots = BoundedSemaphore(long_polls)
+
+        # runs the independent parts of batches
+        self._batch_pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="batch-command")
+
+    """
+    Function: Run
+    given command params, returns (response body, http status[, headers])
+    if wait is True a radio command waits for room in the pool rather than
+    being refused straight away
+    """
+    def Run(self, params, wait=False):
+        command = params.get("cmd", params.get("command"))
+
+        if(command not in STATE_READ_COMMANDS):
+            return self._Run(command, params, wait)
+
+        # wait for a state change here rather than on the radio pool
+        if("since_version" in params):
+            try:
+                since_version = int(params.pop("since_version"))
+                timeout = min(float(params.pop("timeout", LONG_POLL_TIMEOUT)), LONG_POLL_MAX)
+            except (TypeError, ValueError):
+                return "invalid", 400
+            if(not math.isfinite(timeout)):
+                return "invalid", 400
+
+            if(timeout <= 0):
+                version = self._home.State_version(command)
+            elif(self._poll_slots.acquire(blocking=False)):
+                try:
+                    version = self._home.Wait_state_version(since_version, timeout, command)
+                finally:
+                    self._poll_slots.release()
+            else:
+                return "busy", 503, {"Retry-After": str(BUSY_RETRY_AFTER)}
+
+            # unchanged version only means unchanged state while the cached state is current
+            if(version != since_version):
+                result = "changed"
+            elif(self._home.State_current(params)):
+                result = "not_modified"
+            else:
+                result = "stale"
+            self._home.Metrics().Inc("long_polls_total", result=result)
+
+            if(result == "not_modified"):
+                return "", 304, {"ETag": self.Etag(version)}
+        else:
+            version = self._home.State_version(command)
+
+        # version from before the read, the response is at least this new
+        resp = self._Run(command, params, wait)
+        return resp[0], resp[1], dict(resp[2] if len(resp) > 2 else {}, ETag=self.Etag(version))
+
+    @staticmethod
+    def Etag(version):
+        return "\"" + str(version) + "\""
+
+    def _Run(self, command, params, wait):
+        # cheap commands and delayed commands (which only start a timer)
+        if(command in LOCAL_COMMANDS or "delay_seconds" in params):
+            return self._home.Run_command(params), 200
+
+        if(wait):
+            acquired = self._slots.acquire(timeout=self._timeout)
+        else:
+            acquired = self._slots.acquire(blocking=False)
+
+        if(not acquired):
+            return "busy", 503, {"Retry-After": str(BUSY_RETRY_AFTER)}
+
+        try:
+            future = self._pool.submit(self._home.Run_command, params)
+        except RuntimeError:
+            # pool shut down
+            self._slots.release()
+            return "busy", 503, {"Retry-After": str(BUSY_RETRY_AFTER)}
+        future.add_done_callback(lambda f: self._slots.release())
+
+        try:
+            return future.result(timeout=self._timeout), 200
+        except TimeoutError:
+            # command keeps running, client just stops waiting
+            return "timeout", 504
+
+    """
+    Function: Run_batch
+    given a list of command params, returns a list of results in the same
+    order, each a dict with the command, its status ("ok", "failed",
+    "invalid", "not_modified", "busy", "timeout" or "error"), its typed
+    result and how long it took in ms
+
+    commands on the same device (or the thermostat) run in the order given,
+    everything else runs concurrently
+    """
+    def Run_batch(self, batch):
+        results = [None] * len(batch)
+
+        groups = self._Batch_groups(batch)
+        futures = [self._batch_pool.submit(self._Run_group, batch, group, results) for group in groups]
+        for future in futures:
+            future.result()
+
+        return results
+
+    def _Batch_groups(self, batch):
+        # commands sharing a device (directly or through a rename) end up in one group, in batch order
+        group_of_key = dict()
+        groups = []
+
+        for i in range(len(batch)):
+            params = batch[i]
+            command = params.get("cmd", params.get("command"))
+
+            keys = [params[k] for k in ["name", "new_name"] if k in params]
+            if(command in THERMOSTAT_COMMANDS):
+                keys.append(None)
+
+            # merge the groups of every key the command touches
+            group = None
+            for key in keys:
+                other = group_of_key.get(key)
+                if(other is None or other is group):
+                    continue
+                if(group is None):
+                    group = other
+                else:
+                    group.extend(other)
+                    groups.remove(other)
+                    for k in group_of_key:
+                        if(group_of_key[k] is other):
+                            group_of_key[k] = group
+
+            if(group is None):
+                group = []
+                groups.append(group)
+            group.append(i)
+
+            for key in keys:
+                group_of_key[key] = group
+
+        for group in groups:
+            group.sort()
+
+        return groups
+
+    def _Run_group(self, batch, group, results):
+        for i in group:
+            params = dict(batch[i])
+            command = params.get("cmd", params.get("command"))
+
+            start = time.perf_counter()
+            try:
+                resp = self.Run(params, wait=True)
+                status, result = self._Batch_result(command, resp[0], resp[1])
+            except Exception as e:
+                self._home.Log("batch command \"" + str(command) + "\" failed: " + str(e))
+                status, result = "error", None
+
+            results[i] = {"cmd": command, "status": status, "result": result,
+                          "ms": round(1000 * (time.perf_counter() - start), 2)}
+
+    @staticmethod
+    def _Batch_result(command, body, http_status):
+        # returns (status, typed result) of a Run_command response
+        if(http_status == 304):
+            return "not_modified", None
+
+        if(http_status != 200):
+            return body, None
+
+        if(body in FAILED_RESPONSES):
+            return body, None
+
+        if(command == "list_devices"):
+            return "ok", [] if body == "none" else body.split(",")
+
+        if(command == "list_devices_with_types"):
+            return "ok", {} if body == "none" else dict(d.rsplit(":", 1) for d in body.split(","))
+
+        if(body == "unk"):
+            # level couldn't be read
+            return "ok", None
+
+        # numbers and json (power history) come back as such, everything else as a string
+        try:
+            return "ok", json.loads(body)
+        except ValueError:
+            return "ok", body
+
+    def Close(self):
+        self._batch_pool.shutdown(wait=False, cancel_futures=True)
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+def Sse_event(event_type, version, data):
+    return "id: " + str(version) + "\nevent: " + event_type + "\ndata: " + json.dumps(data) + "\n\n"
+
+"""
+Function: Stream_events
+given a home, a queue from Subscribe_state and temperature units, yields
+server-sent events: the whole state first, then each change made since
+"""
+def Stream_events(home, queue, units):
+    state = home.Get_state(units=units)
+    version = state["version"]
+    yield Sse_event("state", version, state)
+
+    while(True):
+        try:
+            event = queue.get(timeout=STREAM_KEEPALIVE)
+        except Empty:
+            # comment line, keeps proxies from closing the stream and finds clients that went away
+            yield ": keepalive\n\n"
+            continue
+
+        # already part of the state sent
+        if(event["version"] <= version):
+            continue
+
+        # fell behind, send the whole state again
+        if(event["event"] == "resync"):
+            state = home.Get_state(units=units)
+            version = state["version"]
+            yield Sse_event("state", version, state)
+            continue
+
+        if(event["event"] == "thermostat"):
+            event = home.Thermostat_in_units(event, units)
+            event["units"] = units
+
+        yield Sse_event(event["event"], event["version"], event)
+
 def main(args):
+    parser = argparse.ArgumentParser(description="home automation http server")
+    parser.add_argument("--sim", type=int, default=None, help="use a simulated radio with this many devices")
+    parser.add_argument("--dev", action="store_true", help="use the flask development server (debug, prints requests)")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--threads", type=int, default=HTTP_THREADS, help="http serving threads")
+    parser.add_argument("--radio-workers", type=int, default=RADIO_WORKERS, help="radio commands run at once")
+    parser.add_argument("--radio-queue", type=int, default=RADIO_QUEUE, help="radio commands running or waiting before refusing")
+    parser.add_argument("--backlog", type=int, default=HTTP_BACKLOG, help="pending connections before refusing")
+    parser.add_argument("--timeout", type=float, default=COMMAND_TIMEOUT, help="seconds to wait for a radio command")
+    parser.add_argument("--socket-timeout", type=float, default=HTTP_SOCKET_TIMEOUT, help="seconds an idle connection is kept")
+    parser.add_argument("--max-streams", type=int, default=MAX_STREAMS, help="event streams open at once")
+    parser.add_argument("--max-long-polls", type=int, default=MAX_LONG_POLLS, help="reads waiting for a state change at once")
+    parser.add_argument("--replay", default=None, help="use a radio playing back this frame trace")
+    parser.add_argument("--replay-speed", type=float, default=1.0, help="trace playback speed, e.g. 10 for ten times faster")
+    opts = parser.parse_args(args[1:])
+
+    # check if should use a simulated radio, e.g. "./server_main.py --sim 20"
+    radio = None
+    if(opts.sim is not None):
+        import sim_xbee
+        num_devices = opts.sim
+        # split fleet between switches and dimmers
+        radio = sim_xbee.Radio(sim_xbee.Make_fleet({SWITCH_TYPE: num_devices - num_devices//2, DIMMER_TYPE: num_devices//2}))
+
+    # or one playing back a captured trace, e.g. "./server_main.py --replay frames.trace --replay-speed 10"
+    elif(opts.replay is not None):
+        import sim_xbee
+        import frame_capture
+        radio = sim_xbee.Replay_radio(frame_capture.Load(opts.replay), speed=opts.replay_speed)
+
     # create instance of home server
-    myhome = Home()
+    myhome = Home(radio=radio)
+
+    runner = CommandRunner(myhome, workers=opts.radio_workers, queue_size=opts.radio_queue, timeout=opts.timeout,
+                           long_polls=opts.max_long_polls)
+
+    stream_slots = BoundedSemaphore(opts.max_streams)
 
     # setup http request handler
     app = Flask(__name__)
@@ -21,7 +360,7 @@ def main(args):
     app.config['BASIC_AUTH_PASSWORD'] = PASS
     app.config['BASIC_AUTH_FORCE'] = True
     basic_auth = BasicAuth(app)
-    
+
     @app.route('/',methods=['GET', 'POST'])
     @basic_auth.required
     def req_handler():
@@ -31,13 +370,93 @@ def main(args):
         else:
             params = request.args
 
-        print("received http request:\n" + str(params))
+        # Run_command may change params
+        params = dict(params)
+
+        # conditional read without waiting
+        if(request.if_none_match and "since_version" not in params):
+            etags = list(request.if_none_match)
+            if(len(etags) == 1 and etags[0].isdigit()):
+                params["since_version"] = etags[0]
+                params["timeout"] = 0
+
+        if(opts.dev):
+            print("received http request:\n" + str(params))
 
         # execute command
-        return(myhome.Run_command(params))
+        return runner.Run(params)
+
+    @app.route('/batch',methods=['POST'])
+    @basic_auth.required
+    def batch_handler():
+        # json list of command params, or {"commands": [...]}
+        batch = request.get_json(silent=True)
+        if(type(batch) is dict):
+            batch = batch.get("commands")
+
+        if(type(batch) is not list or not all(type(params) is dict for params in batch)):
+            return "invalid", 400
+
+        if(len(batch) > BATCH_MAX_COMMANDS):
+            return "too many commands", 413
+
+        if(opts.dev):
+            print("received http batch request:\n" + str(batch))
+
+        # execute commands
+        return Response(json.dumps(runner.Run_batch(batch)), mimetype="application/json")
+
+    @app.route('/metrics',methods=['GET'])
+    @basic_auth.required
+    def metrics_handler():
+        return Response(myhome.Metrics_text(), mimetype="text/plain; version=0.0.4")
+
+    @app.route('/events',methods=['GET'])
+    @basic_auth.required
+    def events_handler():
+        # check if units are specified
+        units = (request.args.get("units") or DEFAULT_TEMP_UNITS)[0].upper()
+        if(units not in ["F", "C", "K"]):
+            return "invalid", 400
+
+        if(not stream_slots.acquire(blocking=False)):
+            return "busy", 503, {"Retry-After": str(BUSY_RETRY_AFTER)}
+
+        queue = myhome.Subscribe_state()
+
+        resp = Response(Stream_events(myhome, queue, units), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+        # runs when the client goes away or the server stops
+        def Close_stream():
+            myhome.Unsubscribe_state(queue)
+            stream_slots.release()
+        resp.call_on_close(Close_stream)
+
+        return resp
 
     # start http server
-    app.run(host='0.0.0.0', port=PORT, ssl_context=('cert.pem', 'key.pem'), debug=True, use_reloader=False)
+    if(opts.dev):
+        app.run(host='0.0.0.0', port=opts.port, ssl_context=(CERT_FILENAME, KEY_FILENAME), debug=True, use_reloader=False)
+
+    elif(wsgi is None):
+        myhome.Log("cheroot not installed, serving with the flask server instead (pip3 install cheroot)")
+        app.run(host='0.0.0.0', port=opts.port, ssl_context=(CERT_FILENAME, KEY_FILENAME), threaded=True)
+
+    else:
+        server = wsgi.Server(('0.0.0.0', opts.port), app, numthreads=opts.threads,
+                             request_queue_size=opts.backlog, timeout=opts.socket_timeout)
+        server.ssl_adapter = BuiltinSSLAdapter(CERT_FILENAME, KEY_FILENAME)
+
+        myhome.Log("serving https on port " + str(opts.port) + " with " + str(opts.threads) + " threads")
+        try:
+            server.start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.stop()
+
+    runner.Close()
 
 if(__name__ == "__main__"):
     main(sys.argv)
@@ -0,0 +1,587 @@
+#!/usr/bin/env python3
+
+import time
+import random
+import heapq
+import struct
+from threading import *
+from collections import deque
+from frame_capture import RX
+
+"""
+simulated xbee/zigbee radio
+
+drop-in replacement for the xbee.ZigBee api object used by Home. commands
+sent with at()/remote_at() are delivered to virtual devices after a
+configurable mesh delay and their responses come back on a separate thread
+through the callback, as dicts shaped exactly like the frames python-xbee
+parses off the serial port.
+
+ReplayZigBee instead plays back the frames of a trace captured with
+frame_capture, to reproduce what a real radio did.
+"""
+
+##################### Link Model Constants ########################
+DEFAULT_SERIAL_LATENCY = 0.005  # seconds between host and coordinator, each way
+DEFAULT_HOP_LATENCY = 0.020     # seconds per mesh hop, each way
+DEFAULT_JITTER = 0.005          # max extra random delay per frame (seconds)
+DEFAULT_LOSS = 0.0              # probability a mesh frame is lost, each way
+
+DEFAULT_TEMP_C = 21.0           # temperature seen by the coordinator's sensor
+
+##################### Device Model Constants ######################
+# must match the pin assignments in home.py
+RELAY_TOGGLE = 'D0'
+RELAY_STAT = 'D1'
+CURRSENSE_OUT = 'D2'
+DPOT_OUT = 'D3'
+DPOT_UD_N = 'D4'
+DPOT_INC_N = 'D6'
+TEMP_ADC = 'D0'
+
+DPOT_NUM_POS = 30
+DIODE_DROP = 0.326
+AC_VOLTAGE = 170
+NOLOAD_VOUT = 2.5
+VOLTAGE_DIV = 0.4
+
+PIN_ADC = 2
+PIN_DINPUT = 3
+PIN_LOW = 4
+PIN_HIGH = 5
+
+STATUS_OK = b'\x00'
+STATUS_INVALID_COMMAND = b'\x02'
+
+"""
+Function: Volts2adc
+converts a voltage to a 10 bit adc reading referenced to 1.2 V
+"""
+def Volts2adc(volts):
+    return max(0, min(1023, int(round((volts / 1.2) * 1023))))
+
+"""
+Function: Param2int
+converts an at command parameter (bytes or str) to an int, None if not given
+"""
+def Param2int(parameter):
+    if(parameter is None):
+        return None
+    if(isinstance(parameter, str)):
+        parameter = parameter.encode("utf-8")
+    return int.from_bytes(bytes(parameter), "big")
+
+class SimLinkModel():
+    """
+    latency, jitter and loss model for one direction of a frame
+    """
+    def __init__(self, serial_latency=DEFAULT_SERIAL_LATENCY, hop_latency=DEFAULT_HOP_LATENCY,
+                 jitter=DEFAULT_JITTER, loss=DEFAULT_LOSS, seed=None):
+        self.serial_latency = serial_latency
+        self.hop_latency = hop_latency
+        self.jitter = jitter
+        self.loss = loss
+        self._rand = random.Random(seed)
+        self._rand_lock = Lock()
+
+    def Delay(self, hops):
+        with self._rand_lock:
+            jitter = self._rand.uniform(0, self.jitter) if self.jitter > 0 else 0
+        return self.serial_latency + hops*self.hop_latency + jitter
+
+    def Lost(self, hops):
+        # local frames never cross the mesh
+        if(hops == 0 or self.loss <= 0):
+            return False
+        with self._rand_lock:
+            return self._rand.random() < self.loss
+
+class SimDevice():
+    """
+    virtual end device behind a remote xbee
+
+    device_type is one of the Home device types ("switch", "dimmer",
+    "cust-switch", "cust-pulse", "cust-input"). load_watts is the power
+    drawn when fully on. hops is the mesh distance from the coordinator.
+    """
+    def __init__(self, mac, device_type, hops=1, load_watts=60.0, node_identifier=None, reachable=True):
+        self.mac = bytes(bytearray.fromhex(mac)) if isinstance(mac, str) else bytes(mac)
+        self.device_type = device_type
+        self.hops = hops
+        self.load_watts = load_watts
+        self.reachable = reachable
+        self.addr = struct.pack(">H", (Param2int(self.mac) & 0xFFFD) or 1)
+
+        if(node_identifier is None):
+            if(device_type.split("-")[0] == "cust"):
+                node_identifier = device_type + "_D4_" + self.mac.hex()[12:]
+            else:
+                node_identifier = device_type + "_" + self.mac.hex()[12:]
+        self.node_identifier = node_identifier
+
+        # pin configuration, "D0".."D9" -> config value
+        self.pins = dict()
+
+        # state of external inputs for cust-input devices, "D0".."D9" -> bool
+        self.inputs = dict()
+
+        # physical state
+        self.relay = False
+        self.wiper = 0           # dpot wiper position, 0 = brightest
+        self.dpot_up = False
+
+        # periodic sampling and change detection
+        self.sample_interval = 0 # seconds, 0 = off
+        self.sample_generation = 0
+        self.change_mask = 0
+
+    def Brightness(self):
+        if(not self.relay):
+            return 0.0
+        return (1.0 - (self.wiper / (DPOT_NUM_POS - 1)))**2
+
+    def Power(self):
+        if(self.device_type == "dimmer"):
+            return self.load_watts * self.Brightness()
+        if(self.device_type == "switch" and self.relay):
+            return self.load_watts
+        return 0.0
+
+    def Digital(self, pin):
+        if(pin == RELAY_STAT and self.device_type in ["switch", "dimmer"]):
+            return self.relay
+        if(pin in self.inputs):
+            return bool(self.inputs[pin])
+        return self.pins.get(pin) == PIN_HIGH
+
+    def Analog(self, pin):
+        if(pin == CURRSENSE_OUT and self.device_type in ["switch", "dimmer"]):
+            # current sense chip outputs NOLOAD_VOUT plus 100 mV per amp
+            current = (2.0 * self.Power()) / AC_VOLTAGE
+            chip_vout = NOLOAD_VOUT + current / 10.0
+            return Volts2adc(chip_vout * VOLTAGE_DIV - DIODE_DROP)
+        if(pin == DPOT_OUT and self.device_type == "dimmer"):
+            return Volts2adc(1.0 * self.wiper / (DPOT_NUM_POS - 1))
+        return 0
+
+    def Sample(self):
+        sample = dict()
+        for pin, conf in self.pins.items():
+            ident = pin[1:]
+            if(conf in [PIN_DINPUT, PIN_LOW, PIN_HIGH]):
+                sample["dio-" + ident] = self.Digital(pin)
+            elif(conf == PIN_ADC):
+                sample["adc-" + ident] = self.Analog(pin)
+        return sample
+
+    def Digital_state(self):
+        return {pin: self.Digital(pin) for pin, conf in self.pins.items() if conf in [PIN_DINPUT, PIN_LOW, PIN_HIGH]}
+
+    def Apply(self, command, parameter):
+        """
+        applies an at command, returns (status, response parameter)
+        """
+        value = Param2int(parameter)
+
+        # digital/analog pin configuration
+        if(len(command) == 2 and command[0] == "D" and command[1].isdigit()):
+            if(value is None):
+                return STATUS_OK, bytes([self.pins.get(command, 0)])
+
+            prev = self.pins.get(command)
+            self.pins[command] = value
+
+            if(self.device_type in ["switch", "dimmer"]):
+                # relay toggles on the rising edge of RELAY_TOGGLE
+                if(command == RELAY_TOGGLE and value == PIN_HIGH and prev != PIN_HIGH):
+                    self.relay = not self.relay
+                # dpot direction
+                elif(command == DPOT_UD_N):
+                    self.dpot_up = (value == PIN_HIGH)
+                # dpot steps on the falling edge of INC#
+                elif(command == DPOT_INC_N and value == PIN_LOW and prev == PIN_HIGH):
+                    if(self.dpot_up):
+                        self.wiper = min(DPOT_NUM_POS - 1, self.wiper + 1)
+                    else:
+                        self.wiper = max(0, self.wiper - 1)
+            return STATUS_OK, b''
+
+        elif(command == "IR"):
+            if(value is None):
+                return STATUS_OK, struct.pack(">H", int(self.sample_interval * 1000))
+            self.sample_interval = value / 1000.0
+            self.sample_generation += 1
+            return STATUS_OK, b''
+
+        elif(command == "IC"):
+            if(value is None):
+                return STATUS_OK, struct.pack(">H", self.change_mask)
+            self.change_mask = value
+            return STATUS_OK, b''
+
+        elif(command == "IS"):
+            return STATUS_OK, self.Sample()
+
+        elif(command == "NI"):
+            if(parameter is None):
+                return STATUS_OK, self.node_identifier.encode("utf-8")
+            self.node_identifier = parameter.decode("utf-8") if isinstance(parameter, (bytes, bytearray)) else str(parameter)
+            return STATUS_OK, b''
+
+        elif(command in ["AC", "WR"]):
+            return STATUS_OK, b''
+
+        return STATUS_INVALID_COMMAND, b''
+
+class SimGPIO():
+    """
+    stand-in for RPi.GPIO when not running on a raspberry pi
+    """
+    BCM = "BCM"
+    OUT = "OUT"
+    IN = "IN"
+    LOW = 0
+    HIGH = 1
+
+    _outputs = dict()
+
+    @staticmethod
+    def setmode(mode):
+        pass
+
+    @classmethod
+    def setup(cls, pin, direction, initial=0):
+        cls._outputs[pin] = initial
+
+    @classmethod
+    def output(cls, pin, value):
+        cls._outputs[pin] = value
+
+    @classmethod
+    def input(cls, pin):
+        return cls._outputs.get(pin, cls.LOW)
+
+    @classmethod
+    def cleanup(cls):
+        cls._outputs.clear()
+
+class SimZigBee():
+    """
+    simulated coordinator xbee with the same api as xbee.ZigBee
+
+    devices   : list of SimDevice in the mesh
+    link      : SimLinkModel used for every frame
+    callback  : called with each received frame (on the delivery thread)
+    temp_c    : temperature reported by the coordinator's TEMP_ADC pin
+    """
+    def __init__(self, devices=None, link=None, callback=None, temp_c=DEFAULT_TEMP_C):
+        self.link = link if link is not None else SimLinkModel()
+        self.temp_c = temp_c
+        self._callback = callback
+        self._devices = dict()
+        self._local = SimDevice(b'\x00' * 8, "coordinator", hops=0, node_identifier="coordinator")
+
+        # lock for device state and event queue
+        self._lock = Condition()
+        self._events = []
+        self._seq = 0
+        self._running = True
+
+        # latest scheduled arrival per device, keeps frames to one device in order
+        self._last_arrival = dict()
+
+        # frame counters
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.frames_lost = 0
+
+        for device in (devices or []):
+            self.Add_device(device)
+
+        self._thread = Thread(target=self._Run, name="sim-zigbee", daemon=True)
+        self._thread.start()
+
+    def Add_device(self, device):
+        with self._lock:
+            self._devices[device.mac] = device
+
+    def Remove_device(self, mac):
+        with self._lock:
+            self._devices.pop(bytes(mac), None)
+
+    def Get_device(self, mac):
+        if(isinstance(mac, str)):
+            mac = bytearray.fromhex(mac)
+        with self._lock:
+            return self._devices.get(bytes(mac))
+
+    def Devices(self):
+        with self._lock:
+            return list(self._devices.values())
+
+    ############### python-xbee api ###############
+
+    def at(self, **kwargs):
+        self.send("at", **kwargs)
+
+    def remote_at(self, **kwargs):
+        self.send("remote_at", **kwargs)
+
+    def send(self, cmd, **kwargs):
+        if(cmd == "at"):
+            self._Send_local(kwargs)
+        elif(cmd == "remote_at"):
+            self._Send_remote(kwargs)
+        else:
+            raise NotImplementedError("simulated radio does not support \"" + cmd + "\" frames")
+
+    def halt(self):
+        with self._lock:
+            self._running = False
+            self._lock.notify_all()
+        self._thread.join()
+
+    ############### internals ###############
+
+    def _Schedule(self, delay, action, order_key=None):
+        with self._lock:
+            arrival = time.monotonic() + delay
+
+            # never let a later frame overtake an earlier one on the same route
+            if(order_key is not None):
+                arrival = max(arrival, self._last_arrival.get(order_key, 0))
+                self._last_arrival[order_key] = arrival
+
+            self._seq += 1
+            heapq.heappush(self._events, (arrival, self._seq, action))
+            self._lock.notify()
+
+    def _Deliver(self, frame):
+        self.frames_received += 1
+        if(self._callback):
+            self._callback(frame)
+
+    def _Send_local(self, kwargs):
+        self.frames_sent += 1
+        command = self._Command(kwargs)
+        frame_id = kwargs.get("frame_id", b'\x01')
+        parameter = kwargs.get("parameter")
+
+        def action():
+            if(command == "ND"):
+                self._Discover(frame_id)
+                return
+
+            if(command == "IS"):
+                with self._lock:
+                    self._local.pins.setdefault(TEMP_ADC, PIN_ADC)
+                    status, resp = STATUS_OK, [self._Local_sample()]
+            else:
+                with self._lock:
+                    status, resp = self._local.Apply(command, parameter)
+
+            if(frame_id != b'\x00'):
+                frame = {'id': 'at_response', 'frame_id': frame_id, 'command': command.encode("ascii"),
+                         'status': status, 'parameter': resp}
+                self._Schedule(self.link.Delay(0), lambda: self._Deliver(frame), order_key=b'local-rx')
+
+        self._Schedule(self.link.Delay(0), action, order_key=b'local-tx')
+
+    def _Local_sample(self):
+        sample = self._local.Sample()
+        # tmp36 style sensor, 10 mV per degree C with 500 mV offset
+        sample["adc-" + TEMP_ADC[1:]] = Volts2adc(0.5 + self.temp_c * 0.01)
+        return sample
+
+    def _Send_remote(self, kwargs):
+        self.frames_sent += 1
+        command = self._Command(kwargs)
+        frame_id = kwargs.get("frame_id", b'\x00')
+        parameter = kwargs.get("parameter")
+        dest = bytes(kwargs.get("dest_addr_long", b''))
+
+        device = self.Get_device(dest)
+
+        # unknown destination, coordinator reports a transmission failure
+        if(device is None or not device.reachable):
+            if(frame_id != b'\x00'):
+                frame = {'id': 'remote_at_response', 'frame_id': frame_id, 'source_addr_long': dest,
+                         'source_addr': b'\xff\xfe', 'command': command.encode("ascii"), 'status': b'\x04'}
+                self._Schedule(self.link.Delay(0) + 4 * self.link.hop_latency, lambda: self._Deliver(frame))
+            return
+
+        if(self.link.Lost(device.hops)):
+            self.frames_lost += 1
+            return
+
+        def action():
+            with self._lock:
+                prev_digital = device.Digital_state()
+                status, resp = device.Apply(command, parameter)
+                new_digital = device.Digital_state()
+
+            if(frame_id != b'\x00'):
+                frame = {'id': 'remote_at_response', 'frame_id': frame_id, 'source_addr_long': device.mac,
+                         'source_addr': device.addr, 'command': command.encode("ascii"), 'status': status}
+                if(isinstance(resp, dict)):
+                    frame['parameter'] = [resp]
+                elif(resp):
+                    frame['parameter'] = resp
+                self._Respond(device, frame)
+
+            # periodic sampling (re)configured, first sample goes out immediately
+            if(command == "IR" and device.sample_interval > 0):
+                self._Periodic_sample(device, device.sample_generation)
+
+            # change detection on monitored digital pins
+            if(device.change_mask):
+                for pin, val in new_digital.items():
+                    if((device.change_mask >> int(pin[1:])) & 1 and prev_digital.get(pin) != val):
+                        self._Send_io_sample(device)
+                        break
+
+        self._Schedule(self.link.Delay(device.hops), action, order_key=device.mac)
+
+    def _Respond(self, device, frame):
+        if(self.link.Lost(device.hops)):
+            self.frames_lost += 1
+            return
+        self._Schedule(self.link.Delay(device.hops), lambda: self._Deliver(frame), order_key=device.mac + b'-rx')
+
+    def _Send_io_sample(self, device):
+        with self._lock:
+            sample = device.Sample()
+        frame = {'id': 'rx_io_data_long_addr', 'source_addr_long': device.mac, 'source_addr': device.addr,
+                 'options': b'\x01', 'samples': [sample]}
+        self._Respond(device, frame)
+
+    def _Periodic_sample(self, device, generation):
+        def action():
+            # stop if sampling was turned off or reconfigured
+            if(not self._running or device.sample_generation != generation or not device.reachable):
+                return
+            self._Send_io_sample(device)
+            self._Schedule(device.sample_interval, action)
+        action()
+
+    def _Discover(self, frame_id):
+        for device in self.Devices():
+            if(not device.reachable or self.link.Lost(device.hops)):
+                continue
+            parameter = {'source_addr': device.addr, 'source_addr_long': device.mac,
+                         'node_identifier': device.node_identifier.encode("utf-8"),
+                         'parent_address': b'\xff\xfe', 'device_type': b'\x02', 'status': b'\x00',
+                         'profile_id': b'\xc1\x05', 'manufacturer': b'\x10\x1e'}
+            frame = {'id': 'at_response', 'frame_id': frame_id, 'command': b'ND',
+                     'status': STATUS_OK, 'parameter': parameter}
+            self._Respond(device, frame)
+
+    @staticmethod
+    def _Command(kwargs):
+        command = kwargs.get("command")
+        if(isinstance(command, (bytes, bytearray))):
+            command = command.decode("ascii")
+        return command
+
+    def _Run(self):
+        while(True):
+            with self._lock:
+                while(self._running and (not self._events or self._events[0][0] > time.monotonic())):
+                    if(self._events):
+                        self._lock.wait(self._events[0][0] - time.monotonic())
+                    else:
+                        self._lock.wait()
+                if(not self._running):
+                    return
+                arrival, seq, action = heapq.heappop(self._events)
+            try:
+                action()
+            except Exception as e:
+                print("sim-zigbee: error delivering frame: " + str(e))
+
+class ReplayZigBee(SimZigBee):
+    """
+    plays back the frames received in a captured trace, with the same api
+    as xbee.ZigBee
+
+    frames sent to it are not applied to anything. a response played back
+    takes the frame id of the oldest unanswered command with the same at
+    command and destination, so commands sent before their captured
+    response is played resolve as they did when captured
+
+    trace    : frame_capture.Trace to play
+    speed    : playback speed, 1 keeps the recorded timing, 10 plays ten times faster
+    callback : called with each played frame (on the delivery thread)
+    """
+    def __init__(self, trace, speed=1.0, callback=None):
+        super().__init__(callback=callback)
+
+        # (command, destination mac or b'local') -> frame ids of commands waiting for their response
+        self._frame_ids = dict()
+
+        self.frames_replayed = 0
+
+        for t, direction, frame in trace.frames:
+            if(direction == RX):
+                self._Schedule(t / speed, self._Replay_action(frame))
+
+    def send(self, cmd, **kwargs):
+        self.frames_sent += 1
+        frame_id = kwargs.get("frame_id", b'\x00')
+        if(frame_id == b'\x00'):
+            return
+
+        command = self._Command(kwargs).encode("ascii")
+        dest = bytes(kwargs["dest_addr_long"]) if cmd == "remote_at" else b'local'
+        with self._lock:
+            self._frame_ids.setdefault((command, dest), deque()).append(frame_id)
+
+    def _Replay_action(self, frame):
+        def action():
+            if(frame.get("id") in ["at_response", "remote_at_response"]):
+                dest = bytes(frame["source_addr_long"]) if "source_addr_long" in frame else b'local'
+                with self._lock:
+                    waiting = self._frame_ids.get((frame.get("command"), dest))
+                    frame_id = waiting.popleft() if waiting else None
+                if(frame_id is not None):
+                    frame["frame_id"] = frame_id
+            self.frames_replayed += 1
+            self._Deliver(frame)
+        return action
+
+"""
+Function: Make_fleet
+builds a list of SimDevice with sequential mac addresses
+counts is a dict of device type -> number of devices
+"""
+def Make_fleet(counts, max_hops=3, seed=None):
+    rand = random.Random(seed)
+    devices = []
+    n = 0
+    for device_type in sorted(counts):
+        for i in range(counts[device_type]):
+            n += 1
+            mac = "0013a200" + ("%08x" % (0x40000000 + n))
+            devices.append(SimDevice(mac, device_type, hops=rand.randint(1, max_hops),
+                                     load_watts=rand.choice([40.0, 60.0, 100.0, 450.0])))
+    return devices
+
+"""
+Function: Radio
+returns a function usable as the radio argument of Home, building a
+SimZigBee with the given devices and link model
+"""
+def Radio(devices=None, link=None, temp_c=DEFAULT_TEMP_C):
+    return lambda callback: SimZigBee(devices=devices, link=link, callback=callback, temp_c=temp_c)
+
+"""
+Function: Replay_radio
+returns a function usable as the radio argument of Home, building a
+ReplayZigBee playing the given frame_capture.Trace
+"""
+def Replay_radio(trace, speed=1.0):
+    return lambda callback: ReplayZigBee(trace, speed=speed, callback=callback)
+
+if(__name__ == "__main__"):
+    print("this is a library. import it to use it")
+    exit(0)
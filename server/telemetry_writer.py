@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+import os
+import gzip
+import time
+import shutil
+import logging
+from queue import *
+from threading import *
+
+"""
+buffered csv log writer
+
+rows handed to Write are queued and written in batches by a dedicated
+thread, so callers never wait on the disk. the file is rotated when it
+gets too big or a new day starts, and rotated segments are gzipped next
+to it as <name>-<segment start time>.csv.gz.
+"""
+
+DEFAULT_MAX_BYTES = 5*1024*1024  # size a file may grow to before it is rotated
+DEFAULT_FLUSH_INTERVAL = 30      # seconds rows may wait in memory before being written
+DEFAULT_MAX_BATCH = 1000         # rows written at once at most
+DEFAULT_MAX_RETRY = 10000        # rows of failed writes kept to retry, the oldest are dropped past this
+
+SEGMENT_TIMESTAMP = "%Y%m%d-%H%M%S"
+
+class TelemetryWriter():
+    """
+    filename       : csv file rows are written to
+    header         : list of column names, the first column is the row time
+    timestamp      : strftime format the row time is written with
+    max_bytes      : size that triggers rotation, 0 for no size limit
+    rotate_daily   : if True a new file is started at local midnight
+    compress       : if True rotated segments are gzipped
+    flush_interval : seconds to collect rows before writing them
+    on_rotate      : optional function called (on the writer thread) with each new segment filename
+    log            : optional function write errors are reported to, called like Home.Log with a
+                     message, % args and level=, logs to the "telemetry" logger if not given
+    max_retry      : rows of failed writes kept to retry with the next batch
+    """
+    def __init__(self, filename, header, timestamp, max_bytes=DEFAULT_MAX_BYTES, rotate_daily=True,
+                 compress=True, flush_interval=DEFAULT_FLUSH_INTERVAL, on_rotate=None, log=None,
+                 max_retry=DEFAULT_MAX_RETRY):
+        self._filename = filename
+        self._header = header
+        self._timestamp = timestamp
+        self._max_bytes = max_bytes
+        self._rotate_daily = rotate_daily
+        self._compress = compress
+        self._flush_interval = flush_interval
+        self._on_rotate = on_rotate
+        self._log = log if log is not None else self._Default_log
+        self._max_retry = max_retry
+
+        # rows waiting to be written, None tells the writer to stop
+        self._queue = Queue()
+
+        # unix time of the first row in the current file
+        self._segment_start = self._Read_segment_start()
+
+        # size of the current file, kept up to date by the writer rather than asked of the os per row
+        self._file_bytes = os.path.getsize(filename) if os.path.isfile(filename) else 0
+
+        self._thread = Thread(target=self._Run, name="telemetry-" + os.path.basename(filename), daemon=True)
+        self._thread.start()
+
+    """
+    Function: Write
+    queues a row to be written, the first field is its unix time
+    """
+    def Write(self, row):
+        self._queue.put(row)
+
+    """
+    Function: Close
+    writes any queued rows and stops the writer thread
+    """
+    def Close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    """
+    Function: Segments
+    returns the rotated segment filenames, oldest first
+    """
+    def Segments(self):
+        directory = os.path.dirname(os.path.abspath(self._filename))
+        prefix = self._Segment_prefix()
+        extension = os.path.splitext(self._filename)[1]
+
+        segments = []
+        for name in os.listdir(directory):
+            if(not name.startswith(prefix)):
+                continue
+            stamp = name[len(prefix):].split(".")[0]
+            if(name[len(prefix) + len(stamp):] not in [extension, extension + ".gz"]):
+                continue
+            try:
+                time.strptime(stamp, SEGMENT_TIMESTAMP)
+            except ValueError:
+                continue
+            segments.append(os.path.join(directory, name))
+
+        # segment timestamps sort in time order
+        return sorted(segments)
+
+    def _Run(self):
+        # rows a write failed on, retried ahead of the next batch
+        unwritten = []
+
+        running = True
+        while(running):
+            row = self._queue.get()
+            if(row is None):
+                # last try at anything left over
+                running = False
+                batch = []
+            else:
+                # collect rows until the flush interval passes
+                batch = [row]
+                deadline = time.monotonic() + self._flush_interval
+                while(len(batch) < DEFAULT_MAX_BATCH):
+                    remaining = deadline - time.monotonic()
+                    if(remaining <= 0):
+                        break
+                    try:
+                        row = self._queue.get(timeout=remaining)
+                    except Empty:
+                        break
+                    if(row is None):
+                        running = False
+                        break
+                    batch.append(row)
+
+            unwritten = self._Try_write(unwritten + batch)
+
+        if(unwritten):
+            self._log("telemetry writer: dropped %s rows never written to %s", len(unwritten), self._filename,
+                      level=logging.ERROR)
+
+    def _Try_write(self, rows):
+        # returns the rows that couldn't be written
+        if(not rows):
+            return rows
+
+        try:
+            self._Write_batch(rows)
+        except Exception as e:
+            self._log("telemetry writer: could not write %s, keeping %s rows to retry: %s", self._filename, len(rows), e,
+                      level=logging.WARNING)
+
+            if(len(rows) > self._max_retry):
+                self._log("telemetry writer: dropped %s oldest rows of %s", len(rows) - self._max_retry, self._filename,
+                          level=logging.ERROR)
+                del(rows[:len(rows) - self._max_retry])
+
+        return rows
+
+    def _Write_batch(self, batch):
+        # rows are removed from batch as they are written, if this raises batch holds the rest
+        lines = []
+        pending_bytes = 0
+        while(len(lines) < len(batch)):
+            row = batch[len(lines)]
+
+            # rotate before a row that belongs in a new segment
+            if(self._segment_start is not None and self._Needs_rotation(row[0], pending_bytes)):
+                self._Append(lines)
+                del(batch[:len(lines)])
+                lines = []
+                pending_bytes = 0
+                self._Rotate()
+
+            if(self._segment_start is None):
+                self._segment_start = row[0]
+
+            line = (time.strftime(self._timestamp, time.localtime(row[0])) + "," +
+                    ",".join(str(field) for field in row[1:]) + "\n")
+            lines.append(line)
+            pending_bytes += len(line)
+
+        self._Append(lines)
+        del(batch[:len(lines)])
+
+    def _Append(self, lines):
+        if(not lines):
+            return
+
+        new_file = not os.path.isfile(self._filename)
+        if(new_file):
+            self._file_bytes = 0
+        with open(self._filename, 'a') as f:
+            if(new_file):
+                self._file_bytes += f.write(",".join(self._header) + "\n")
+            self._file_bytes += f.write("".join(lines))
+
+    def _Needs_rotation(self, row_time, pending_bytes):
+        if(self._rotate_daily and time.localtime(row_time)[:3] != time.localtime(self._segment_start)[:3]):
+            return True
+
+        if(self._max_bytes):
+            return self._file_bytes + pending_bytes >= self._max_bytes
+
+        return False
+
+    def _Rotate(self):
+        if(not os.path.isfile(self._filename)):
+            self._segment_start = None
+            self._file_bytes = 0
+            return
+
+        segment = self._Segment_prefix() + time.strftime(SEGMENT_TIMESTAMP, time.localtime(self._segment_start))
+        segment = os.path.join(os.path.dirname(os.path.abspath(self._filename)), segment + os.path.splitext(self._filename)[1])
+
+        os.replace(self._filename, segment)
+        self._segment_start = None
+        self._file_bytes = 0
+
+        if(self._compress):
+            with open(segment, 'rb') as f_in, gzip.open(segment + ".gz", 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            os.remove(segment)
+            segment += ".gz"
+
+        if(self._on_rotate is not None):
+            self._on_rotate(segment)
+
+    @staticmethod
+    def _Default_log(logstr, *args, level=logging.INFO):
+        logging.getLogger("telemetry").log(level, logstr, *args)
+
+    def _Segment_prefix(self):
+        return os.path.splitext(os.path.basename(self._filename))[0] + "-"
+
+    def _Read_segment_start(self):
+        # time of the first row of an existing file, so a restart keeps rotating on schedule
+        if(not os.path.isfile(self._filename)):
+            return None
+
+        with open(self._filename) as f:
+            f.readline()
+            first_row = f.readline()
+
+        try:
+            return time.mktime(time.strptime(first_row.split(",")[0], self._timestamp))
+        except ValueError:
+            return os.path.getmtime(self._filename)
+
+if(__name__ == "__main__"):
+    print("this is a library. import it to use it")
+    exit(0)
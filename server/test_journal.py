@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+# USAGE: python3 -m unittest test_journal (or pytest) from the server directory
+
+import os
+import json
+import tempfile
+import unittest
+
+from journal import Journal, LOG_SUFFIX
+
+"""
+regression tests for journal.Journal
+"""
+
+class TornLogTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._tmp_dir.name, "db.json")
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _Crash(self, journal):
+        # stop journaling without the final snapshot Close would write, like a killed process
+        with journal._lock:
+            journal._running = False
+            journal._lock.notify_all()
+            journal._log.close()
+            journal._log = None
+        journal._thread.join()
+
+    def test_record_after_torn_first_line_survives(self):
+        with open(self._filename + LOG_SUFFIX, "w") as f:
+            f.write('["set", "a", {"x"')
+
+        journal = Journal(self._filename, fsync_delay=0)
+        self.assertEqual(journal.Load(), {})
+        journal.Set("b", 1)
+        self._Crash(journal)
+
+        journal = Journal(self._filename, fsync_delay=0)
+        self.assertEqual(journal.Load(), {"b": 1})
+        journal.Close()
+
+    def test_record_after_torn_last_line_survives(self):
+        with open(self._filename + LOG_SUFFIX, "w") as f:
+            f.write(json.dumps(["set", "a", 1]) + "\n")
+            f.write('["set", "b"')
+
+        journal = Journal(self._filename, fsync_delay=0)
+        self.assertEqual(journal.Load(), {"a": 1})
+        journal.Set("c", 2)
+        self._Crash(journal)
+
+        journal = Journal(self._filename, fsync_delay=0)
+        self.assertEqual(journal.Load(), {"a": 1, "c": 2})
+        journal.Close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+import time
+from threading import *
+from concurrent.futures import Future
+
+"""
+frame id correlated at/remote_at commands
+
+every command sent through XBeeTransactions gets its own api frame id and
+returns a Future resolved from the matching at_response/remote_at_response
+frame, so callers can keep several commands in flight (across devices) and
+still know when, and whether, each one was applied.
+"""
+
+DEFAULT_WINDOW = 8        # max outstanding commands
+DEFAULT_TIMEOUT = 2       # seconds before an unanswered command is given up on
+
+FIRST_FRAME_ID = 2        # frame id 1 is left for callers using the api directly (e.g. ND)
+LAST_FRAME_ID = 255
+
+STATUS_OK = b'\x00'
+
+class XBeeTransactions():
+    """
+    zb      : ZigBee api object (or sim_xbee.SimZigBee)
+    zb_lock : lock held while writing a frame to zb
+    window  : max number of commands waiting for a response
+    timeout : seconds to wait for a response before resolving to False
+    metrics : optional metrics.Metrics to count frames, round trips and timeouts in
+    """
+    def __init__(self, zb, zb_lock, window=DEFAULT_WINDOW, timeout=DEFAULT_TIMEOUT, metrics=None):
+        self._zb = zb
+        self._zb_lock = zb_lock
+        self._timeout = timeout
+        self._metrics = metrics
+
+        # limits number of outstanding commands
+        self._window = BoundedSemaphore(window)
+
+        # lock/condition for pending table
+        self._lock = Condition()
+
+        # outstanding commands, frame id -> (command, future, deadline, time sent)
+        self._pending = dict()
+        self._next_id = FIRST_FRAME_ID
+        self._running = True
+
+        # thread expiring unanswered commands
+        self._reaper = Thread(target=self._Reap, name="xbee-tx-reaper", daemon=True)
+        self._reaper.start()
+
+    """
+    Function: At
+    sends an at command to the local xbee, returns a Future resolving to
+    the response frame, or False if it timed out
+    """
+    def At(self, command, parameter=None):
+        return self._Send("at", command, parameter)
+
+    """
+    Function: Remote_at
+    sends an at command to a remote xbee, returns a Future resolving to
+    the response frame, or False if it timed out
+    """
+    def Remote_at(self, dest_addr_long, command, parameter=None):
+        return self._Send("remote_at", command, parameter, dest_addr_long=dest_addr_long)
+
+    """
+    Function: Handle_response
+    given a received packet, resolves the matching outstanding command
+    returns True if the packet was a response to one of them
+    """
+    def Handle_response(self, packet):
+        if(packet.get("id") not in ["at_response", "remote_at_response"] or "frame_id" not in packet):
+            return False
+
+        frame_id = packet["frame_id"][0]
+
+        with self._lock:
+            pending = self._pending.get(frame_id)
+
+            # check response is for the command sent with this id
+            if(pending is None or pending[0] != packet.get("command")):
+                return False
+
+            del(self._pending[frame_id])
+
+        self._window.release()
+        if(self._metrics is not None):
+            self._metrics.Observe("xbee_command_seconds", time.monotonic() - pending[3])
+        pending[1].set_result(packet)
+        return True
+
+    """
+    Function: Outstanding
+    returns number of commands waiting for a response
+    """
+    def Outstanding(self):
+        with self._lock:
+            return len(self._pending)
+
+    def Close(self):
+        with self._lock:
+            self._running = False
+            self._lock.notify_all()
+        self._reaper.join()
+
+        # fail anything still waiting
+        with self._lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for command, future, deadline, sent in pending:
+            future.set_result(False)
+
+    @staticmethod
+    def Ok(response):
+        return bool(response) and response.get("status") == STATUS_OK
+
+    def _Send(self, api_command, command, parameter, **kwargs):
+        future = Future()
+
+        # wait for room in the window
+        if(not self._window.acquire(timeout=self._timeout)):
+            if(self._metrics is not None):
+                self._metrics.Inc("xbee_command_timeouts_total")
+            future.set_result(False)
+            return future
+
+        with self._lock:
+            # closed, nothing would ever resolve or expire the command
+            if(not self._running):
+                self._window.release()
+                future.set_result(False)
+                return future
+
+            frame_id = self._Allocate_id()
+            now = time.monotonic()
+            self._pending[frame_id] = (command.encode("ascii"), future, now + self._timeout, now)
+            self._lock.notify()
+
+        if(parameter is not None):
+            kwargs["parameter"] = parameter
+
+        with self._zb_lock:
+            getattr(self._zb, api_command)(frame_id=bytes([frame_id]), command=command, **kwargs)
+
+        if(self._metrics is not None):
+            self._metrics.Inc("xbee_frames_sent_total", frame=api_command)
+
+        return future
+
+    def _Allocate_id(self):
+        # must hold self._lock, window guarantees a free id exists
+        while(self._next_id in self._pending):
+            self._Advance_id()
+        frame_id = self._next_id
+        self._Advance_id()
+        return frame_id
+
+    def _Advance_id(self):
+        self._next_id += 1
+        if(self._next_id > LAST_FRAME_ID):
+            self._next_id = FIRST_FRAME_ID
+
+    def _Reap(self):
+        while(True):
+            expired = []
+            with self._lock:
+                if(not self._running):
+                    return
+
+                now = time.monotonic()
+                for frame_id, (command, future, deadline, sent) in list(self._pending.items()):
+                    if(deadline <= now):
+                        expired.append(future)
+                        del(self._pending[frame_id])
+
+                if(not expired):
+                    if(self._pending):
+                        self._lock.wait(min(pending[2] for pending in self._pending.values()) - now)
+                    else:
+                        self._lock.wait()
+
+            for future in expired:
+                self._window.release()
+                if(self._metrics is not None):
+                    self._metrics.Inc("xbee_command_timeouts_total")
+                future.set_result(False)
+
+if(__name__ == "__main__"):
+    print("this is a library. import it to use it")
+    exit(0)